@@ -9,7 +9,7 @@ Amazon's S3 service.
 '''
 
 # Function to insert derivatives into the un-normalized database
-def insert_unormd(roi_txt_fpaths, creds_path, oasis_file):
+def insert_unormd(roi_txt_fpaths, creds_path, oasis_file, batch_size=None):
     '''
     Function to insert image results data for ANTs cortical thickness
     to the DERIVATIVES_UNORMD table in miNDAR.
@@ -25,6 +25,9 @@ def insert_unormd(roi_txt_fpaths, creds_path, oasis_file):
         'Secret Access Key' string and ASCII text
     oasis_file : string
         filepath to the Oasis_ROIs.txt file
+    batch_size : integer (optional)
+        number of entries to send to the database at a time; see
+        bulk_insert.py
 
     Returns
     -------
@@ -34,9 +37,11 @@ def insert_unormd(roi_txt_fpaths, creds_path, oasis_file):
     '''
 
     # Import packages
+    import bulk_insert
     import cx_Oracle
     import datetime
     import fetch_creds
+    import id_allocator
     import os
 
     # Init variables
@@ -85,22 +90,11 @@ def insert_unormd(roi_txt_fpaths, creds_path, oasis_file):
     deriv_name = 'cortical thickness'
     measure_name = 'mean'
     units = 'mm'
-    # Get the next derivativeid (primary key from table)
-    deriv_id = return_next_pk(cursor, 'derivatives_unormd')
+    # Primary keys come from the table's allocator
+    allocator = id_allocator.get_allocator('derivatives_unormd', 'id')
 
-    # Command string
-    cmd = '''
-          insert into derivatives_unormd
-          (id, atlasname, atlasversion, roi, roidescription, pipelinename, pipelinetype, 
-          cfgfilelocation, pipelinetools, pipelineversion, pipelinedescription, 
-          derivativename, measurename, datasetid, timestamp, value, units, guid)
-          values
-          (:col_1, :col_2, :col_3, :col_4, :col_5, :col_6, :col_7, :col_8, :col_9, 
-           :col_10, :col_11, :col_12, :col_13, :col_14, :col_15, :col_16, :col_17,
-           :col_18)
-          '''
-
-    # Iterate through dictionary and upload data
+    # Iterate through dictionary and build the rows for all subjects
+    rows = []
     not_in_nitrc = []
     for key, val in big_dic.iteritems():
         # Find subject in image03 to get datasetID
@@ -116,38 +110,27 @@ def insert_unormd(roi_txt_fpaths, creds_path, oasis_file):
         guid = res[0][0]
         print 'dataset_id ', dataset_id
         print 'guid', guid
-        # Iterate through ROIs
-        for k, v in val.iteritems():
-            # Timestamp
-            timestamp = str(datetime.datetime.now())
-            # Get ROI number
-            roi = k.split('Mean_')[1]
-            roi_name = roi_dic[k]
-            # Value
-            value = float(v)
-            # Execute insert command
-            cursor.execute(cmd,
-                           col_1 = deriv_id,
-                           col_2 = atlas_name,
-                           col_3 = atlas_ver,
-                           col_4 = roi,
-                           col_5 = roi_name,
-                           col_6 = pipeline_name,
-                           col_7 = pipeline_type,
-                           col_8 = cfg_file_loc,
-                           col_9 = pipeline_tools,
-                           col_10 = pipeline_ver,
-                           col_11 = pipeline_desc,
-                           col_12 = deriv_name,
-                           col_13 = measure_name,
-                           col_14 = dataset_id,
-                           col_15 = timestamp,
-                           col_16 = value,
-                           col_17 = units,
-                           col_18 = guid)
-            # Increment the unique id
-            deriv_id += 1
-            print 'deriv_id ', deriv_id
+        # Values shared by all of the subject's entries
+        fields = {'atlasname' : atlas_name, 'atlasversion' : atlas_ver,
+                  'pipelinename' : pipeline_name,
+                  'pipelinetype' : pipeline_type,
+                  'cfgfilelocation' : cfg_file_loc,
+                  'pipelinetools' : pipeline_tools,
+                  'pipelineversion' : pipeline_ver,
+                  'pipelinedescription' : pipeline_desc,
+                  'derivativename' : deriv_name, 'measurename' : measure_name,
+                  'datasetid' : dataset_id,
+                  'timestamp' : str(datetime.datetime.now()),
+                  'units' : units, 'guid' : guid}
+        # Build the rows for the subject's ROIs
+        rows.extend(bulk_insert.roi_rows(allocator.take(cursor, len(val)),
+                                         val, roi_dic, fields))
+
+    # Insert all of the rows, one round trip per batch_size rows
+    num_rows = bulk_insert.insert_rows(cursor, 'derivatives_unormd',
+                                       bulk_insert.roi_columns, rows,
+                                       batch_size=batch_size)
+    print 'inserted %d entries' % num_rows
 
     # And commit changes
     cursor.execute('commit')
@@ -253,9 +236,9 @@ def insert_img_unormd(id_s3_list, creds_path):
                        col_14 = guid,
                        col_15 = dataset_id,
                        col_16 = roi_description)
-        # Increment the unique id
+        # Get the next unique id
         print 'deriv_id ', deriv_id
-        deriv_id += 1
+        deriv_id = return_next_pk(cursor, 'img_derivatives_unormd')
 
     # Commit the changes and close the cursor/connection
     cursor.execute('commit')
@@ -452,8 +435,8 @@ def transfer_table_entries(creds_path):
                                 col_19=cfgfile)
         # Commit changes
         cursor.execute('commit')
-        # Increment to next unique pk id
-        deriv_id += 1
+        # Get the next unique pk id
+        deriv_id = insert_utils.return_next_pk(cursor, 'ABIDE_IMG_RESULTS')
         print deriv_id
 
     # Get abide results from derivatives_unormd (ABIDE id's have an 'a' in them)
@@ -504,6 +487,6 @@ def transfer_table_entries(creds_path):
                                 col_19=cfgfile)
         # Commit changes
         cursor.execute('commit')
-        # Increment to next unique pk id
-        deriv_id += 1
+        # Get the next unique pk id
+        deriv_id = insert_utils.return_next_pk(cursor, 'ABIDE_IMG_RESULTS')
         print deriv_id
@@ -284,7 +284,7 @@ def upload_results(cursor, url_path):
     #url_file = urllib.urlopen(url_path)
     #file_contents = url_file.readlines()
     # Known field values for CIVET pipeline results
-    deriv_id = return_next_pk(cursor)
+    deriv_id = return_next_pk(cursor, 'abide_img_results')
     # Pipeline info
     pname = 'CIVET'
     ptype = 'Executable C, Perl'
@@ -370,7 +370,7 @@ def upload_results(cursor, url_path):
                            col_19=units)
             # Commit changes
             cursor.execute('commit')
-            deriv_id += 1
+            deriv_id = return_next_pk(cursor, 'abide_img_results')
             print deriv_id
 
     # If it's a txt file, get the specific file's info
@@ -78,7 +78,7 @@ def extract_upload_stats(cursor, url_path, subs_dir):
     mlist = s.measures
 
     # Get next derivative id to insert
-    deriv_id = insert_utils.return_next_pk(cursor)
+    deriv_id = insert_utils.return_next_pk(cursor, 'abide_img_results')
     if 'aparc.stats' in fname:
         # Set atlas to parcellation atlas
         atlas = 'Desikan-Killiany Atlas'
@@ -127,7 +127,7 @@ def extract_upload_stats(cursor, url_path, subs_dir):
                        col_19=units)
         # Commit changes
         cursor.execute('commit')
-        deriv_id += 1
+        deriv_id = insert_utils.return_next_pk(cursor, 'abide_img_results')
         print deriv_id
 
 
@@ -280,7 +280,7 @@ def upload_results(cursor, url_path):
     else:
         # Init variables
         # Known field values for CIVET pipeline results
-        deriv_id = insert_utils.return_next_pk(cursor)
+        deriv_id = insert_utils.return_next_pk(cursor, 'abide_img_results')
         # S3 path
         s3_path = url_path
         # Get datasetid and guid
@@ -162,7 +162,10 @@ def return_datasetid_guid(cursor, subid):
 # Return the new unique id for table entry
 def return_next_pk(cursor, table_name):
     '''
-    Function to grab the next unique primary key from a table
+    Function to grab the next unique primary key from a table; keys are
+    served from blocks reserved from a sequence (see id_allocator.py),
+    so concurrent writers never get the same key and the table isn't
+    scanned. Keys are not consecutive, so call this for each entry.
 
     Parameters
     ----------
@@ -170,7 +173,7 @@ def return_next_pk(cursor, table_name):
         a cx_Oracle cursor object which is used to query and modify an
         Oracle database
     table_name : string
-        name of the Oracle table to search
+        name of the Oracle table to insert into
 
     Returns
     -------
@@ -178,14 +181,11 @@ def return_next_pk(cursor, table_name):
         the next primary key to use from table table_name
     '''
 
-    # Get the next derivativeid (primary key from table)
-    pk_cmd = 'select max(id) from %s' % table_name
-    cursor.execute(pk_cmd)
-    res = cursor.fetchall()[0][0]
-    if res:
-        deriv_id = res + 1
-    else:
-        deriv_id = 1
+    # Import packages
+    import id_allocator
+
+    # Get the next derivativeid (primary key for the table)
+    deriv_id = id_allocator.next_pk(cursor, table_name, 'id')
 
     # Return the primary key
     return deriv_id 
@@ -296,7 +296,7 @@ def upload_results(cursor, url_path):
     # Set up lists of keys
     pnames = [pn for pn in pipeline_dict.iterkeys()]
     # Get next derivative id
-    deriv_id = return_next_pk(cursor)
+    deriv_id = return_next_pk(cursor, 'abide_img_results')
     # Timestamp
     timestamp = str(time.ctime(time.time()))
     # Get the filepath and split it
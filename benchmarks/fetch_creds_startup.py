@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+"""startup benchmark for fetch_creds
+
+Times a fresh interpreter importing fetch_creds and reading the AWS keys
+and database variables from a credentials file (run as separate
+processes, so the times include interpreter startup and imports), times
+repeated reads in one process (which are served from the per-path
+cache), and checks that reading credentials doesn't import pandas.
+
+Usage: python benchmarks/fetch_creds_startup.py [-n <runs>]
+           [--max-cold <seconds>]
+
+Exits 1 if pandas is imported or if the median cold time exceeds the
+limit.
+"""
+
+import sys
+import os
+import argparse
+import shutil
+import subprocess
+import tempfile
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+template = os.path.join(root, 'credentials_template.csv')
+
+cold_code = '''
+import sys
+import fetch_creds
+fetch_creds.return_aws_keys(%r)
+fetch_creds.return_rds_vars(%r)
+print 'pandas' in sys.modules
+'''
+
+def time_cold(creds_path, n):
+    """run cold_code n times and return the sorted times and whether
+    pandas was imported"""
+    code = cold_code % (creds_path, creds_path)
+    times = []
+    pandas_imported = False
+    for i in xrange(n):
+        t0 = time.time()
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=root)
+        times.append(time.time() - t0)
+        if output.strip() == 'True':
+            pandas_imported = True
+    times.sort()
+    return (times, pandas_imported)
+
+def time_cached(creds_path, n):
+    """return the mean time of a credentials read after the first"""
+    sys.path.insert(0, root)
+    import fetch_creds
+    fetch_creds.return_rds_vars(creds_path)
+    t0 = time.time()
+    for i in xrange(n):
+        fetch_creds.return_aws_keys(creds_path)
+        fetch_creds.return_rds_vars(creds_path)
+    return (time.time() - t0) / (2 * n)
+
+parser = argparse.ArgumentParser(description='fetch_creds startup benchmark')
+parser.add_argument('-n', type=int, default=10, help='runs of each test')
+parser.add_argument('--max-cold',
+                    type=float,
+                    help='limit for the median cold start time (seconds)')
+args = parser.parse_args()
+
+ok = True
+
+tempdir = tempfile.mkdtemp()
+try:
+    creds_path = os.path.join(tempdir, 'credentials.csv')
+    shutil.copy(template, creds_path)
+
+    (times, pandas_imported) = time_cold(creds_path, args.n)
+    median = times[len(times)//2]
+    print 'cold start     min %.3f s  median %.3f s  max %.3f s' % (times[0],
+                                                                 median,
+                                                                 times[-1])
+    if args.max_cold is not None and median > args.max_cold:
+        print 'cold start: median over the %.3f s limit' % args.max_cold
+        ok = False
+    if pandas_imported:
+        print 'pandas imported when reading credentials'
+        ok = False
+    else:
+        print 'pandas not imported'
+
+    mean = time_cached(creds_path, 1000 * args.n)
+    print 'cached read    mean %.1f us' % (mean * 1e6)
+finally:
+    shutil.rmtree(tempdir)
+
+if not ok:
+    sys.exit(1)
+sys.exit(0)
+
+# eof
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# See file COPYING distributed with ndar_unpack for copyright and license.
+
+"""startup benchmark for ndar_unpack
+
+Times ndar_unpack --version and a check of a small local .nii.gz (run as
+separate processes, so the times include interpreter startup and
+imports), and checks that importing ndar_unpack_lib doesn't import the
+heavy modules (dicom, boto, nibabel, SimpleITK) that only some paths
+need.
+
+Usage: python benchmarks/ndar_unpack_startup.py [-n <runs>]
+           [--max-version <seconds>] [--max-check <seconds>]
+
+Exits 1 if a heavy module is imported at startup or if the median time
+of either run exceeds its limit.
+"""
+
+import sys
+import os
+import argparse
+import gzip
+import shutil
+import struct
+import subprocess
+import tempfile
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ndar_unpack = os.path.join(root, 'ndar_unpack')
+
+heavy_modules = ('dicom', 'boto', 'nibabel', 'SimpleITK', 'numpy')
+
+def write_nifti(fname):
+    """write a 4x4x4 unsigned char NIfTI-1 volume to fname (.nii.gz)"""
+    header = struct.pack('<i', 348)
+    header += '\0' * 36
+    header += struct.pack('<8h', 3, 4, 4, 4, 1, 1, 1, 1)
+    header += '\0' * 14
+    # datatype, bitpix
+    header += struct.pack('<hh', 2, 8)
+    header += '\0' * 2
+    header += struct.pack('<8f', 1, 1, 1, 1, 1, 1, 1, 1)
+    # vox_offset
+    header += struct.pack('<f', 352)
+    header += '\0' * 11
+    # xyzt_units: mm
+    header += struct.pack('<B', 2)
+    header += '\0' * (344 - len(header))
+    header += 'n+1\0'
+    fo = gzip.open(fname, 'wb')
+    fo.write(header + '\0' * 4 + '\1' * 64)
+    fo.close()
+    return
+
+def time_run(args, n):
+    """run args n times and return the sorted times"""
+    times = []
+    dev_null = open(os.devnull, 'w')
+    for i in xrange(n):
+        t0 = time.time()
+        rv = subprocess.call(args, stdout=dev_null, stderr=dev_null)
+        times.append(time.time() - t0)
+        if rv:
+            raise RuntimeError('%s exited with %d' % (' '.join(args), rv))
+    dev_null.close()
+    times.sort()
+    return times
+
+def startup_imports():
+    """return the heavy modules imported by importing ndar_unpack_lib"""
+    code = 'import sys, ndar_unpack_lib; '
+    code += 'print " ".join([ m for m in %r if m in sys.modules ])'
+    code = code % (heavy_modules, )
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+    return output.split()
+
+parser = argparse.ArgumentParser(description='ndar_unpack startup benchmark')
+parser.add_argument('-n', type=int, default=10, help='runs of each test')
+parser.add_argument('--max-version',
+                    type=float,
+                    help='limit for the median --version time (seconds)')
+parser.add_argument('--max-check',
+                    type=float,
+                    help='limit for the median .nii.gz check time (seconds)')
+args = parser.parse_args()
+
+ok = True
+
+imported = startup_imports()
+if imported:
+    print 'heavy modules imported at startup: %s' % ', '.join(imported)
+    ok = False
+else:
+    print 'no heavy modules imported at startup'
+
+tempdir = tempfile.mkdtemp()
+try:
+    nii_gz = os.path.join(tempdir, 'volume.nii.gz')
+    write_nifti(nii_gz)
+    tests = (('--version', [sys.executable, ndar_unpack, '--version'],
+              args.max_version),
+             ('.nii.gz check', [sys.executable, ndar_unpack, nii_gz],
+              args.max_check))
+    for (name, run_args, limit) in tests:
+        times = time_run(run_args, args.n)
+        median = times[len(times)//2]
+        print '%-14s min %.3f s  median %.3f s  max %.3f s' % (name,
+                                                             times[0],
+                                                             median,
+                                                             times[-1])
+        if limit is not None and median > limit:
+            print '%s: median over the %.3f s limit' % (name, limit)
+            ok = False
+finally:
+    shutil.rmtree(tempdir)
+
+if not ok:
+    sys.exit(1)
+sys.exit(0)
+
+# eof
@@ -0,0 +1,182 @@
+# bulk_insert.py
+
+'''
+This module contains functions which insert many rows into a miNDAR
+table at once, sending them in batches with cx_Oracle's executemany
+(array binding) rather than one execute call per row.
+
+Usage:
+    import bulk_insert
+    bulk_insert.insert_rows(cursor, 'derivatives_unormd',
+                            ['id', 'roi', 'value'], rows)
+    bulk_insert.insert_roi_values(cursor, roi_dict, roi_map, fields)
+'''
+
+# Number of rows sent in each executemany call
+default_batch_size = 500
+
+# Columns of the derivatives_unormd ROI entries, in the order of the
+# rows from roi_rows
+roi_columns = ['id', 'atlasname', 'atlasversion', 'roi', 'roidescription',
+               'pipelinename', 'pipelinetype', 'cfgfilelocation',
+               'pipelinetools', 'pipelineversion', 'pipelinedescription',
+               'derivativename', 'measurename', 'datasetid', 'timestamp',
+               'value', 'units', 'guid']
+
+
+# Return the insert statement for a table and its columns
+def insert_statement(table, columns):
+    '''
+    Function to return an insert statement with positional binds for
+    the given columns of a table
+
+    Parameters
+    ----------
+    table : string
+        name of the table to insert into
+    columns : list (str)
+        names of the columns to insert, in row order
+
+    Returns
+    -------
+    cmd : string
+        the insert statement
+    '''
+
+    # Form the bind list
+    binds = ', '.join([':%d' % (i+1) for i in range(len(columns))])
+
+    # Form the statement
+    cmd = 'insert into %s (%s) values (%s)' % (table, ', '.join(columns),
+                                               binds)
+
+    # Return the statement
+    return cmd
+
+
+# Insert rows into a table in batches
+def insert_rows(cursor, table, columns, rows, batch_size=None):
+    '''
+    Function to insert rows into a table; the statement is prepared
+    once and the rows are sent batch_size at a time, so each batch is
+    one round trip to the database
+
+    Parameters
+    ----------
+    cursor : OracleCursor
+        a cx_Oracle cursor object which is used to query and modify an
+        Oracle database
+    table : string
+        name of the table to insert into
+    columns : list (str)
+        names of the columns to insert
+    rows : list (tuple)
+        the rows to insert, each a tuple of values in column order
+    batch_size : integer (optional)
+        the number of rows to send at a time; default_batch_size if not
+        given
+
+    Returns
+    -------
+    num_rows : integer
+        the number of rows inserted
+    '''
+
+    # Init variables
+    if not batch_size:
+        batch_size = default_batch_size
+    num_rows = len(rows)
+
+    # Nothing to do
+    if not num_rows:
+        return 0
+
+    # Prepare the statement once for all of the batches
+    cursor.prepare(insert_statement(table, columns))
+
+    # Send the rows a batch at a time
+    for start in range(0, num_rows, batch_size):
+        cursor.executemany(None, rows[start:start+batch_size])
+
+    # Return the number of rows inserted
+    return num_rows
+
+
+# Build the derivatives_unormd rows for a subject's ROI values
+def roi_rows(deriv_ids, roi_dict, roi_map, fields):
+    '''
+    Function to return a derivatives_unormd row for each of a subject's
+    ROI values
+
+    Parameters
+    ----------
+    deriv_ids : list (int)
+        the primary keys to use, one for each ROI
+    roi_dict : dictionary {str : str}
+        the subject's ROI labels (e.g. 'Mean_1002') and values
+    roi_map : dictionary {str : str}
+        a dictionary containing the mapping between the ROI label (key)
+        and the ROI anatomical label (value) for the atlas
+    fields : dictionary {str : object}
+        the values of the other roi_columns (all but id, roi,
+        roidescription and value), shared by all of the rows
+
+    Returns
+    -------
+    rows : list (tuple)
+        the rows, each a tuple of values in roi_columns order
+    '''
+
+    # Build a row for each ROI value
+    rows = []
+    for deriv_id, (k, v) in zip(deriv_ids, roi_dict.iteritems()):
+        row = dict(fields)
+        # Get ROI number and name from dictionaries
+        row['id'] = deriv_id
+        row['roi'] = k.split('Mean_')[1]
+        row['roidescription'] = roi_map[k]
+        # Get ROI value from dictionary
+        row['value'] = float(v)
+        rows.append(tuple([row[column] for column in roi_columns]))
+
+    # Return the rows
+    return rows
+
+
+# Insert a subject's ROI values into derivatives_unormd
+def insert_roi_values(cursor, roi_dict, roi_map, fields, batch_size=None):
+    '''
+    Function to insert a derivatives_unormd entry for each of a
+    subject's ROI values, with primary keys from id_allocator.py
+
+    Parameters
+    ----------
+    cursor : OracleCursor
+        a cx_Oracle cursor object which is used to query and modify an
+        Oracle database
+    roi_dict : dictionary {str : str}
+        the subject's ROI labels and values; see roi_rows
+    roi_map : dictionary {str : str}
+        the ROI label to anatomical label mapping; see roi_rows
+    fields : dictionary {str : object}
+        the values of the other columns; see roi_rows
+    batch_size : integer (optional)
+        the number of rows to send at a time; see insert_rows
+
+    Returns
+    -------
+    num_rows : integer
+        the number of rows inserted
+    '''
+
+    # Import packages
+    import id_allocator
+
+    # Get a primary key for each entry
+    allocator = id_allocator.get_allocator('derivatives_unormd', 'id')
+    deriv_ids = allocator.take(cursor, len(roi_dict))
+
+    # Build the rows and insert them
+    rows = roi_rows(deriv_ids, roi_dict, roi_map, fields)
+    return insert_rows(cursor, 'derivatives_unormd', roi_columns, rows,
+                       batch_size=batch_size)
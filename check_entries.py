@@ -15,9 +15,8 @@ Usage:
 # Get next primary key id
 def get_next_pk(cursor, table, pk_id):
     '''
-    Method to return the next (highest+1) primary key from a table to
-    use for the next entry. If no entries are found, the method will
-    return 1.
+    Method to return the next primary key from a table to use for the
+    next entry; delegates to id_allocator.next_pk.
 
     Parameters
     ----------
@@ -25,7 +24,7 @@ def get_next_pk(cursor, table, pk_id):
         a cx_Oracle cursor object which is used to query and modify an
         Oracle database
     table : string
-        name of the table to query
+        name of the table to insert into
     pk_id : string
         field name of the column that contains the primary keys
 
@@ -35,22 +34,11 @@ def get_next_pk(cursor, table, pk_id):
         the next primary key to use for that table
     '''
 
-    # Init variables
-    cmd = 'select max(%s) from %s' %(pk_id, table)
-
-    # Query database and get results
-    cursor.execute(cmd)
-    res = cursor.fetchall()[0][0]
-
-    # If it has a value, increment and return
-    if res:
-        pk_id = int(res) + 1
-    # Otherwise, consider this the first entry, return 1
-    else:
-        pk_id = 1
+    # Import packages
+    import id_allocator
 
     # Return the primary key
-    return pk_id
+    return id_allocator.next_pk(cursor, table, pk_id)
 
 
 # Get ROI txt file from S3 bucket and return as dict object
@@ -100,7 +88,7 @@ def get_roi_dict(creds_path, bucket_name, datasetid):
 
 # Function to load the ROIS to the unorm'd database
 def insert_unormd(cursor, img03_id_str, table_name,
-                  s3_path=None, roi_map=None, roi_dict=None):
+                  s3_path=None, roi_map=None, roi_dict=None, batch_size=None):
     '''
     Method to return the next (highest+1) primary key from a table to
     use for the next entry. If no entries are found, the method will
@@ -123,7 +111,11 @@ def insert_unormd(cursor, img03_id_str, table_name,
     roi_dict : dictionary {str : str} (optional)
         a dictionary of the subject's ROI labels and values; this
         parameter is only necessary when inserting ROI entries. If this
-        is not set, the function will only insert a single entry
+        is not set, the function will only insert a single entry. The
+        ROI entries are inserted together with one executemany call per
+        batch_size rows
+    batch_size : integer (optional)
+        number of ROI entries to send at a time; see bulk_insert.py
 
     Returns
     -------
@@ -133,6 +125,7 @@ def insert_unormd(cursor, img03_id_str, table_name,
     '''
     
     # Import packages
+    import bulk_insert
     import time
 
     # Init variables
@@ -156,54 +149,24 @@ def insert_unormd(cursor, img03_id_str, table_name,
     # If roi dictionary is passed in, insert ROI means 
     if roi_dict:
         deriv_name = 'cortical thickness'
-        # Get next deriv_id here
-        deriv_id = get_next_pk(cursor, 'derivatives_unormd','id') 
-        # Command string
-        cmd = '''
-              insert into %s
-              (id, atlasname, atlasversion, roi, roidescription, 
-               pipelinename, pipelinetype, cfgfilelocation, pipelinetools, 
-               pipelineversion, pipelinedescription, derivativename, measurename, 
-               datasetid, timestamp, value, units, guid)
-              values
-              (:col_1, :col_2, :col_3, :col_4, :col_5, :col_6, :col_7, :col_8, :col_9, 
-               :col_10, :col_11, :col_12, :col_13, :col_14, :col_15, :col_16, 
-               :col_17, :col_18)
-              '''
         pipeline_desc = 'compute the mean thickness of cortex in ROI'
         measure_name = 'mean'
         units = 'mm'
-        # Iterate through ROI dictionary to upload all ROI values
-        for k,v in roi_dict.iteritems():
-            # Timestamp
-            timestamp = str(time.ctime(time.time()))
-            # Get ROI number and name from dictionaries
-            roi = k.split('Mean_')[1]
-            roi_name = roi_map[k]
-            # Get ROI value from dictionary
-            value = float(v)
-            # Execute insert command
-            cursor.execute(cmd % 'derivatives_unormd',
-                           col_1 = deriv_id,
-                           col_2 = atlas_name,
-                           col_3 = atlas_ver,
-                           col_4 = roi,
-                           col_5 = roi_name,
-                           col_6 = pipeline_name,
-                           col_7 = pipeline_type,
-                           col_8 = cfg_file_loc,
-                           col_9 = pipeline_tools,
-                           col_10 = pipeline_ver,
-                           col_11 = pipeline_desc,
-                           col_12 = deriv_name,
-                           col_13 = measure_name,
-                           col_14 = img03_id,
-                           col_15 = timestamp,
-                           col_16 = value,
-                           col_17 = units,
-                           col_18 = guid)
-            # ...and increment the primary key
-            deriv_id +=1
+        # Values shared by all of the subject's entries
+        fields = {'atlasname' : atlas_name, 'atlasversion' : atlas_ver,
+                  'pipelinename' : pipeline_name,
+                  'pipelinetype' : pipeline_type,
+                  'cfgfilelocation' : cfg_file_loc,
+                  'pipelinetools' : pipeline_tools,
+                  'pipelineversion' : pipeline_ver,
+                  'pipelinedescription' : pipeline_desc,
+                  'derivativename' : deriv_name, 'measurename' : measure_name,
+                  'datasetid' : img03_id,
+                  'timestamp' : str(time.ctime(time.time())),
+                  'units' : units, 'guid' : guid}
+        # Insert an entry for each ROI value
+        bulk_insert.insert_roi_values(cursor, roi_dict, roi_map, fields,
+                                      batch_size=batch_size)
 
     # Otherwise, inserting nifti file derivative
     elif s3_path:
@@ -247,8 +210,6 @@ def insert_unormd(cursor, img03_id_str, table_name,
                        col_14 = guid,
                        col_15 = img03_id,
                        col_16 = roi_desc)
-        # ...and increment the primary key
-        deriv_id +=1
     # and commit changes
     cursor.execute('commit')
 
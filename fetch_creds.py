@@ -5,8 +5,148 @@
 '''
 This module contains functions which return sensitive information from 
 a csv file, with regards to connection to AWS services.
+
+Credentials files are read with the csv module (not pandas, which takes
+seconds to import) once per path per process, and any field can be
+given, or overridden, by an environment variable (see return_creds).
+
+Database connections come from a process-wide cx_Oracle session pool
+for each credentials file (see return_pool), so a script pays for
+session setup once per pooled session rather than on every
+return_cursor call. Each cursor still has a connection, and so a
+transaction, of its own. S3 buckets are likewise kept for reuse (see
+return_bucket).
 '''
 
+# Import packages
+import threading
+
+# Environment variables are checked for each credentials field under
+# these names (e.g. NDAR_DB_PASSWD), and the AWS keys under the standard
+# AWS names too
+env_prefix = 'NDAR_'
+aws_env_names = {'ACCESS_KEY_ID' : 'AWS_ACCESS_KEY_ID',
+                 'SECRET_ACCESS_KEY' : 'AWS_SECRET_ACCESS_KEY'}
+# Fields (as in credentials_template.csv) that environment variables can
+# give even if the credentials file doesn't have them
+creds_fields = ['USER_NAME', 'ACCESS_KEY_ID', 'SECRET_ACCESS_KEY',
+                'DB_USER', 'DB_PASSWD', 'DB_HOST', 'DB_PORT', 'DB_SID']
+
+# Session pool settings (see return_pool); pool_max sessions are kept
+# open, and more are opened (and closed when released) while more
+# connections than that are in use
+pool_min = 1
+pool_max = 4
+pool_increment = 1
+# Number of prepared statements each pooled connection keeps
+stmt_cache_size = 50
+# Number of rows a cursor from return_cursor fetches per round trip
+cursor_arraysize = 500
+
+# Parsed credentials files, keyed by path
+_creds = {}
+
+# Process-wide pools and buckets, keyed by the credentials file path
+# (and bucket name)
+_pools = {}
+_buckets = {}
+# Lock for creating and replacing the pools
+_pools_lock = threading.Lock()
+
+# Function to return the cache key for a credentials file
+def _creds_key(creds_path):
+    '''
+    Method to return the key that the pools and buckets of this module
+    are kept under for a credentials file (None for the environment
+    variables alone)
+    '''
+
+    # Import packages
+    import os
+
+    # Return the absolute path
+    if creds_path:
+        return os.path.abspath(creds_path)
+    else:
+        return None
+
+
+# Function to return the fields of a credentials file
+def return_creds(creds_path):
+    '''
+    Method to return the credentials fields of a local csv file (e.g.
+    credentials_template.csv). A field FIELD, if it's in the file or in
+    creds_fields, is taken from env_prefix + FIELD (e.g. NDAR_DB_PASSWD)
+    if that's set, in place of the file's value; failing both, the AWS
+    keys are taken from AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY,
+    which often hold some other account's keys and so never override
+    the file. The file is only read the first time its path is given.
+
+    Parameters
+    ----------
+    creds_path : string (filepath)
+        path to the csv file with the field names as the header and the
+        corresponding ASCII text for each underneath; may be None to
+        use the environment variables alone
+
+    Returns
+    -------
+    creds : dictionary
+        dictionary of the field names and values
+    '''
+
+    # Import packages
+    import csv
+    import os
+
+    # Read in the csv file on first use
+    creds_key = _creds_key(creds_path)
+    if creds_key:
+        if creds_key not in _creds:
+            with open(creds_path, 'rb') as csv_file:
+                reader = csv.reader(csv_file)
+                try:
+                    header = [field.strip() for field in reader.next()]
+                    values = [value.strip() for value in reader.next()]
+                except StopIteration:
+                    err_msg = 'Credentials file %s needs a header row ' \
+                              'and a row of values' % creds_path
+                    raise ValueError(err_msg)
+            _creds[creds_key] = dict(zip(header, values))
+        creds = dict(_creds[creds_key])
+    else:
+        creds = {}
+
+    # Our environment variables take precedence over the file
+    for field in set(creds_fields).union(creds):
+        if env_prefix + field in os.environ:
+            creds[field] = os.environ[env_prefix + field]
+    # The generic AWS ones only fill in keys the file doesn't have
+    for field, env_name in aws_env_names.items():
+        if not creds.get(field) and env_name in os.environ:
+            creds[field] = os.environ[env_name]
+
+    # Return the credentials
+    return creds
+
+
+# Function to return a credentials field
+def _return_field(creds, field, creds_path):
+    '''
+    Method to return a field from return_creds output, raising a
+    KeyError naming the field and file if it's missing
+    '''
+
+    # Get the field
+    try:
+        return creds[field]
+    except KeyError:
+        err_msg = 'No %s in $%s%s' % (field, env_prefix, field)
+        if creds_path:
+            err_msg += ' or in %s' % creds_path
+        raise KeyError(err_msg)
+
+
 # Function to return AWS secure environment variables
 def return_aws_keys(creds_path):
     '''
@@ -27,15 +167,13 @@ def return_aws_keys(creds_path):
         string of the AWS secret access key
     '''
 
-    # Import packages
-    import pandas
-
-    # Read in csv file as dataframe
-    df = pandas.read_csv(creds_path)
+    # Init variables
+    creds = return_creds(creds_path)
 
     # Get AWS keys
-    aws_access_key_id = df['ACCESS_KEY_ID'][0]
-    aws_secret_access_key = df['SECRET_ACCESS_KEY'][0]
+    aws_access_key_id = _return_field(creds, 'ACCESS_KEY_ID', creds_path)
+    aws_secret_access_key = _return_field(creds, 'SECRET_ACCESS_KEY',
+                                          creds_path)
 
     # Return keys
     return aws_access_key_id,\
@@ -62,24 +200,21 @@ def return_rds_vars(creds_path):
         string of the password for the database connection
     db_host : string
         string of the host for the database connection
-    db_port : string
-        string of the port for the database connection
+    db_port : integer
+        the port for the database connection
     db_sid : string
         string of the SID for the database connection
     '''
 
-    # Import packages
-    import pandas
-
-    # Read in csv file as dataframe
-    df = pandas.read_csv(creds_path)
+    # Init variables
+    creds = return_creds(creds_path)
 
     # Get database credentials
-    db_user = df['DB_USER'][0]
-    db_passwd = df['DB_PASSWD'][0]
-    db_host = df['DB_HOST'][0]
-    db_port = df['DB_PORT'][0]
-    db_sid = df['DB_SID'][0]
+    db_user = _return_field(creds, 'DB_USER', creds_path)
+    db_passwd = _return_field(creds, 'DB_PASSWD', creds_path)
+    db_host = _return_field(creds, 'DB_HOST', creds_path)
+    db_port = int(_return_field(creds, 'DB_PORT', creds_path))
+    db_sid = _return_field(creds, 'DB_SID', creds_path)
 
     # Return the DB variables
     return db_user,\
@@ -108,13 +243,19 @@ def return_bucket(creds_path, bucket_name):
     -------
     bucket : boto.s3.bucket.Bucket
         a boto s3 Bucket object which is used to interact with files
-        in an S3 bucket on AWS
+        in an S3 bucket on AWS; it is kept and returned again for the
+        same credentials and bucket name
     '''
 
     # Import packages
     import boto
     import boto.s3.connection
 
+    # Reuse the bucket if it was already fetched
+    bucket_key = (_creds_key(creds_path), bucket_name)
+    if bucket_key in _buckets:
+        return _buckets[bucket_key]
+
     # Get AWS credentials
     aws_access_key_id, aws_secret_access_key = return_aws_keys(creds_path)
 
@@ -124,16 +265,149 @@ def return_bucket(creds_path, bucket_name):
                               calling_format=cf)
     # And fetch the bucket with the name argument
     bucket = s3_conn.get_bucket(bucket_name)
+    _buckets[bucket_key] = bucket
 
     # Return bucket
     return bucket
 
 
+# Function to return the session pool for a database
+def return_pool(creds_path):
+    '''
+    Method to return the process-wide cx_Oracle session pool for the
+    database instance named by the credentials found in a local file;
+    the pool is created on first use with the pool_min, pool_max and
+    pool_increment settings of this module
+
+    Parameters
+    ----------
+    creds_path : string (filepath)
+        path to the csv file with 'DB_USER' as the header and the
+        corresponding ASCII text for the user name underneath; same
+        'DB_PASSWD', 'DB_HOST', 'DB_PORT', and 'DB_SID'headers and text
+
+    Returns
+    -------
+    pool : cx_Oracle.SessionPool
+        the session pool to acquire connections from
+    '''
+
+    # Import packages
+    import cx_Oracle
+
+    # Init variables
+    pool_key = _creds_key(creds_path)
+
+    # Create the pool on first use (once, even with several threads);
+    # past pool_max sessions, open more rather than failing (or waiting,
+    # where cx_Oracle can't force)
+    with _pools_lock:
+        if pool_key not in _pools:
+            user, passwd, host, port, sid = return_rds_vars(creds_path)
+            dsn = cx_Oracle.makedsn(host, port, sid)
+            getmode = getattr(cx_Oracle, 'SPOOL_ATTRVAL_FORCEGET',
+                              cx_Oracle.SPOOL_ATTRVAL_WAIT)
+            _pools[pool_key] = cx_Oracle.SessionPool(user, passwd, dsn,
+                                                     pool_min, pool_max,
+                                                     pool_increment,
+                                                     threaded=True,
+                                                     getmode=getmode)
+
+        # Return the pool
+        return _pools[pool_key]
+
+
+# Function to check a connection
+def check_connection(conn):
+    '''
+    Method to check that a database connection is still usable
+
+    Parameters
+    ----------
+    conn : cx_Oracle.Connection
+        the connection to check
+
+    Returns
+    -------
+    ok : boolean
+        True if the database answered, False otherwise
+    '''
+
+    # Import packages
+    import cx_Oracle
+
+    # Ping the database (or run a trivial query where ping isn't there)
+    try:
+        if hasattr(conn, 'ping'):
+            conn.ping()
+        else:
+            cursor = conn.cursor()
+            cursor.execute('select 1 from dual')
+            cursor.fetchall()
+            cursor.close()
+        ok = True
+    except cx_Oracle.Error:
+        ok = False
+
+    # Return the status
+    return ok
+
+
+# Function to acquire a connection from the pool
+def _acquire_connection(creds_path):
+    '''
+    Method to acquire a checked connection from the session pool for the
+    database in the credentials file; dead connections are dropped from
+    the pool and replaced from it, and if the pool itself fails (e.g.
+    after the database instance restarts) it is rebuilt. The connection
+    goes back to its pool once it's no longer referenced.
+    '''
+
+    # Import packages
+    import cx_Oracle
+
+    # Init variables
+    pool_key = _creds_key(creds_path)
+    pool = return_pool(creds_path)
+    drops = 0
+
+    # Take connections from the pool until one works
+    while True:
+        try:
+            conn = pool.acquire()
+        except cx_Oracle.Error:
+            # The pool itself is broken: replace it (unless another
+            # thread already has) and try once more from the new one
+            with _pools_lock:
+                if _pools.get(pool_key) is pool:
+                    del _pools[pool_key]
+            pool = return_pool(creds_path)
+            conn = pool.acquire()
+        if check_connection(conn):
+            conn.stmtcachesize = stmt_cache_size
+            return conn
+        # Drop a dead connection, and give up if they're all dead
+        try:
+            pool.drop(conn)
+        except cx_Oracle.Error:
+            pass
+        drops += 1
+        if drops > pool_max:
+            raise cx_Oracle.DatabaseError('could not get a working '
+                                          'connection')
+
+
 # Function to return a RDS cursor
 def return_cursor(creds_path):
     '''
     Method to return an Oracle DB cursor which is connected to database
-    instance using credentials found in a local file.
+    instance using credentials found in a local file. The cursor is on a
+    connection of its own, acquired from the session pool (see
+    _acquire_connection), so repeated calls don't set up new sessions,
+    but commits and rollbacks through one cursor don't affect another's
+    work. The connection goes back to the pool, rolling back any
+    uncommitted work as closing it would, once the cursor is no longer
+    referenced. The cursor fetches cursor_arraysize rows per round trip.
 
     Parameters
     ----------
@@ -149,15 +423,13 @@ def return_cursor(creds_path):
         Oracle database
     '''
 
-    # Import packages
-    import cx_Oracle
-
-    # Get DB connection variables
-    user, passwd, host, port, sid = return_rds_vars(creds_path)
-    # Setup connection and cursor
-    dsn = cx_Oracle.makedsn(host, port, sid)
-    conn = cx_Oracle.connect(user, passwd, dsn)
+    # Get a pooled connection and a cursor on it
+    conn = _acquire_connection(creds_path)
     cursor = conn.cursor()
+    cursor.arraysize = cursor_arraysize
+    # Prefetch as many rows as we fetch, where cx_Oracle supports it
+    if hasattr(cursor, 'prefetchrows'):
+        cursor.prefetchrows = cursor_arraysize + 1
 
     # Return cursor
     return cursor
@@ -0,0 +1,419 @@
+# id_allocator.py
+
+'''
+This module contains classes and functions which hand out primary keys
+for miNDAR tables without querying the tables themselves.
+
+Keys are reserved in blocks from a sequence, an Oracle sequence whose
+increment is the block size (or a locked local file standing in for
+one), and then served from memory. Every writer that uses this module
+draws keys from the same sequence, so concurrent writers (e.g. SGE
+tasks) never hand out the same key, and no table is scanned for its
+highest key except once, to start a new sequence.
+
+The sequences and allocators keep no cursor; each call takes the
+caller's, so an allocator outlives the cursors it's used with.
+
+Usage:
+    import id_allocator
+    deriv_id = id_allocator.next_pk(cursor, 'derivatives_unormd', 'id')
+'''
+
+# Number of keys reserved from a sequence at a time
+default_block_size = 100
+
+# Allocators of this process, keyed by (table, primary key field)
+_allocators = {}
+
+
+# Return the name of the sequence for a table's primary keys
+def sequence_name(table, pk_id):
+    '''
+    Function to return the name of the sequence that backs the primary
+    keys of a table; Oracle names are at most 30 characters long
+
+    Parameters
+    ----------
+    table : string
+        name of the table
+    pk_id : string
+        field name of the column that contains the primary keys
+
+    Returns
+    -------
+    seq_name : string
+        the name of the sequence
+    '''
+
+    # Form the name and truncate it
+    seq_name = ('%s_%s_seq' % (table, pk_id)).upper()[:30]
+
+    # Return the sequence name
+    return seq_name
+
+
+# Return the first key to start a sequence for a table with
+def first_key(cursor, table, pk_id):
+    '''
+    Function to return the key after the highest one in a table, where
+    a new sequence for the table starts; this is the only time the table
+    is scanned
+
+    Parameters
+    ----------
+    cursor : OracleCursor
+        a cx_Oracle cursor object which is used to query and modify an
+        Oracle database
+    table : string
+        name of the table
+    pk_id : string
+        field name of the column that contains the primary keys
+
+    Returns
+    -------
+    start : integer
+        the first key for the sequence
+    '''
+
+    # Find the highest key
+    cursor.execute('select max(%s) from %s' % (pk_id, table))
+    res = cursor.fetchall()[0][0]
+
+    # Return the key after it
+    if res:
+        return int(res) + 1
+    else:
+        return 1
+
+
+# Oracle sequence that reserves blocks of keys
+class OracleSequence(object):
+    '''
+    Class for an Oracle sequence that increments by the block size, so
+    each nextval reserves the block of keys starting at the value
+    returned. The sequence is looked up, and created if it doesn't
+    exist, on the first next_block() call.
+
+    The sequence is created in an autonomous transaction, since create
+    sequence (like all DDL) commits the open transaction; the caller's
+    uncommitted work is left as it was.
+
+    Parameters
+    ----------
+    table : string
+        name of the table the keys are for
+    pk_id : string
+        field name of the column that contains the primary keys
+    block_size : integer
+        the increment to create the sequence with, if it doesn't exist;
+        an existing sequence keeps its own increment
+
+    Attributes
+    ----------
+    name : string
+        the name of the sequence
+    block_size : integer
+        the number of keys reserved by each next_block() call (None
+        until the first call)
+    '''
+
+    def __init__(self, table, pk_id, block_size=default_block_size):
+
+        # Init variables
+        self.table = table
+        self.pk_id = pk_id
+        self.name = sequence_name(table, pk_id)
+        self.new_block_size = block_size
+        self.block_size = None
+
+    def _increment(self, cursor):
+        '''
+        Method to return the increment of the sequence, or None if it
+        doesn't exist
+        '''
+
+        # Query the data dictionary for the sequence
+        cmd = '''
+              select increment_by from user_sequences
+              where sequence_name = :arg_1
+              '''
+        cursor.execute(cmd, arg_1=self.name)
+        res = cursor.fetchall()
+
+        # Return the increment, if found
+        if res:
+            return int(res[0][0])
+        else:
+            return None
+
+    def _create(self, cursor):
+        '''
+        Method to create the sequence, starting after the highest key in
+        the table, without committing the caller's transaction
+        '''
+
+        # Create the sequence; another writer may have just created it
+        start = first_key(cursor, self.table, self.pk_id)
+        ddl = 'create sequence %s start with %d increment by %d' \
+              % (self.name, start, self.new_block_size)
+        cmd = '''
+              declare
+                  pragma autonomous_transaction;
+              begin
+                  execute immediate '%s';
+              end;
+              ''' % ddl
+        try:
+            cursor.execute(cmd)
+        except Exception as exc:
+            if self._increment(cursor) is None:
+                raise exc
+
+    def next_block(self, cursor):
+        '''
+        Method to reserve the next block of keys from the sequence
+
+        Parameters
+        ----------
+        cursor : OracleCursor
+            a cx_Oracle cursor object which is used to query and modify
+            an Oracle database
+
+        Returns
+        -------
+        start : integer
+            the first key of the block; the block holds the keys from
+            start to start + block_size - 1
+        '''
+
+        # Look up (or create) the sequence on first use
+        if self.block_size is None:
+            increment = self._increment(cursor)
+            if increment is None:
+                self._create(cursor)
+                increment = self._increment(cursor)
+            self.block_size = increment
+
+        # Get the next value of the sequence
+        cursor.execute('select %s.nextval from dual' % self.name)
+        start = int(cursor.fetchall()[0][0])
+
+        # Return the start of the block
+        return start
+
+
+# Local file standing in for an Oracle sequence
+class FileSequence(object):
+    '''
+    Class for a local stand-in for an OracleSequence; the next value is
+    kept in a file which is locked while it's updated. The lock is only
+    reliable on a local filesystem, so a file sequence is only safe for
+    writers on one host; writers on several hosts (e.g. SGE tasks on a
+    cluster) must use an OracleSequence.
+
+    Parameters
+    ----------
+    fname : string (filepath)
+        path to the file holding the next value; it is created on the
+        first next_block() call, starting after the highest key in the
+        table
+    table : string
+        name of the table the keys are for
+    pk_id : string
+        field name of the column that contains the primary keys
+    block_size : integer
+        the number of keys reserved by each next_block() call
+    '''
+
+    def __init__(self, fname, table, pk_id, block_size=default_block_size):
+
+        # Init variables
+        self.fname = fname
+        self.table = table
+        self.pk_id = pk_id
+        self.block_size = block_size
+
+    def next_block(self, cursor):
+        '''
+        Method to reserve the next block of keys from the file
+
+        Parameters
+        ----------
+        cursor : OracleCursor
+            a cx_Oracle cursor object which is used to query and modify
+            an Oracle database; it is only used to start a new file
+
+        Returns
+        -------
+        start : integer
+            the first key of the block
+        '''
+
+        # Import packages
+        import fcntl
+        import os
+
+        # Open (creating if need be) and lock the file
+        fd = os.open(self.fname, os.O_RDWR | os.O_CREAT, 0644)
+        fo = os.fdopen(fd, 'r+')
+        try:
+            fcntl.flock(fo, fcntl.LOCK_EX)
+            # Read the next value, then store the one after this block
+            contents = fo.read().strip()
+            if contents:
+                start = int(contents)
+            else:
+                start = first_key(cursor, self.table, self.pk_id)
+            fo.seek(0)
+            fo.truncate()
+            fo.write('%d\n' % (start + self.block_size))
+            fo.flush()
+            os.fsync(fo.fileno())
+        finally:
+            fo.close()
+
+        # Return the start of the block
+        return start
+
+
+# Serve keys from the blocks of a sequence
+class IdAllocator(object):
+    '''
+    Class which serves keys from memory, reserving a new block from its
+    sequence when the current block runs out
+
+    Parameters
+    ----------
+    sequence : OracleSequence or FileSequence
+        the sequence to reserve blocks of keys from
+    '''
+
+    def __init__(self, sequence):
+
+        # Init variables
+        self.sequence = sequence
+        self.next_id = None
+        self.end_id = None
+
+    def next(self, cursor):
+        '''
+        Method to return the next key
+
+        Parameters
+        ----------
+        cursor : OracleCursor
+            a cx_Oracle cursor object which is used to query and modify
+            an Oracle database, if a new block has to be reserved
+
+        Returns
+        -------
+        pk_id : integer
+            a key no other user of the sequence will be given
+        '''
+
+        # Reserve a new block if this one is used up
+        if self.next_id is None or self.next_id >= self.end_id:
+            self.next_id = self.sequence.next_block(cursor)
+            self.end_id = self.next_id + self.sequence.block_size
+
+        # Hand out the key
+        pk_id = self.next_id
+        self.next_id += 1
+
+        # Return the key
+        return pk_id
+
+    def take(self, cursor, num_ids):
+        '''
+        Method to return a number of keys; they are unique but not
+        necessarily consecutive
+
+        Parameters
+        ----------
+        cursor : OracleCursor
+            a cx_Oracle cursor object which is used to query and modify
+            an Oracle database, if new blocks have to be reserved
+        num_ids : integer
+            the number of keys to return
+
+        Returns
+        -------
+        pk_ids : list (int)
+            the keys
+        '''
+
+        # Return the keys
+        return [self.next(cursor) for i in range(num_ids)]
+
+
+# Return this process's allocator for a table
+def get_allocator(table, pk_id='id', block_size=default_block_size,
+                  local_dir=None):
+    '''
+    Function to return the allocator for a table's primary keys, which
+    is created on first use and kept for the life of the process; pass
+    your cursor to its next() and take() methods
+
+    Parameters
+    ----------
+    table : string
+        name of the table
+    pk_id : string
+        field name of the column that contains the primary keys
+    block_size : integer
+        the number of keys to reserve at a time, for a new sequence
+    local_dir : string (filepath) (optional)
+        a directory to keep FileSequence files in instead of using
+        Oracle sequences; the NDAR_ID_DIR environment variable sets
+        this too. Only for writers on one host (see FileSequence).
+
+    Returns
+    -------
+    allocator : IdAllocator
+        the allocator for the table
+    '''
+
+    # Import packages
+    import os
+
+    # Init variables
+    key = (table.lower(), pk_id.lower())
+    if local_dir is None:
+        local_dir = os.environ.get('NDAR_ID_DIR')
+
+    # Create the allocator on first use
+    if key not in _allocators:
+        if local_dir:
+            fname = os.path.join(local_dir, sequence_name(table, pk_id))
+            sequence = FileSequence(fname, table, pk_id, block_size)
+        else:
+            sequence = OracleSequence(table, pk_id, block_size)
+        _allocators[key] = IdAllocator(sequence)
+
+    # Return the allocator
+    return _allocators[key]
+
+
+# Return the next primary key for a table
+def next_pk(cursor, table, pk_id='id'):
+    '''
+    Function to return the next primary key to use for a table
+
+    Parameters
+    ----------
+    cursor : OracleCursor
+        a cx_Oracle cursor object which is used to query and modify an
+        Oracle database
+    table : string
+        name of the table
+    pk_id : string
+        field name of the column that contains the primary keys
+
+    Returns
+    -------
+    pk_id : integer
+        the next primary key to use for that table
+    '''
+
+    # Return the next key from the table's allocator
+    return get_allocator(table, pk_id).next(cursor)
@@ -223,9 +223,8 @@ def create_workflow(base_path, img03_id_str, input_skull, oasis_path):
 # Get next primary key id
 def get_next_pk(cursor, table, pk_id):
     '''
-    Method to return the next (highest+1) primary key from a table to
-    use for the next entry. If no entries are found, the method will
-    return 1.
+    Method to return the next primary key from a table to use for the
+    next entry; delegates to id_allocator.next_pk.
 
     Parameters
     ----------
@@ -233,7 +232,7 @@ def get_next_pk(cursor, table, pk_id):
         a cx_Oracle cursor object which is used to query and modify an
         Oracle database
     table : string
-        name of the table to query
+        name of the table to insert into
     pk_id : string
         field name of the column that contains the primary keys
 
@@ -243,26 +242,16 @@ def get_next_pk(cursor, table, pk_id):
         the next primary key to use for that table
     '''
 
-    # Init variables
-    cmd = 'select max(%s) from %s' %(pk_id, table)
-
-    # Query database and get results
-    cursor.execute(cmd)
-    res = cursor.fetchall()[0][0]
-
-    # If it has a value, increment and return
-    if res:
-        pk_id = int(res) + 1
-    # Otherwise, consider this the first entry, return 1
-    else:
-        pk_id = 1
+    # Import packages
+    import id_allocator
 
     # Return the primary key
-    return pk_id
+    return id_allocator.next_pk(cursor, table, pk_id)
 
 
 # Function to load the ROIS to the unorm'd database
-def insert_unormd(cursor, img03_id_str, roi_dic=None, s3_path=None):
+def insert_unormd(cursor, img03_id_str, roi_dic=None, s3_path=None,
+                  batch_size=None):
     '''
     Method to return the next (highest+1) primary key from a table to
     use for the next entry. If no entries are found, the method will
@@ -275,8 +264,13 @@ def insert_unormd(cursor, img03_id_str, roi_dic=None, s3_path=None):
         Oracle database
     img03_id_str : string
         string of the image03_id of the input subject to process
-    pk_id : string
-        field name of the column that contains the primary keys
+    roi_dic : dictionary {str : float} (optional)
+        the subject's ROI labels and values; the ROI entries are
+        inserted together with one executemany call per batch_size rows
+    s3_path : string (optional)
+        S3 file path location of the normalized image on AWS
+    batch_size : integer (optional)
+        number of ROI entries to send at a time; see bulk_insert.py
 
     Returns
     -------
@@ -285,6 +279,7 @@ def insert_unormd(cursor, img03_id_str, roi_dic=None, s3_path=None):
         the un-normalized database tables
     '''
     # Import packages
+    import bulk_insert
     import time
     oasis_path = '/data/OASIS-30_Atropos_template/'
     oasis_roi_yaml = oasis_path + 'oasis_roi_map.yml'
@@ -311,54 +306,24 @@ def insert_unormd(cursor, img03_id_str, roi_dic=None, s3_path=None):
     # If roi dictionary is passed in, insert ROI means 
     if roi_dic:
         deriv_name = 'cortical thickness'
-        # Get next deriv_id here
-        deriv_id = get_next_pk(cursor, 'derivatives_unormd','id') 
-        # Command string
-        cmd = '''
-              insert into %s
-              (id, atlasname, atlasversion, roi, roidescription, 
-               pipelinename, pipelinetype, cfgfilelocation, pipelinetools, 
-               pipelineversion, pipelinedescription, derivativename, measurename, 
-               datasetid, timestamp, value, units, guid)
-              values
-              (:col_1, :col_2, :col_3, :col_4, :col_5, :col_6, :col_7, :col_8, :col_9, 
-               :col_10, :col_11, :col_12, :col_13, :col_14, :col_15, :col_16, 
-               :col_17, :col_18)
-              '''
         pipeline_desc = 'compute the mean thickness of cortex in ROI'
         measure_name = 'mean'
         units = 'mm'
-        # Iterate through ROI dictionary to upload all ROI values
-        for k,v in roi_dic.iteritems():
-            # Timestamp
-            timestamp = str(time.ctime(time.time()))
-            # Get ROI number and name from dictionaries
-            roi = k.split('Mean_')[1]
-            roi_name = oasis_roi_map[k]
-            # Get ROI value from dictionary
-            value = float(v)
-            # Execute insert command
-            cursor.execute(cmd % 'derivatives_unormd',
-                           col_1 = deriv_id,
-                           col_2 = atlas_name,
-                           col_3 = atlas_ver,
-                           col_4 = roi,
-                           col_5 = roi_name,
-                           col_6 = pipeline_name,
-                           col_7 = pipeline_type,
-                           col_8 = cfg_file_loc,
-                           col_9 = pipeline_tools,
-                           col_10 = pipeline_ver,
-                           col_11 = pipeline_desc,
-                           col_12 = deriv_name,
-                           col_13 = measure_name,
-                           col_14 = img03_id,
-                           col_15 = timestamp,
-                           col_16 = value,
-                           col_17 = units,
-                           col_18 = guid)
-            # ...and increment the primary key
-            deriv_id +=1
+        # Values shared by all of the subject's entries
+        fields = {'atlasname' : atlas_name, 'atlasversion' : atlas_ver,
+                  'pipelinename' : pipeline_name,
+                  'pipelinetype' : pipeline_type,
+                  'cfgfilelocation' : cfg_file_loc,
+                  'pipelinetools' : pipeline_tools,
+                  'pipelineversion' : pipeline_ver,
+                  'pipelinedescription' : pipeline_desc,
+                  'derivativename' : deriv_name, 'measurename' : measure_name,
+                  'datasetid' : img03_id,
+                  'timestamp' : str(time.ctime(time.time())),
+                  'units' : units, 'guid' : guid}
+        # Insert an entry for each ROI value
+        bulk_insert.insert_roi_values(cursor, roi_dic, oasis_roi_map, fields,
+                                      batch_size=batch_size)
 
     # Otherwise, inserting nifti file derivative
     if s3_path:
@@ -403,8 +368,6 @@ def insert_unormd(cursor, img03_id_str, roi_dic=None, s3_path=None):
                        col_14 = guid,
                        col_15 = img03_id,
                        col_16 = roi_desc)
-        # ...and increment the primary key
-        deriv_id +=1
     # and commit changes
     cursor.execute('commit')
 
@@ -506,6 +469,7 @@ def main(sub_list, sub_idx):
     import cx_Oracle
     import fetch_creds
     import logging
+    import ndar_unpack_lib
     from nipype import logging as np_logging
     from nipype import config
     import os
@@ -575,18 +539,14 @@ def main(sub_list, sub_idx):
     # --- Download and extract data from NDAR_Central S3 bucket ---
     nifti_file = base_path + 'inputs-ef/' + img03_id_str + '.nii.gz'
     # Execute ndar_unpack for that subject
-    cmd = './ndar_unpack'
     if not os.path.exists(nifti_file):
-        cmd_list = [cmd, '--aws-access-key-id', aws_access_key_id, 
-                    '--aws-secret-access-key', aws_secret_access_key, 
-                    '-v', nifti_file, s3_path]
-        cmd_str = ' '.join(cmd_list)
-        ndar_log.info('Executing command: %s ' % cmd_str)
-        p = subprocess.Popen(cmd_list, stdout=subprocess.PIPE, 
-                             stderr=subprocess.STDOUT)
-        p.wait()
-        stdout, stderr = p.communicate()
-        ndar_log.info(stdout)
+        ndar_log.info('Running ndar_unpack on %s to %s' % (s3_path, nifti_file))
+        result = ndar_unpack_lib.unpack(s3_path, volume=nifti_file,
+                                        aws_access_key_id=aws_access_key_id,
+                                        aws_secret_access_key=aws_secret_access_key)
+        ndar_log.info('ndar_unpack exit value: %d' % result.exit_value)
+        if result.error:
+            ndar_log.info(result.error)
     else:
         ndar_log.info('Nifti file already present for IMAGE03 ID %s' % img03_id_str)
         ndar_log.info('ndar_unpack did not need to run')
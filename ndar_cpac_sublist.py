@@ -14,6 +14,12 @@ the required -c and -y flag arguments; if the -i and -s arguments are
 defined then the S3 data will be downloaded and a local-version of the
 CPAC subject list will be saved to disk.
 
+The IMAGE03 file paths and NDAR_AGGREGATE phenotypes for the
+IMAGE_AGGREGATE entries are fetched with one joined query each and kept
+in dictionaries (see build_img03_index and build_pheno_index), so
+building the lists takes a handful of queries however many subjects
+there are.
+
 Usage:
     python ndar_cpac_sublist.py -c <creds_path> -y <sublist_yaml>
                                 [-i <inputs_dir> -s <study_name>]
@@ -23,8 +29,60 @@ Example:
                                 -i /user/docs/inputs -s site001
 '''
 
+# Return an index of IMAGE03 s3 filepaths
+def build_img03_index(cursor):
+    '''
+    Function to query IMAGE03 for the s3 filepaths of all of the
+    IMAGE_AGGREGATE entries at once, joining the two tables where
+    IMAGE_AGGREGATE image_subtype = IMAGE03 image_description
+
+    Parameters
+    ----------
+    cursor : OracleCursor
+        a cx_Oracle cursor object which is used to query and modify an
+        Oracle database
+
+    Returns
+    -------
+    img03_index : dictionary
+        a dictionary where the keys are (subjectkey, interview_age,
+        lower(image_subtype)) tuples of IMAGE_AGGREGATE values and the
+        values are lists of the matching IMAGE03 results, as tuples of
+        (image_file, image03_id)
+    '''
+
+    # Init variables
+    img03_index = {}
+    img03_cmd = '''
+                select agg.subjectkey, agg.interview_age, agg.img_type,
+                img.image_file, img.image03_id
+                from
+                (select distinct subjectkey, interview_age,
+                 lower(image_subtype) img_type
+                 from image_aggregate) agg
+                join
+                image03 img
+                on
+                img.subjectkey = agg.subjectkey and
+                img.interview_age = agg.interview_age and
+                lower(img.image_description) = agg.img_type
+                '''
+
+    # Query for all of the matches
+    print 'Querying IMAGE03 for s3 filepaths...'
+    cursor.execute(img03_cmd)
+
+    # Index them by IMAGE_AGGREGATE entry
+    for subkey, age, img_type, img_file, img03_id in cursor.fetchall():
+        img03_index.setdefault((subkey, age, img_type), []).\
+                append((img_file, img03_id))
+
+    # Return the index
+    return img03_index
+
+
 # Get S3 image filepath
-def add_s3_path(cursor, entry):
+def add_s3_path(cursor, entry, img03_index=None):
     '''
     Function to find the IMAGE03 s3 filepath of an IMAGE_AGGREGATE entry
     and add it to the entry tuple
@@ -40,6 +98,9 @@ def add_s3_path(cursor, entry):
          image_dimensions, image_subtyp, image_scanner_manufacturer,
          image_tr, image_te, image_flip_angle)
         from the IMAGE_AGGREGATE table in the miNDAR DB instance 
+    img03_index : dictionary (optional)
+        an index from build_img03_index to look the entry up in instead
+        of querying IMAGE03
 
     Returns
     -------
@@ -69,9 +130,12 @@ def add_s3_path(cursor, entry):
     img_type = entry[5].lower()
 
     # Match where IMG_AGG image_subtype = IMG03 image_description
-    print 'querying for %s, %s, %s...' % (subkey, age, img_type)
-    cursor.execute(img03_cmd, arg_1=subkey, arg_2=age, arg_3=img_type)
-    res = cursor.fetchall()
+    if img03_index is not None:
+        res = img03_index.get((subkey, age, img_type), [])
+    else:
+        print 'querying for %s, %s, %s...' % (subkey, age, img_type)
+        cursor.execute(img03_cmd, arg_1=subkey, arg_2=age, arg_3=img_type)
+        res = cursor.fetchall()
 
     # If we found multiple image types, filter through
     no_res = len(res)
@@ -92,7 +156,7 @@ def add_s3_path(cursor, entry):
 
 
 # Return an organized dictionary from the IMAGE_AGGREGATE table
-def build_subkey_dict(cursor, agg_results):
+def build_subkey_dict(cursor, agg_results, img03_index=None):
     '''
     Function to take a list of entry results from querying the
     IMAGE_AGGREGATE table and return an organized dictionary of
@@ -107,6 +171,9 @@ def build_subkey_dict(cursor, agg_results):
     agg_results : list
         a list of tuples that correspond to the column values for each
         database entry
+    img03_index : dictionary (optional)
+        an index from build_img03_index; it is built (with one query)
+        if not given
 
     Returns
     -------
@@ -157,7 +224,11 @@ def build_subkey_dict(cursor, agg_results):
     print 'Found %d items with both anatomical and functional data' \
             % (len(subkey_dict))
 
-    # Iterate through dictionary to query IMAGE03 for S3 file paths
+    # Fetch the IMAGE03 S3 file paths for all of the entries
+    if img03_index is None:
+        img03_index = build_img03_index(cursor)
+
+    # Iterate through dictionary to look up IMAGE03 S3 file paths
     for subkey, entry_dict in subkey_dict.items():
         # Get IMAGE_AGGREGATE entries for anat/rest
         anat_entries = entry_dict['anat']
@@ -166,7 +237,7 @@ def build_subkey_dict(cursor, agg_results):
         for a_entry in anat_entries:
             entries_tmp = []
             try:
-                new_entry = add_s3_path(cursor, a_entry)
+                new_entry = add_s3_path(cursor, a_entry, img03_index)
                 entries_tmp.append(new_entry)
             except Exception as exc:
                 print exc.message
@@ -176,7 +247,7 @@ def build_subkey_dict(cursor, agg_results):
         for r_entry in rest_entries:
             entries_tmp = []
             try:
-                new_entry = add_s3_path(cursor, r_entry)
+                new_entry = add_s3_path(cursor, r_entry, img03_index)
                 entries_tmp.append(new_entry)
             except Exception as exc:
                 print exc.message
@@ -193,8 +264,54 @@ def build_subkey_dict(cursor, agg_results):
     return subkey_dict
 
 
+# Return an index of NDAR_AGGREGATE phenotypes
+def build_pheno_index(cursor):
+    '''
+    Function to query NDAR_AGGREGATE for the phenotypic data of all of
+    the IMAGE_AGGREGATE subjectkeys and interview ages at once
+
+    Parameters
+    ----------
+    cursor : OracleCursor
+        a cx_Oracle cursor object which is used to query and modify an
+        Oracle database
+
+    Returns
+    -------
+    pheno_index : dictionary
+        a dictionary where the keys are (subjectkey, interview_age)
+        tuples of IMAGE_AGGREGATE values and the values are the first
+        matching (full_phenotype, gender) result from NDAR_AGGREGATE
+    '''
+
+    # Init variables
+    pheno_index = {}
+    pheno_query = '''
+                  select agg.subjectkey, agg.interview_age,
+                  nda.full_phenotype, nda.gender
+                  from
+                  (select distinct subjectkey, interview_age
+                   from image_aggregate) agg
+                  join
+                  NDAR_AGGREGATE nda
+                  on
+                  nda.subjectkey = agg.subjectkey and
+                  nda.interview_age = agg.interview_age
+                  '''
+
+    # Query for all of the phenotypes
+    cursor.execute(pheno_query)
+
+    # Index them, keeping the first result as fetchone would
+    for subkey, age, phenotype, gender in cursor.fetchall():
+        pheno_index.setdefault((subkey, age), (phenotype, gender))
+
+    # Return the index
+    return pheno_index
+
+
 # Query and build phenotype file
-def build_pheno_list(cursor, subkey_dict):
+def build_pheno_list(cursor, subkey_dict, pheno_index=None):
     '''
     Function which takes thesubject key dictionary and builds a C-PAC-
     compatible phenotype file for use in C-PAC's group analysis
@@ -208,6 +325,9 @@ def build_pheno_list(cursor, subkey_dict):
         a dictionary where the keys correspond to the subject GUIDs and
         the values are dictionaries comprising of the anatomical and
         functional entries for that subject GUID;
+    pheno_index : dictionary (optional)
+        an index from build_pheno_index; it is built (with one query)
+        if not given
 
     Returns
     -------
@@ -223,20 +343,19 @@ def build_pheno_list(cursor, subkey_dict):
     # asd = 1 - asd, asd = 0 - control
     # age = months/12.0
     pheno_list = [('subject_id', 'sex', 'age', 'asd')]
-    pheno_query = '''
-                  select full_phenotype, gender
-                  from NDAR_AGGREGATE
-                  where
-                  subjectkey = :arg_1 and
-                  interview_age = :arg_2
-                  '''
 
-    # Query for data for each subject entry
+    # Fetch the data for all of the subject entries
     print 'Building phenotypic file...'
+    if pheno_index is None:
+        pheno_index = build_pheno_index(cursor)
+
+    # Look up the data for each subject entry
     for subkey, entry_dict in subkey_dict.items():
         sub_age = entry_dict['anat'][0][1]
-        cursor.execute(pheno_query, arg_1=subkey, arg_2=sub_age)
-        pheno_data = cursor.fetchone()
+        pheno_data = pheno_index.get((subkey, sub_age))
+        if pheno_data is None:
+            print 'No phenotypic data for subject %s; skipping...' % subkey
+            continue
         asd_status = pheno_data[0].lower()
         sex = pheno_data[1].lower()
 
@@ -385,8 +504,8 @@ def download_s3_sublist(s3_sublist, inputs_dir, study_name, creds_path):
 def run_ndar_unpack(s3_path, out_nii, aws_access_key_id, 
                                       aws_secret_access_key):
     '''
-    Function to execute the ndar_unpack python script included in this
-    package
+    Function to execute ndar_unpack (via the ndar_unpack_lib package
+    included in this package) in this process
 
     Parameters
     ----------
@@ -404,29 +523,23 @@ def run_ndar_unpack(s3_path, out_nii, aws_access_key_id,
     -------
     None or Exception
         if the function successfully runs, it will return nothing;
-        however, if there is an error in running the system command, the
+        however, if there is an error in running ndar_unpack, the
         function will raise an exception
     '''
 
     # Import packages
     import os
-    import subprocess
-
-    # Init variables
-    cmd_list = ['./ndar_unpack', '--aws-access-key-id', aws_access_key_id, 
-                '--aws-secret-access-key', aws_secret_access_key, 
-                '-v', out_nii, s3_path]
+    import ndar_unpack_lib
 
-    # Run the command
-    p = subprocess.Popen(cmd_list, stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
-    p.wait()
-    stdout, stderr = p.communicate()
+    # Run ndar_unpack
+    result = ndar_unpack_lib.unpack(s3_path, volume=out_nii,
+                                    aws_access_key_id=aws_access_key_id,
+                                    aws_secret_access_key=aws_secret_access_key)
 
     # If the output doesn't exist, raise an OSError
     if not os.path.exists(out_nii):
-        raise OSError('ndar_unpack failed, responded with:\n'\
-                      'stdout: %s\n\nstderror: %s' % (stdout, stderr))
+        raise OSError('ndar_unpack failed with exit value %d:\n%s'\
+                      % (result.exit_value, result.error))
 
 
 # Main routine
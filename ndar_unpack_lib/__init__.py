@@ -0,0 +1,28 @@
+# See file COPYING distributed with ndar_unpack for copyright and license.
+
+"""ndar_unpack_lib
+
+The library behind the ndar_unpack script.  Batch callers can import this
+and call unpack() for each image rather than running ndar_unpack once per
+image:
+
+    import ndar_unpack_lib
+    result = ndar_unpack_lib.unpack('s3://bucket/path/image.zip',
+                                    volume='/path/to/image.nii.gz',
+                                    aws_access_key_id=key_id,
+                                    aws_secret_access_key=secret_key)
+    if not result.ok:
+        print result.exit_value, result.error
+"""
+
+version = 'ndar_unpack 0.1.2'
+
+from .common import SILENT, ERROR, NOTICE, DEBUG, set_output_level, \
+                    message, BaseError, DataError, GeneralError
+from .data import find_data_handler, image03_fields, NIfTI_1
+from .core import unpack, check_arguments, UnpackResult
+from .batch import read_manifest, run_batch
+from .cache import DownloadCache, default_cache
+from .server import serve, remote_unpack, default_socket
+
+# eof
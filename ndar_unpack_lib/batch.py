@@ -0,0 +1,160 @@
+# See file COPYING distributed with ndar_unpack for copyright and license.
+
+"""batch (manifest) mode for ndar_unpack
+
+A manifest is a YAML (or JSON) list of items.  Each item is either an
+(image03_id, S3 URL) pair, as written by act_sublist_build.py, in which
+case the volume is written to <output directory>/<image03_id>.nii.gz, or
+a dictionary with a 'source' key and any other unpack() keyword
+arguments (e.g. 'volume', 'image03', 'thumbnail') plus an optional 'id'.
+
+run_batch() runs the items through a bounded pool of worker processes,
+each item with its own temporary directory, and writes one JSON line per
+item to the report as items finish.
+"""
+
+import os
+import json
+
+from .common import message, NOTICE, DEBUG, GeneralError
+from .core import unpack
+
+# unpack() keyword arguments that may be given in a manifest item
+item_keywords = ('volume',
+                 'thumbnail',
+                 'image03',
+                 'image03_format',
+                 'header',
+                 'contents',
+                 'download_dir',
+                 'unpack_dir')
+
+def _manifest_loader():
+
+    """return a YAML loader for manifests
+
+    This is yaml.SafeLoader plus the Python tuple, long, unicode and str
+    tags, which yaml.dump() writes for the lists of cursor rows that
+    act_sublist_build.py saves; other Python tags (which could construct
+    arbitrary objects) are still refused.
+    """
+
+    import yaml
+
+    class ManifestLoader(yaml.SafeLoader):
+        pass
+
+    constructors = {
+        'tuple': lambda loader, node: tuple(loader.construct_sequence(node)),
+        'long': lambda loader, node: long(loader.construct_scalar(node)),
+        'unicode': lambda loader, node: loader.construct_scalar(node),
+        'str': lambda loader, node: \
+            loader.construct_scalar(node).encode('utf-8')}
+    for (name, constructor) in constructors.iteritems():
+        ManifestLoader.add_constructor(u'tag:yaml.org,2002:python/' + name,
+                                       constructor)
+    return ManifestLoader
+
+def read_manifest(fname, output_dir=None):
+
+    """read a manifest and return a list of (id, source, unpack() keyword
+    arguments) tuples"""
+
+    import yaml
+
+    try:
+        manifest = yaml.load(open(fname), Loader=_manifest_loader())
+    except yaml.YAMLError, exc:
+        raise GeneralError('%s: error reading manifest: %s' % (fname,
+                                                                str(exc)))
+    if not isinstance(manifest, list):
+        raise GeneralError('%s: manifest is not a list' % fname)
+    items = []
+    for (i, entry) in enumerate(manifest):
+        if isinstance(entry, dict):
+            if 'source' not in entry:
+                raise GeneralError('%s: item %d has no source' % (fname, i))
+            kwargs = {}
+            for (key, value) in entry.iteritems():
+                if key in ('id', 'source'):
+                    continue
+                if key not in item_keywords:
+                    msg = '%s: item %d: unknown key %s' % (fname, i, key)
+                    raise GeneralError(msg)
+                kwargs[key] = value
+            items.append((entry.get('id', i), entry['source'], kwargs))
+        elif isinstance(entry, (list, tuple)) and len(entry) == 2:
+            if not output_dir:
+                msg = '%s: (id, source) items need an output directory'
+                raise GeneralError(msg % fname)
+            (item_id, source) = entry
+            volume = os.path.join(output_dir, '%s.nii.gz' % str(item_id))
+            items.append((item_id, source, {'volume': volume}))
+        else:
+            raise GeneralError('%s: bad item %d' % (fname, i))
+    return items
+
+def _run_item(args):
+    """run one manifest item; the worker pool target"""
+    (item_id, source, kwargs, common_kwargs) = args
+    all_kwargs = dict(common_kwargs)
+    all_kwargs.update(kwargs)
+    try:
+        result = unpack(source, **all_kwargs)
+    except KeyboardInterrupt:
+        # let the parent handle the interrupt rather than hanging the pool
+        return {'id': item_id,
+                'source': source,
+                'exit_value': 1,
+                'error': 'interrupted'}
+    report = {'id': item_id,
+              'source': source,
+              'exit_value': result.exit_value,
+              'error': result.error}
+    if result.volumes:
+        report['volumes'] = result.volumes
+    if result.image03 is not None:
+        report['image03'] = result.image03
+    if result.metrics is not None:
+        report['metrics'] = result.metrics
+    return report
+
+def run_batch(items, report_fo, jobs=None, **common_kwargs):
+
+    """run the manifest items through a pool of jobs worker processes
+
+    items is a list as returned by read_manifest(); common_kwargs are
+    passed to every unpack() call (e.g. the AWS keys).  A JSON line is
+    written to report_fo for each item as it finishes.  Returns a
+    dictionary mapping exit values to the number of items with that exit
+    value.
+    """
+
+    import multiprocessing
+
+    if not jobs:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, max(len(items), 1))
+    message(NOTICE, 'running %d items with %d workers...' % (len(items), jobs))
+    work = [ (item_id, source, kwargs, common_kwargs)
+             for (item_id, source, kwargs) in items ]
+    counts = {}
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for report in pool.imap_unordered(_run_item, work):
+            message(DEBUG, 'item %s exited with %d' % (str(report['id']),
+                                                       report['exit_value']))
+            json.dump(report, report_fo)
+            report_fo.write('\n')
+            report_fo.flush()
+            ev = report['exit_value']
+            counts[ev] = counts.get(ev, 0) + 1
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return counts
+
+# eof
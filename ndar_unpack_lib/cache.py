@@ -0,0 +1,245 @@
+# See file COPYING distributed with ndar_unpack for copyright and license.
+
+"""a local cache of S3 downloads shared by ndar_unpack runs
+
+Objects are stored under a name derived from their bucket, key and ETag,
+so a changed S3 object is never served from the cache.  Downloads are
+written to a temporary file and renamed into place, and a lock file per
+object makes concurrent processes on the same host (e.g. SGE tasks)
+share a single download.  When the cache grows beyond its size cap, the
+least recently used objects are removed, skipping any whose lock is 
+held.
+
+The cache directory is laid out as:
+
+    objects/<hash>    cached objects
+    locks/<hash>      per-object lock files
+    tmp/              downloads in progress
+    lock              lock file for eviction and the statistics
+    stats.json        hit, miss and eviction counts for all processes
+"""
+
+import os
+import errno
+import fcntl
+import hashlib
+import json
+import tempfile
+
+from .common import message, DEBUG
+
+class DownloadCache:
+
+    """a download cache in directory, holding at most max_size bytes
+    (None for no limit)
+
+    hits, misses and evictions count the events in this process; stats()
+    returns the counts for all processes using the cache.
+    """
+
+    def __init__(self, directory, max_size=None):
+        self.directory = os.path.abspath(directory)
+        self.max_size = max_size
+        self.objects_dir = os.path.join(self.directory, 'objects')
+        self.locks_dir = os.path.join(self.directory, 'locks')
+        self.tmp_dir = os.path.join(self.directory, 'tmp')
+        self.lock_fname = os.path.join(self.directory, 'lock')
+        self.stats_fname = os.path.join(self.directory, 'stats.json')
+        for d in (self.objects_dir, self.locks_dir, self.tmp_dir):
+            try:
+                os.makedirs(d)
+            except OSError, exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        return
+
+    def object_name(self, bucket, key, etag):
+        """return the cache name for an S3 object"""
+        h = hashlib.sha1()
+        h.update('%s\0%s\0%s' % (bucket, key, etag))
+        return h.hexdigest()
+
+    def _lock(self, fname):
+        fo = open(fname, 'a')
+        fcntl.flock(fo, fcntl.LOCK_EX)
+        return fo
+
+    def _unlock(self, fo):
+        fcntl.flock(fo, fcntl.LOCK_UN)
+        fo.close()
+        return
+
+    def _try_lock(self, fname):
+        """lock fname if no one else has it locked, returning the open
+        lock file, or None"""
+        fo = open(fname, 'a')
+        try:
+            fcntl.flock(fo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, exc:
+            fo.close()
+            if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return None
+        return fo
+
+    def _link(self, path, dest):
+        """link dest to the cached object path
+
+        A hard link keeps the data even if the object is evicted from the 
+        cache before the caller is done with it; a symbolic link is only 
+        used where a hard link can't be made (another file system, or 
+        links not allowed).
+        """
+        try:
+            os.link(path, dest)
+        except OSError, exc:
+            if exc.errno not in (errno.EXDEV, errno.EPERM):
+                raise
+            os.symlink(path, dest)
+        return
+
+    def fetch(self, key, download, dest):
+
+        """link dest to the cached copy of the boto key object key
+
+        If the object isn't in the cache, download(key, fname) is called
+        to download it to fname, and the result is published into the
+        cache.  The object's lock is held from the check through the 
+        link, so it can't be evicted in between.
+        """
+
+        name = self.object_name(key.bucket.name, key.name, key.etag)
+        path = os.path.join(self.objects_dir, name)
+
+        lock_fo = self._lock(os.path.join(self.locks_dir, name))
+        try:
+            hit = os.path.exists(path)
+            if hit:
+                os.utime(path, None)
+                message(DEBUG, 'cache hit for %s' % key.name)
+            else:
+                message(DEBUG, 'cache miss for %s' % key.name)
+                (fd, temp_path) = tempfile.mkstemp(dir=self.tmp_dir)
+                os.close(fd)
+                try:
+                    download(key, temp_path)
+                    os.rename(temp_path, path)
+                except:
+                    os.unlink(temp_path)
+                    raise
+            self._link(path, dest)
+        finally:
+            self._unlock(lock_fo)
+
+        if hit:
+            self._count('hits')
+        else:
+            self._count('misses')
+            self.evict(keep=path)
+
+        return
+
+    def evict(self, keep=None):
+
+        """remove least recently used objects until the cache is within
+        its size cap
+
+        keep is never removed, nor is any object whose lock is held (one 
+        being fetched).
+        """
+
+        if self.max_size is None:
+            return
+        lock_fo = self._lock(self.lock_fname)
+        try:
+            objects = []
+            total = 0
+            for name in os.listdir(self.objects_dir):
+                path = os.path.join(self.objects_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                objects.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+            objects.sort()
+            n_evicted = 0
+            for (mtime, size, path) in objects:
+                if total <= self.max_size:
+                    break
+                if path == keep:
+                    continue
+                object_lock_fo = self._try_lock(os.path.join(self.locks_dir, 
+                                                os.path.basename(path)))
+                if not object_lock_fo:
+                    continue
+                try:
+                    message(DEBUG, 'evicting %s from the cache' % path)
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        continue
+                finally:
+                    self._unlock(object_lock_fo)
+                total -= size
+                n_evicted += 1
+            if n_evicted:
+                self.evictions += n_evicted
+                self._update_stats('evictions', n_evicted)
+        finally:
+            self._unlock(lock_fo)
+        return
+
+    def _count(self, counter):
+        setattr(self, counter, getattr(self, counter) + 1)
+        lock_fo = self._lock(self.lock_fname)
+        try:
+            self._update_stats(counter, 1)
+        finally:
+            self._unlock(lock_fo)
+        return
+
+    def _read_stats(self):
+        try:
+            return json.load(open(self.stats_fname))
+        except (IOError, ValueError):
+            return {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def _update_stats(self, counter, n):
+        """add n to a shared counter; the caller holds the cache lock"""
+        stats = self._read_stats()
+        stats[counter] = stats.get(counter, 0) + n
+        temp_fname = '%s.%d' % (self.stats_fname, os.getpid())
+        fo = open(temp_fname, 'w')
+        json.dump(stats, fo)
+        fo.close()
+        os.rename(temp_fname, self.stats_fname)
+        return
+
+    def stats(self):
+        """return the hit, miss and eviction counts for all processes"""
+        return self._read_stats()
+
+def default_cache():
+
+    """return the cache named by the environment, or None
+
+    NDAR_UNPACK_CACHE_DIR is the cache directory and
+    NDAR_UNPACK_CACHE_SIZE its size cap in megabytes.
+    """
+
+    directory = os.environ.get('NDAR_UNPACK_CACHE_DIR')
+    if not directory:
+        return None
+    max_size = os.environ.get('NDAR_UNPACK_CACHE_SIZE')
+    if max_size:
+        max_size = int(max_size) * 1024 * 1024
+    else:
+        max_size = None
+    message(DEBUG, 'using download cache %s' % directory)
+    return DownloadCache(directory, max_size)
+
+# eof
@@ -0,0 +1,122 @@
+# See file COPYING distributed with ndar_unpack for copyright and license.
+
+"""output levels, messages, exceptions and lazy imports shared by the 
+ndar_unpack modules"""
+
+import sys
+
+SILENT = 0
+ERROR = 1
+NOTICE = 2
+DEBUG = 3
+
+# set by the caller (see set_output_level()); ndar_unpack sets this from
+# -q and -D
+output_level = NOTICE
+
+progname = 'ndar_unpack'
+
+#############################################################################
+# exceptions
+#
+
+class BaseError(Exception):
+
+    """base class for exceptions"""
+
+    def __init__(self, error):
+        self.error = error
+
+    def __str__(self):
+        return self.error
+
+class DataError(BaseError):
+
+    """error in the data"""
+
+    def __str__(self):
+        return 'bad data: %s' % self.error
+
+class GeneralError(BaseError):
+
+    """error running"""
+
+#############################################################################
+# lazy imports
+#
+
+class LazyModule(object):
+
+    """a module that is imported when it is first used
+
+    Attribute access imports the module (and the given submodules).  An 
+    optional module that can't be imported, or for which check(module) 
+    raises an exception, is false, and using it raises ImportError; so 
+    "if module:" tests for it as with the usual
+
+        try:
+            import module
+        except:
+            module = None
+    """
+
+    def __init__(self, name, submodules=(), optional=False, check=None):
+        self._name = name
+        self._submodules = submodules
+        self._optional = optional
+        self._check = check
+        self._module = None
+        self._tried = False
+        return
+
+    def _load(self):
+        if self._tried:
+            return self._module
+        try:
+            module = __import__(self._name)
+            for submodule in self._submodules:
+                __import__(submodule)
+            if self._check:
+                self._check(module)
+        except Exception:
+            if not self._optional:
+                raise
+            module = None
+        self._module = module
+        self._tried = True
+        return module
+
+    def __nonzero__(self):
+        return self._load() is not None
+
+    def __getattr__(self, name):
+        module = self._load()
+        if module is None:
+            raise ImportError('%s is not available' % self._name)
+        return getattr(module, name)
+
+#############################################################################
+# functions
+#
+
+def set_output_level(level):
+    global output_level
+    output_level = level
+    return
+
+def message(level, msg):
+    fo = sys.stdout
+    if level > output_level:
+        return
+    if level == DEBUG:
+        prefix = 'DEBUG: '
+    elif level == ERROR:
+        fo = sys.stderr
+        prefix = '%s: ' % progname
+    else:
+        prefix = ''
+    for line in msg.split('\n'):
+        fo.write('%s%s\n' % (prefix, line))
+    return
+
+# eof
@@ -0,0 +1,942 @@
+# See file COPYING distributed with ndar_unpack for copyright and license.
+
+"""the ndar_unpack driver
+
+unpack() does everything a single ndar_unpack run does -- fetch the
+source, unpack it, check it, and write the requested outputs -- and
+reports the outcome in an UnpackResult rather than exiting, so it can be
+called repeatedly from one process.
+"""
+
+import sys
+import os
+import traceback
+import tempfile
+import shutil
+import zipfile
+import tarfile
+import json
+import errno
+import threading
+
+from .common import message, ERROR, NOTICE, DEBUG, DataError, \
+                    GeneralError
+from .data import find_data_handler, image03_fields, nibabel, \
+                  classify_member, is_imaging_magic, member_magic_size, \
+                  DICOMData
+from .s3 import get_s3_key, download_key, S3RangeFile, _thread_key
+from .cache import default_cache
+from .files import place_file, place_tree
+from .thumbnail import render_thumbnail
+from .probe import can_probe, probe_source, probe_size
+from .metrics import Metrics
+
+# number of threads extracting zip members
+extract_threads = 4
+
+# number of series of split DICOM data converted at once
+convert_threads = 4
+
+# the umask when the module is loaded (before any of our threads start); 
+# see _umask()
+_startup_umask = os.umask(0)
+os.umask(_startup_umask)
+
+class UnpackResult:
+
+    """the outcome of an unpack() call
+
+    exit_value is the ndar_unpack exit value: 0 for success, 1 for an
+    error running, and 3 for bad data.  For a nonzero exit value, error
+    holds the error message and traceback the formatted traceback.
+
+    data is the BaseData subclass instance that handled the data, if the
+    data was inspected, and image03 is the image03 structure, if it was
+    requested.  For split DICOM data (see unpack()), image03 and 
+    thumbnail are lists with an entry for each series.  metrics is the 
+    dictionary of phase timings and resource use for the run (see 
+    metrics.Metrics.as_dict()).
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.exit_value = 0
+        self.error = None
+        self.traceback = None
+        self.data = None
+        self.image03 = None
+        self.volumes = []
+        self.thumbnail = None
+        self.metrics = None
+        return
+
+    @property
+    def ok(self):
+        return self.exit_value == 0
+
+def check_arguments(source,
+                    volume=None,
+                    thumbnail=None,
+                    image03=None,
+                    header=None,
+                    contents=None,
+                    download_dir=None,
+                    unpack_dir=None,
+                    aws_access_key_id=None,
+                    aws_secret_access_key=None,
+                    metrics=None):
+
+    """check the arguments to unpack() and return a list of errors"""
+
+    errors = []
+
+    if volume:
+        for fname in volume:
+            if os.path.exists(fname):
+                errors.append('%s exists' % fname)
+            else:
+                if not fname.endswith('.nii.gz'):
+                    errors.append('unknown extension for volume %s' % fname)
+
+    if thumbnail and os.path.exists(thumbnail):
+        errors.append('%s exists' % thumbnail)
+
+    if isinstance(image03, basestring) \
+       and image03 != '-' \
+       and os.path.exists(image03):
+        errors.append('%s exists' % image03)
+
+    if contents and contents != '-' and os.path.exists(contents):
+        errors.append('%s exists' % contents)
+
+    if header and header != '-' and os.path.exists(header):
+        errors.append('%s exists' % header)
+
+    if metrics and metrics != '-' and os.path.exists(metrics):
+        errors.append('%s exists' % metrics)
+
+    if source.startswith('s3://'):
+        if not aws_access_key_id:
+            errors.append('input is from S3 but no AWS access key ID given')
+        if not aws_secret_access_key:
+            errors.append('input is from S3 but no AWS secret access key given')
+
+    if download_dir and not os.path.isdir(download_dir):
+        errors.append('%s: not a directory' % download_dir)
+
+    if unpack_dir and not os.path.isdir(unpack_dir):
+        errors.append('%s: not a directory' % unpack_dir)
+
+    return errors
+
+def is_archive(source):
+    """is source a zip or tar file (judging by its name)?"""
+    return source.endswith('.zip') or 'tar' in source or 'tgz' in source
+
+def fetch_source(source,
+                 temp_source,
+                 aws_access_key_id=None,
+                 aws_secret_access_key=None,
+                 cache=None,
+                 download_dir=None,
+                 metrics=None):
+
+    """get the source (an S3 URL or a local file) into temp_source, and 
+    into download_dir if given
+
+    S3 objects are taken from cache (a DownloadCache) if one is given.  
+    Otherwise they are downloaded straight into download_dir, if given, 
+    and temp_source links to the download.  Downloads are counted in 
+    metrics (a Metrics object), if given.
+    """
+
+    def download(key, fname):
+        _download_key(key, fname, metrics)
+        return
+
+    if source.startswith('s3://'):
+        k = get_s3_key(source, aws_access_key_id, aws_secret_access_key)
+        if cache:
+            message(NOTICE, 'getting data through the download cache...')
+            cache.fetch(k, download, temp_source)
+        elif download_dir:
+            dest = os.path.join(download_dir, os.path.basename(source))
+            # download under a temporary name so a failed download 
+            # doesn't leave a partial file under the real one
+            (fd, partial) = tempfile.mkstemp(prefix='.ndar_unpack.', 
+                                             dir=download_dir)
+            os.close(fd)
+            message(NOTICE, 'downloading data to %s...' % download_dir)
+            try:
+                download(k, partial)
+                os.chmod(partial, 0666 & ~_umask())
+                os.rename(partial, dest)
+            except:
+                os.unlink(partial)
+                raise
+            os.symlink(os.path.abspath(dest), temp_source)
+            return
+        else:
+            message(NOTICE, 'downloading data...')
+            message(DEBUG, 'downloading S3 object to %s' % temp_source)
+            download(k, temp_source)
+    else:
+        message(DEBUG, 'linking source to %s' % temp_source)
+        os.symlink(os.path.abspath(source), temp_source)
+
+    if download_dir:
+        message(NOTICE, 'copying source to %s...' % download_dir)
+        # never hard link a cached object to an output
+        place_file(temp_source, 
+                   os.path.join(download_dir, os.path.basename(source)), 
+                   link=not cache)
+
+    return
+
+def _download_key(key, fname, metrics=None):
+    """download_key(), counting the bytes in metrics if given"""
+    download_key(key, fname)
+    if metrics:
+        metrics.add_bytes(key.size, 'bytes_read')
+        metrics.add_bytes(key.size, 'bytes_written')
+    return
+
+def _umask():
+
+    """return the process umask
+
+    Setting the umask to read it would briefly apply a zero umask to files 
+    created by other threads (e.g. conversion threads), so it is read 
+    from /proc where the kernel provides it and otherwise taken as it was 
+    when this module was loaded.
+    """
+
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('Umask:'):
+                return int(line.split()[1], 8)
+    except (IOError, ValueError, IndexError):
+        pass
+    return _startup_umask
+
+def check_source(source,
+                 aws_access_key_id=None,
+                 aws_secret_access_key=None):
+    """raise GeneralError if source doesn't exist"""
+    if source.startswith('s3://'):
+        get_s3_key(source, aws_access_key_id, aws_secret_access_key)
+    elif not os.path.exists(source):
+        raise GeneralError('%s not found' % source)
+    return
+
+def _select_zip_member(zf, name):
+    """should a zip member be extracted? (see data.classify_member())"""
+    selected = classify_member(name)
+    if selected is None:
+        fo = zf.open(name)
+        selected = is_imaging_magic(fo.read(member_magic_size))
+        fo.close()
+    if not selected:
+        message(DEBUG, 'skipping %s' % name)
+    return selected
+
+def _extract_zip(open_zip, unpacked_dir, select=False):
+
+    """extract a zip file
+
+    open_zip() returns the zip file (a file name or a new seekable file 
+    object); it is called once by each of extract_threads threads, which 
+    decompress members in parallel.  If select is true, only imaging 
+    members are extracted.
+    """
+
+    local = threading.local()
+    zip_files = []
+
+    def zip_file():
+        if not hasattr(local, 'zf'):
+            local.zf = zipfile.ZipFile(open_zip())
+            zip_files.append(local.zf)
+        return local.zf
+
+    def extract(name):
+        zf = zip_file()
+        if select:
+            if name.endswith('/') or not _select_zip_member(zf, name):
+                return
+        try:
+            zf.extract(name, unpacked_dir)
+        except OSError, exc:
+            if exc.errno != errno.EEXIST:
+                raise
+            # another thread created the member's directory first
+            zf.extract(name, unpacked_dir)
+        return
+
+    try:
+        names = zip_file().namelist()
+        # imported here to keep startup fast
+        import multiprocessing.pool
+        n_threads = max(min(extract_threads, len(names)), 1)
+        pool = multiprocessing.pool.ThreadPool(n_threads)
+        try:
+            pool.map(extract, names)
+        finally:
+            pool.close()
+            pool.join()
+    except zipfile.BadZipfile:
+        raise DataError('error in zip file')
+    finally:
+        for zf in zip_files:
+            zf.close()
+    return
+
+def _extract_tar(tf, unpacked_dir, select=False):
+
+    """extract the members of an open tar file as they are read
+
+    If select is true, only imaging members are extracted.  Members that 
+    can't be judged by name are read once, checking their first bytes 
+    and writing them out if they are imaging data, so this works on tar 
+    streams.
+    """
+
+    try:
+        for item in tf:
+            if not select or not item.isfile():
+                tf.extract(item, unpacked_dir)
+                continue
+            selected = classify_member(item.name)
+            if selected:
+                tf.extract(item, unpacked_dir)
+                continue
+            if selected is None:
+                fo = tf.extractfile(item)
+                magic = fo.read(member_magic_size)
+                if is_imaging_magic(magic):
+                    _write_member(fo, magic, unpacked_dir, item.name)
+                    continue
+            message(DEBUG, 'skipping %s' % item.name)
+    except:
+        raise DataError('error in tar file')
+    return
+
+def _write_member(fo, head, unpacked_dir, name):
+    """write a tar member whose first bytes (head) have been read from 
+    fo"""
+    path = os.path.join(unpacked_dir, os.path.normpath(name).lstrip('/'))
+    if os.path.relpath(path, unpacked_dir).startswith('..'):
+        raise DataError('bad path %s in tar file' % name)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    out_fo = open(path, 'wb')
+    try:
+        out_fo.write(head)
+        shutil.copyfileobj(fo, out_fo)
+    finally:
+        out_fo.close()
+    return
+
+def unpack_source(source, temp_source, unpacked_dir, select=False):
+
+    """unpack temp_source (fetched from source) into unpacked_dir
+
+    If select is true, only the imaging members of archives are 
+    unpacked.
+    """
+
+    if source.endswith('.zip'):
+        message(NOTICE, 'unpacking ZIP file...')
+        _extract_zip(lambda: temp_source, unpacked_dir, select)
+    elif 'tar' in source or 'tgz' in source:
+        message(NOTICE, 'unpacking tar file...')
+        try:
+            tf = tarfile.open(temp_source,'r')
+        except:
+            raise DataError('error in tar file')
+        _extract_tar(tf, unpacked_dir, select)
+    else:
+        message(DEBUG, 'linking source to unpacked/')
+        source_basename = os.path.basename(temp_source)
+        os.symlink(temp_source, os.path.join(unpacked_dir, source_basename))
+    return
+
+def stream_source(source,
+                  unpacked_dir,
+                  aws_access_key_id=None,
+                  aws_secret_access_key=None,
+                  select=False,
+                  metrics=None):
+
+    """unpack an archive on S3 into unpacked_dir without downloading it
+
+    Tar files are read as a stream and each member is written as it
+    arrives; zip files are read with ranged GETs, starting with the
+    central directory, by the extraction threads, each on its own 
+    connection.  If select is true, only imaging members are unpacked.  
+    The bytes read are counted in metrics (a Metrics object), if given.
+    """
+
+    k = get_s3_key(source, aws_access_key_id, aws_secret_access_key)
+    if source.endswith('.zip'):
+        message(NOTICE, 'unpacking ZIP file from S3...')
+        range_files = []
+        def open_range_file():
+            range_files.append(S3RangeFile(_thread_key(k)))
+            return range_files[-1]
+        _extract_zip(open_range_file, unpacked_dir, select)
+        if metrics:
+            metrics.add_bytes(sum([ rf.bytes_read for rf in range_files ]), 
+                              'bytes_read')
+    else:
+        message(NOTICE, 'unpacking tar file from S3...')
+        try:
+            try:
+                # 'r|*' reads the (possibly compressed) tar file as a
+                # stream, never seeking backwards
+                tf = tarfile.open(fileobj=k, mode='r|*')
+            except:
+                raise DataError('error in tar file')
+            _extract_tar(tf, unpacked_dir, select)
+            if metrics:
+                metrics.add_bytes(k.size, 'bytes_read')
+        finally:
+            k.close()
+    return
+
+def _archive_names(source, temp_source):
+    """return [(name, is directory)] for the members of an archive
+
+    temp_source is a file name or, for a zip file, a file object
+    """
+    if source.endswith('.zip'):
+        try:
+            zf = zipfile.ZipFile(temp_source)
+            names = [ (n, n.endswith('/')) for n in zf.namelist() ]
+            zf.close()
+        except zipfile.BadZipfile:
+            raise DataError('error in zip file')
+    else:
+        try:
+            tf = tarfile.open(temp_source, 'r')
+            names = [ (m.name, m.isdir()) for m in tf.getmembers() ]
+            tf.close()
+        except:
+            raise DataError('error in tar file')
+    return names
+
+def list_source(source, temp_source):
+
+    """return the paths of the files and directories (with a trailing /) 
+    in source, as unpack_source() would unpack them
+
+    Archives are listed from their index (the zip central directory or 
+    the tar headers) rather than by unpacking them, and directories that 
+    are only implied by member paths are included.  temp_source can be 
+    a file object (such as an S3RangeFile) for a zip file.
+    """
+
+    if not is_archive(source):
+        return [os.path.basename(source)]
+    paths = []
+    seen = set()
+    for (name, is_dir) in _archive_names(source, temp_source):
+        # normpath removes the leading './' of some tar members
+        parts = os.path.normpath(name).split('/')
+        for i in xrange(1, len(parts)+1):
+            path = '/'.join(parts[:i])
+            if i < len(parts) or is_dir:
+                path += '/'
+            if path not in seen:
+                seen.add(path)
+                paths.append(path)
+    return paths
+
+def write_contents(fo, paths):
+    for path in paths:
+        fo.write('%s\n' % path)
+    return
+
+def write_image03(fo, image03, format='text'):
+    """write an image03 structure, or a list of them (text records 
+    separated by blank lines or JSON lines), to fo"""
+    if isinstance(image03, dict):
+        image03 = [image03]
+    for (i, record) in enumerate(image03):
+        if format == 'text':
+            if i > 0:
+                fo.write('\n')
+            max_width = max([ len(f) for f in image03_fields ])
+            for field in image03_fields:
+                val = record[field]
+                if val is None:
+                    str_val = ''
+                else:
+                    str_val = str(val)
+                fo.write('%s = %s\n' % (field.ljust(max_width), str_val))
+        else:
+            json.dump(record, fo)
+            fo.write('\n')
+    return
+
+def series_fname(fname, number):
+    """return the output file name for series number of split DICOM 
+    data (volume.nii.gz => volume_series2.nii.gz)"""
+    if fname.endswith('.nii.gz'):
+        (base, ext) = (fname[:-7], '.nii.gz')
+    else:
+        (base, ext) = os.path.splitext(fname)
+    return '%s_series%d%s' % (base, number, ext)
+
+def _output_fname(fname, handler, split):
+    """return the output file name for handler, a series handler if 
+    split is true (see unpack())"""
+    if not split:
+        return fname
+    fname = series_fname(fname, handler.number)
+    if os.path.exists(fname):
+        raise GeneralError('%s exists' % fname)
+    return fname
+
+def _convert_handlers(handlers):
+
+    """convert the data of each handler to .nii.gz, in parallel if there 
+    are several
+
+    Returns the handlers whose conversions succeeded.  A failed 
+    conversion of one of several series is reported and its series 
+    dropped; if all fail, the first error is raised.
+    """
+
+    if len(handlers) == 1:
+        handlers[0].nii_gz()
+        return handlers
+
+    def convert(handler):
+        try:
+            handler.nii_gz()
+            return None
+        except Exception, exc:
+            return exc
+
+    # imported here to keep startup fast
+    import multiprocessing.pool
+
+    pool = multiprocessing.pool.ThreadPool(min(convert_threads, 
+                                               len(handlers)))
+    try:
+        errors = pool.map(convert, handlers)
+    finally:
+        pool.close()
+        pool.join()
+    converted = []
+    for (handler, error) in zip(handlers, errors):
+        if error is None:
+            converted.append(handler)
+        else:
+            message(ERROR, 'series %d (%s): %s' % (handler.number, 
+                                                   handler.series.uid, 
+                                                   str(error)))
+    if not converted:
+        raise [ e for e in errors if e is not None ][0]
+    return converted
+
+# the stages of an unpack() run, in the order they run
+stage_names = ('fetch', 
+               'list', 
+               'probe', 
+               'extract', 
+               'inspect', 
+               'convert', 
+               'render')
+
+def plan_stages(source,
+                volume=None,
+                thumbnail=None,
+                image03=None,
+                header=None,
+                contents=None,
+                download_dir=None,
+                unpack_dir=None,
+                cache=None,
+                probe=False):
+
+    """return the stages (see stage_names) unpack() needs to run to 
+    produce the requested outputs
+
+    If no outputs are requested, the data is inspected (checked).  If 
+    probe is true and only image03 or the check is needed, single files 
+    on S3 are probed (see probe.probe_source()) rather than fetched and 
+    inspected.
+    """
+
+    stages = set()
+
+    if not volume \
+       and not thumbnail \
+       and not image03 \
+       and not header \
+       and not download_dir \
+       and not unpack_dir \
+       and not contents:
+        stages.add('inspect')
+    if volume or thumbnail or image03 or header:
+        stages.add('inspect')
+    if volume or thumbnail:
+        stages.add('convert')
+    if thumbnail:
+        stages.add('render')
+    if contents:
+        stages.add('list')
+    if probe \
+       and 'inspect' in stages \
+       and can_probe(source) \
+       and 'convert' not in stages \
+       and not header \
+       and not download_dir \
+       and not unpack_dir:
+        stages.discard('inspect')
+        stages.add('probe')
+    if unpack_dir or 'inspect' in stages:
+        stages.add('extract')
+
+    # archives on S3 can be extracted without fetching them first, unless 
+    # the archive itself is needed; zip files on S3 are listed from their 
+    # central directory
+    if download_dir:
+        stages.add('fetch')
+    if 'list' in stages and is_archive(source):
+        if not source.startswith('s3://') or not source.endswith('.zip'):
+            stages.add('fetch')
+    if 'extract' in stages:
+        if not source.startswith('s3://') \
+           or not is_archive(source) \
+           or cache:
+            stages.add('fetch')
+
+    return [ stage for stage in stage_names if stage in stages ]
+
+def _write_output(fname, what, writer, *args):
+    """call writer(fo, *args) with fo opened on fname ('-' for stdout)"""
+    if fname == '-':
+        fo = sys.stdout
+    else:
+        message(NOTICE, 'writing %s to %s...' % (what, fname))
+        fo = open(fname, 'w')
+    try:
+        writer(fo, *args)
+    finally:
+        if fo is not sys.stdout:
+            fo.close()
+    return
+
+def unpack(source,
+           volume=None,
+           thumbnail=None,
+           image03=None,
+           image03_format='text',
+           header=None,
+           contents=None,
+           download_dir=None,
+           unpack_dir=None,
+           aws_access_key_id=None,
+           aws_secret_access_key=None,
+           cache=None,
+           clean=True,
+           metrics=None,
+           probe=False,
+           split_series=False):
+
+    """check, describe, and unpack the data at source (a local file or an
+    S3 URL)
+
+    volume is a .nii.gz file name or a list of them.  image03, header and
+    contents are output file names ('-' for stdout); image03 can also be
+    True to fill in UnpackResult.image03 without writing it anywhere.
+    thumbnail is the output PNG file name, and download_dir and
+    unpack_dir are existing directories to copy the source and the
+    unpacked data to.  If no outputs are requested, the data is checked.
+
+    cache is the DownloadCache to fetch S3 objects through; by default
+    the cache named by the environment (see cache.default_cache()) is
+    used, if any, and False disables caching.
+
+    metrics is a file name ('-' for stdout) to write the run's phase 
+    timings and resource use to as JSON (see metrics.Metrics); they are 
+    also in UnpackResult.metrics.
+
+    If probe is true and only image03 or the check is requested, a 
+    single-file source on S3 (.nii, .nii.gz, .nrrd or .mnc) is described 
+    from its header, read with ranged GETs, rather than downloaded; this 
+    doesn't check the voxel data (see probe.probe_source()).  
+    UnpackResult.data is then a probe.ProbeData.
+
+    If split_series is true, DICOM data with more than one series is 
+    accepted rather than rejected, and each series is converted (in 
+    parallel) and described separately: volumes and thumbnails are 
+    written for each series, with the series number added to the file 
+    names (see series_fname()), and image03 has a record for each 
+    series.  Series that fail to convert are reported and skipped.
+
+    Returns an UnpackResult.  Errors are reported through the result
+    rather than raised.
+    """
+
+    if isinstance(volume, basestring):
+        volume = [volume]
+
+    result = UnpackResult(source)
+    tempdir = None
+    run_metrics = Metrics()
+
+    try:
+
+        errors = check_arguments(source,
+                                 volume=volume,
+                                 thumbnail=thumbnail,
+                                 image03=image03,
+                                 header=header,
+                                 contents=contents,
+                                 download_dir=download_dir,
+                                 unpack_dir=unpack_dir,
+                                 aws_access_key_id=aws_access_key_id,
+                                 aws_secret_access_key=aws_secret_access_key,
+                                 metrics=metrics)
+        if errors:
+            raise GeneralError('; '.join(errors))
+
+        tempdir = tempfile.mkdtemp()
+        source_dir = os.path.join(tempdir, 'source')
+        unpacked_dir = os.path.join(tempdir, 'unpacked')
+        output_dir = os.path.join(tempdir, 'output')
+        os.mkdir(source_dir)
+        os.mkdir(unpacked_dir)
+        os.mkdir(output_dir)
+
+        temp_source = os.path.join(source_dir, os.path.basename(source))
+
+        if cache is None:
+            cache = default_cache()
+
+        stages = plan_stages(source,
+                             volume=volume,
+                             thumbnail=thumbnail,
+                             image03=image03,
+                             header=header,
+                             contents=contents,
+                             download_dir=download_dir,
+                             unpack_dir=unpack_dir,
+                             cache=cache,
+                             probe=probe)
+        message(DEBUG, 'stages: %s' % ', '.join(stages))
+
+        if 'fetch' in stages:
+            with run_metrics.phase('download'):
+                fetch_source(source,
+                             temp_source,
+                             aws_access_key_id,
+                             aws_secret_access_key,
+                             cache,
+                             download_dir,
+                             run_metrics)
+
+        if 'list' in stages:
+            with run_metrics.phase('contents'):
+                if 'fetch' in stages:
+                    paths = list_source(source, temp_source)
+                elif is_archive(source):
+                    # a zip file on S3; read just its central directory
+                    k = get_s3_key(source, 
+                                   aws_access_key_id, 
+                                   aws_secret_access_key)
+                    rf = S3RangeFile(k, probe_size)
+                    # fetch the end of the file, where the central 
+                    # directory of most zip files is, in one GET
+                    rf.seek(max(rf.size - probe_size, 0))
+                    rf.read(1)
+                    paths = list_source(source, rf)
+                    run_metrics.add_bytes(rf.bytes_read, 'bytes_read')
+                else:
+                    # the listing of a single file is its name, but make 
+                    # sure it's there
+                    check_source(source, 
+                                 aws_access_key_id, 
+                                 aws_secret_access_key)
+                    paths = list_source(source, temp_source)
+                _write_output(contents, 'contents', write_contents, paths)
+
+        data = None
+
+        if 'probe' in stages:
+            with run_metrics.phase('probe'):
+                k = get_s3_key(source, 
+                               aws_access_key_id, 
+                               aws_secret_access_key)
+                try:
+                    data = probe_source(source, k, run_metrics)
+                except NotImplementedError, exc:
+                    message(DEBUG, 'can\'t probe (%s); downloading' % str(exc))
+                    stages = plan_stages(source,
+                                         image03=image03,
+                                         contents=contents,
+                                         cache=cache)
+                    if 'fetch' in stages:
+                        fetch_source(source,
+                                     temp_source,
+                                     aws_access_key_id,
+                                     aws_secret_access_key,
+                                     cache,
+                                     metrics=run_metrics)
+
+        if 'extract' in stages:
+            with run_metrics.phase('unpack'):
+                # unpack everything for --unpack, and just the imaging 
+                # data otherwise
+                select = not unpack_dir
+                if 'fetch' in stages:
+                    unpack_source(source, temp_source, unpacked_dir, select)
+                else:
+                    # archives on S3 are unpacked straight from S3 when 
+                    # the source itself isn't wanted
+                    stream_source(source,
+                                  unpacked_dir,
+                                  aws_access_key_id,
+                                  aws_secret_access_key,
+                                  select,
+                                  run_metrics)
+                run_metrics.add_bytes(_tree_size(unpacked_dir), 
+                                      'bytes_written')
+                if unpack_dir:
+                    message(NOTICE, 
+                            'copying unpacked data to %s...' % unpack_dir)
+                    place_tree(unpacked_dir, unpack_dir)
+
+        if 'inspect' in stages:
+            with run_metrics.phase('inspect'):
+                data = find_data_handler(tempdir, split_series, run_metrics)
+
+        # the handlers that produce the outputs: one for each series of 
+        # split DICOM data, otherwise just data
+        if isinstance(data, DICOMData):
+            handlers = data.split()
+        else:
+            handlers = [data]
+        split = len(handlers) > 1
+        if split:
+            message(NOTICE, 'found %d series' % len(handlers))
+
+        if header:
+            with run_metrics.phase('header'):
+                _write_output(header,
+                              'header',
+                              lambda fo: fo.write(data.header()))
+
+        if 'convert' in stages:
+            with run_metrics.phase('convert'):
+                message(NOTICE, 'converting data...')
+                handlers = _convert_handlers(handlers)
+                for handler in handlers:
+                    run_metrics.add_bytes(os.path.getsize(handler.nii_gz()), 
+                                          'bytes_written')
+                # later nii_gz() calls reuse the conversion
+                for handler in handlers:
+                    for fname in volume or []:
+                        fname = _output_fname(fname, handler, split)
+                        message(NOTICE, 'creating %s...' % fname)
+                        if fname.endswith('.nii.gz'):
+                            handler.nii_gz(fname)
+                            result.volumes.append(fname)
+
+        if 'render' in stages:
+            with run_metrics.phase('thumbnail'):
+                thumbnails = []
+                for handler in handlers:
+                    fname = _output_fname(thumbnail, handler, split)
+                    message(NOTICE, 'creating %s...' % fname)
+                    if nibabel:
+                        render_thumbnail(handler.nii_gz(), fname)
+                    else:
+                        vol_r = os.path.join(handler.tempdir, 'vol_r.nii.gz')
+                        handler.check_call(['fslreorient2std', 
+                                            handler.nii_gz(), 
+                                            vol_r])
+                        handler.check_call(['slicer', vol_r, '-a', fname])
+                    run_metrics.add_bytes(os.path.getsize(fname), 
+                                          'bytes_written')
+                    thumbnails.append(fname)
+                if split:
+                    result.thumbnail = thumbnails
+                else:
+                    result.thumbnail = thumbnail
+
+        if image03:
+            with run_metrics.phase('image03'):
+                if split:
+                    result.image03 = [ h.image03 for h in handlers ]
+                else:
+                    result.image03 = data.image03
+                if image03 is not True:
+                    _write_output(image03,
+                                  'image03',
+                                  write_image03,
+                                  result.image03,
+                                  image03_format)
+
+        # print a message if no other actions were taken
+        if not volume \
+           and not thumbnail \
+           and not image03 \
+           and not header \
+           and not download_dir \
+           and not unpack_dir \
+           and not contents:
+            message(NOTICE, 'data okay')
+
+        if not data:
+            message(DEBUG, 'data was not checked')
+
+        result.data = data
+
+    except Exception, exc:
+
+        if isinstance(exc, DataError):
+            result.exit_value = 3
+        else:
+            result.exit_value = 1
+        result.error = str(exc)
+        result.traceback = traceback.format_exc()
+
+    finally:
+
+        if tempdir:
+            if clean:
+                message(DEBUG, 'removing temporary directory %s' % tempdir)
+                shutil.rmtree(tempdir)
+            else:
+                message(NOTICE, 'leaving temporary directory %s' % tempdir)
+
+        run_metrics.finish()
+        result.metrics = run_metrics.as_dict()
+
+    if metrics:
+        try:
+            _write_output(metrics, 
+                          'metrics', 
+                          lambda fo: fo.write(json.dumps(result.metrics) + 
+                                              '\n'))
+        except IOError, exc:
+            message(ERROR, 'error writing metrics: %s' % str(exc))
+
+    return result
+
+def _tree_size(dir):
+    """return the total size of the files (not symlinks) under dir"""
+    size = 0
+    for (dirpath, dirnames, filenames) in os.walk(dir):
+        for fname in filenames:
+            path = os.path.join(dirpath, fname)
+            if not os.path.islink(path):
+                size += os.path.getsize(path)
+    return size
+
+# eof
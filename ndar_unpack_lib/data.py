@@ -0,0 +1,1539 @@
+# See file COPYING distributed with ndar_unpack for copyright and license.
+
+"""data handling classes for ndar_unpack
+
+find_data_handler() chooses a BaseData subclass for the data in an 
+ndar_unpack temporary directory.
+"""
+
+import os
+import re
+import subprocess
+import errno
+import time
+import gzip
+import zlib
+import struct
+import collections
+
+from .common import message, DEBUG, NOTICE, DataError, GeneralError, \
+                    LazyModule
+from .files import place_file
+
+# the imaging modules are slow to import, so they are imported when 
+# first used (see common.LazyModule), and ndar_unpack --version or a 
+# NIfTI check doesn't pay for them
+
+dicom = LazyModule('dicom')
+
+# nibabel if possible
+# and since we're just using nibabel for MINC2, consider the import 
+# unsuccessful if nibabel.Minc2Image doesn't exist
+nibabel = LazyModule('nibabel', 
+                     optional=True, 
+                     check=lambda nibabel: nibabel.Minc2Image)
+
+# numpy (for in-process DICOM conversion)
+numpy = LazyModule('numpy', optional=True)
+
+# SimpleITK for NRRD support
+SimpleITK = LazyModule('SimpleITK', optional=True)
+
+image03_fields = ('subjectkey', 'src_subject_id', 'interview_date', 
+                  'interview_age', 'gender', 'comments_misc', 'image_file', 
+                  'image_thumbnail_file', 'image_description', 
+                  'image_file_format', 'image_modality', 
+                  'scanner_manufacturer_pd', 'scanner_type_pd', 
+                  'scanner_software_versions_pd', 'magnetic_field_strength', 
+                  'mri_repetition_time_pd', 'mri_echo_time_pd', 'flip_angle', 
+                  'acquisition_matrix', 'mri_field_of_view_pd', 
+                  'patient_position', 'photomet_interpret', 'receive_coil', 
+                  'transmit_coil', 'transformation_performed', 
+                  'transformation_type', 'image_history', 
+                  'image_num_dimensions', 'image_extent1', 'image_extent2', 
+                  'image_extent3', 'image_extent4', 'extent4_type', 
+                  'image_extent5', 'extent5_type', 'image_unit1', 
+                  'image_unit2', 'image_unit3', 'image_unit4', 'image_unit5', 
+                  'image_resolution1', 'image_resolution2', 
+                  'image_resolution3', 'image_resolution4', 
+                  'image_resolution5', 'image_slice_thickness', 
+                  'image_orientation', 'qc_outcome', 'qc_description', 
+                  'qc_fail_quest_reason', 'time_diff_units', 
+                  'decay_correction', 'frame_end_times', 'frame_end_unit', 
+                  'frame_start_times', 'frame_start_unit', 'pet_isotope', 
+                  'pet_tracer', 'time_diff_inject_to_image', 'pulse_seq', 
+                  'slice_acquisition', 'software_preproc', 'experiment_id', 
+                  'scan_type', 'data_file2', 'data_file2_type')
+
+# order matters; see NIfTI_1.__init__()
+nifti_units_xyz = (('Meters', 1), 
+                   ('Millimeters', 2), 
+                   ('Micrometers', 3))
+
+# order matters; see NIfTI_1.__init__()
+nifti_units_t = (('Seconds', 8), 
+                 ('Milliseconds', 16), 
+                 ('Microseconds', 24))
+
+# NIfTI-1 datatype code => bits per voxel
+nifti_datatype_bitpix = {1: 1,          # binary
+                         2: 8,          # unsigned char
+                         4: 16,         # signed short
+                         8: 32,         # signed int
+                         16: 32,        # float
+                         32: 64,        # complex
+                         64: 64,        # double
+                         128: 24,       # RGB
+                         256: 8,        # signed char
+                         512: 16,       # unsigned short
+                         768: 32,       # unsigned int
+                         1024: 64,      # long long
+                         1280: 64,      # unsigned long long
+                         1536: 128,     # long double
+                         1792: 128,     # double pair
+                         2048: 256,     # long double pair
+                         2304: 32}      # RGBA
+
+# AFNI TAXIS_NUMS time units code => image03 unit
+afni_units_t = {77001: 'Milliseconds',
+                77002: 'Seconds'}
+
+# MINC units attribute => image03 unit (None gives the MINC default)
+minc_units_xyz = {None: 'Millimeters',
+                  'm': 'Meters',
+                  'mm': 'Millimeters',
+                  'um': 'Micrometers'}
+minc_units_t = {None: 'Seconds',
+                's': 'Seconds',
+                'ms': 'Milliseconds',
+                'us': 'Microseconds'}
+
+# NetCDF nc_type => (struct format, size)
+netcdf_types = {1: ('b', 1),            # byte
+                2: ('c', 1),            # char
+                3: ('h', 2),            # short
+                4: ('i', 4),            # int
+                5: ('f', 4),            # float
+                6: ('d', 8)}            # double
+
+def convert_dicom_time(val):
+    return str(float(val)/1000.0)
+
+def convert_dicom_date(val):
+    mo = dicom_date_re.search(val)
+    if mo is None:
+        return None
+    return '%s/%s/%s' % (mo.groupdict['month'], 
+                         mo.groupdict['day'], 
+                         mo.groupdict['year'])
+
+def convert_dicom_float(val):
+    if not isinstance(val, dicom.valuerep.DSfloat):
+        return None
+    return float(val)
+
+dicom_date_re = re.compile('^(P<year>\d\d\d\d)(P<month>\d\d)(P<day>\d\d)$')
+
+# image03 field => (DICOM tag, formatting/conversion function)
+image03_dicom = {'gender': ('PatientSex', None), 
+                 'image_modality': ('Modality', None), 
+                 'scanner_manufacturer_pd': ('Manufacturer', None), 
+                 'scanner_type_pd': ('ManufacturerModelName', None), 
+                 'magnetic_field_strength': ('MagneticFieldStrength', 
+                                             convert_dicom_float),  
+                 'flip_angle': ('FlipAngle', convert_dicom_float), 
+                 'acquisition_matrix': ('AcquisitionMatrix', None), 
+                 'patient_position': ('PatientPosition', None), 
+                 'photomet_interpret': ('PhotometricInterpretation', None), 
+                 'receive_coil': ('ReceiveCoilName', None), 
+                 'transmit_coil': ('TransmitCoilName', None), 
+                 'interview_date': ('StudyDate', convert_dicom_date), 
+                 'mri_repetition_time_pd': ('RepititionTime', 
+                                            convert_dicom_time),
+                 'mri_echo_time_pd': ('EchoTime', convert_dicom_time)}
+
+def unpacked_contents(tempdir):
+    """return the paths of the files unpacked in tempdir"""
+    contents = []
+    for (dir, dirs, files) in os.walk(os.path.join(tempdir, 'unpacked')):
+        for f in files:
+            contents.append(os.path.join(dir, f))
+    return contents
+
+def read_magic(fname, n):
+    """return the first n bytes of fname (decompressed for .gz files)"""
+    if fname.endswith('.gz'):
+        fo = gzip.open(fname)
+    else:
+        fo = open(fname, 'rb')
+    try:
+        return fo.read(n)
+    except IOError:
+        # e.g. a .gz file that isn't gzipped
+        return ''
+    finally:
+        fo.close()
+
+def is_dicom_magic(magic):
+    """do the first 132 bytes of a file (magic) look like DICOM?
+
+    Part 10 files have "DICM" after a 128-byte preamble; files without
+    the preamble start with a group 0002 or 0008 tag.
+    """
+    if magic[128:132] == 'DICM':
+        return True
+    return magic[:2] in ('\x02\x00', '\x08\x00', '\x00\x02', '\x00\x08')
+
+def is_dicom(fname):
+    """does fname look like a DICOM file?"""
+    return is_dicom_magic(read_magic(fname, 132))
+
+# archive members with these (lower case) extensions are imaging data
+member_imaging_extensions = ('.nii', '.nii.gz', '.mnc', '.nrrd', '.head', 
+                             '.brik', '.brik.gz', '.dcm', '.dicom', '.ima')
+
+# and these are not
+member_other_extensions = ('.pdf', '.txt', '.csv', '.tsv', '.doc', '.docx', 
+                           '.xls', '.xlsx', '.rtf', '.htm', '.html', '.xml', 
+                           '.json', '.jpg', '.jpeg', '.png', '.gif', '.bmp', 
+                           '.md', '.log', '.py', '.m', '.sh')
+
+# bytes needed by is_imaging_magic()
+member_magic_size = 348
+
+def is_imaging_magic(magic):
+    """do the first member_magic_size bytes of a file (magic) look like 
+    imaging data?"""
+    if magic[344:348] == 'n+1\0':
+        return True
+    if magic[:4] in ('NRRD', 'CDF\x01', 'CDF\x02', '\x89HDF'):
+        return True
+    return is_dicom_magic(magic)
+
+def classify_member(name):
+
+    """decide by its name whether an archive member is imaging data
+
+    Returns True or False, or None if the member's first bytes should be 
+    checked with is_imaging_magic().  Metadata that archivers add 
+    (__MACOSX/, ._* and .DS_Store files) is never imaging data.
+    """
+
+    basename = os.path.basename(name)
+    if name.startswith('__MACOSX/') \
+       or basename.startswith('._') \
+       or basename == '.DS_Store':
+        return False
+    lower = basename.lower()
+    for ext in member_imaging_extensions:
+        if lower.endswith(ext):
+            return True
+    for ext in member_other_extensions:
+        if lower.endswith(ext):
+            return False
+    return None
+
+def classify_data(contents):
+
+    """return the BaseData subclass for the unpacked files (contents), 
+    judging by their names and first bytes
+
+    Raises DataError if the files are not in a recognized format, or if 
+    their names and contents disagree.
+    """
+
+    if not contents:
+        raise DataError('unrecognized data format: no files')
+
+    if len(contents) == 1:
+        fname = contents[0]
+        if fname.endswith('.nii.gz') or fname.endswith('.nii'):
+            if read_magic(fname, 348)[344:348] != 'n+1\0':
+                raise DataError('bad magic string in NIfTI-1 file')
+            if fname.endswith('.gz'):
+                return NIfTIGzData
+            return NIfTIData
+        if fname.endswith('.mnc'):
+            magic = read_magic(fname, 4)
+            if magic[:3] == 'CDF':
+                return MINCData
+            if magic == '\x89HDF':
+                # MINC2; without nibabel, fall back to mnc2nii
+                if nibabel:
+                    return MINC2Data
+                return MINCData
+            raise DataError('.mnc file is neither NetCDF nor HDF5')
+        if fname.endswith('.nrrd'):
+            if read_magic(fname, 4) != 'NRRD':
+                raise DataError('bad magic string in NRRD file')
+            if not SimpleITK:
+                raise DataError('unrecognized data format: NRRD unsupported')
+            return NRRDData
+
+    if len(contents) == 2:
+        base = os.path.commonprefix(contents)
+        if base.endswith('.') \
+           and '%sHEAD' % base in contents \
+           and '%sBRIK' % base in contents:
+            return AFNIData
+
+    for fname in contents:
+        if not is_dicom(fname):
+            message(DEBUG, 'non-DICOM found: %s' % fname)
+            raise DataError('unrecognized data format')
+    return DICOMData
+
+def find_data_handler(tempdir, split_series=False, metrics=None):
+
+    """find the class (BaseData subclass) that can handle the data and
+    return an instance of it
+
+    The class is chosen by classify_data() in a single pass over the
+    file names and magic numbers.  Its constructor then checks the data,
+    raising DataError if it finds an error.  If split_series is true, 
+    DICOM data with more than one series is accepted (see 
+    DICOMData.split()).  The handler records to metrics, if given (see 
+    BaseData).
+    """
+
+    message(NOTICE, 'inspecting data...')
+    data_class = classify_data(unpacked_contents(tempdir))
+    message(DEBUG, 'data looks like %s' % str(data_class))
+    kwargs = {'metrics': metrics}
+    if split_series and data_class is DICOMData:
+        kwargs['split_series'] = True
+    try:
+        data = data_class(tempdir, **kwargs)
+    except TypeError, exc:
+        message(DEBUG, 'class complains: %s' % str(exc))
+        raise DataError('unrecognized data format')
+    message(DEBUG, 'class %s accepted the data' % str(data.__class__))
+
+    return data
+
+def image03_from_geometry(geometry):
+
+    """return an image03 structure with the fields given by geometry 
+    (see BaseData.geometry()) filled in and the rest None"""
+
+    image03 = {}
+    for field in image03_fields:
+        image03[field] = None
+
+    (extents, resolutions, xyz_units, t_units) = geometry
+
+    image03['image_num_dimensions'] = len(extents)
+
+    for i in xrange(1, len(extents)+1):
+        image03['image_extent%d' % i] = extents[i-1]
+        image03['image_resolution%d' % i] = resolutions[i-1]
+        if i < 4 and xyz_units:
+            image03['image_unit%d' % i] = xyz_units
+        if i == 4 and t_units:
+            image03['image_unit4'] = t_units
+
+    return image03
+
+#############################################################################
+# classes
+#
+
+class NIfTI_1:
+
+    """NIfTI-1 volume"""
+
+    def __init__(self, fname, header_bytes=None):
+
+        # read the header (unless we're given its bytes, as from an S3 
+        # probe) and check its length and the magic string
+        if header_bytes is not None:
+            header_bytes = header_bytes[:348]
+        elif fname.endswith('.gz'):
+            header_bytes = gzip.open(fname).read(348)
+        else:
+            header_bytes = open(fname).read(348)
+        if len(header_bytes) < 348:
+            raise ValueError('header too short in NIfTI-1 file')
+        self.magic = header_bytes[344:]
+        if self.magic != 'n+1\0':
+            raise ValueError('bad magic string in NIfTI-1 file')
+
+        # determine the byte ordering
+        bo = '<'
+        dim0 = struct.unpack('<h', header_bytes[40:42])[0]
+        if dim0 < 1 or dim0 > 7:
+            bo = '>'
+            dim0 = struct.unpack('>h', header_bytes[40:42])[0]
+            if dim0 < 1 or dim0 > 7:
+                raise ValueError('couldn\'t determine byte ordering')
+        self.sizeof_hdr = struct.unpack('%si' % bo, header_bytes[:4])[0]
+        if self.sizeof_hdr != 348:
+            raise ValueError('couldn\'t determine byte ordering')
+
+        # unpack the header
+        self.dim = struct.unpack('%s8h' % bo, header_bytes[40:56])
+        self.datatype = struct.unpack('%sh' % bo, header_bytes[70:72])[0]
+        self.bitpix = struct.unpack('%sh' % bo, header_bytes[72:74])[0]
+        self.pixdim = struct.unpack('%s8f' % bo, header_bytes[76:108])
+        self.vox_offset = struct.unpack('%sf' % bo, header_bytes[108:112])[0]
+        self.xyzt_units = struct.unpack('%sB' % bo, header_bytes[123:124])[0]
+
+        # order matters here; xyzt_units = 3 will match both Meters (1) and 
+        # Micrometers (3), so we go from less to more specific
+        self.xyz_units = None
+        for (name, value) in nifti_units_xyz:
+            if self.xyzt_units & value == value:
+                self.xyz_units = name
+
+        # again, order matters and we go from less to more specific
+        self.t_units = None
+        for (name, value) in nifti_units_t:
+            if self.xyzt_units & value == value:
+                self.t_units = name
+
+        self.fname = fname
+
+        return
+
+    def check(self):
+
+        """check that the header is consistent and that the file holds 
+        all of the voxel data
+
+        raises ValueError on a problem
+        """
+
+        expected = self.check_header()
+
+        if self.fname.endswith('.gz'):
+            # read through the whole stream; this also checks the gzip CRC
+            length = 0
+            fo = gzip.open(self.fname)
+            try:
+                while True:
+                    data = fo.read(1024*1024)
+                    if not data:
+                        break
+                    length += len(data)
+            except (IOError, EOFError, zlib.error), exc:
+                raise ValueError('error decompressing: %s' % str(exc))
+            finally:
+                fo.close()
+        else:
+            length = os.path.getsize(self.fname)
+
+        self.check_length(length, expected)
+
+        return
+
+    def check_length(self, length, expected):
+        if length < expected:
+            msg = 'file too short (%d bytes, expected %d)'
+            raise ValueError(msg % (length, expected))
+        return
+
+    def check_header(self):
+
+        """check that the header is consistent and return the expected 
+        file length (uncompressed)
+
+        raises ValueError on a problem
+        """
+
+        for i in xrange(1, self.dim[0]+1):
+            if self.dim[i] < 1:
+                raise ValueError('bad dim[%d] %d' % (i, self.dim[i]))
+        if self.datatype not in nifti_datatype_bitpix:
+            raise ValueError('unknown datatype %d' % self.datatype)
+        if self.bitpix != nifti_datatype_bitpix[self.datatype]:
+            msg = 'bitpix %d does not match datatype %d'
+            raise ValueError(msg % (self.bitpix, self.datatype))
+        # in a single file the data follows the header and extension flag
+        if self.vox_offset < 352:
+            raise ValueError('bad vox_offset %f' % self.vox_offset)
+
+        n_voxels = 1
+        for i in xrange(1, self.dim[0]+1):
+            n_voxels *= self.dim[i]
+
+        return int(self.vox_offset) + (n_voxels * self.bitpix + 7) // 8
+
+    def geometry(self):
+        """return the geometry of the volume (see BaseData.geometry())"""
+        n = self.dim[0]
+        return (self.dim[1:n+1],
+                self.pixdim[1:n+1],
+                self.xyz_units,
+                self.t_units)
+
+class AFNIHeader:
+
+    """the attributes in an AFNI .HEAD file
+
+    attributes maps attribute names to lists of values (or to a string,
+    for string attributes).
+    """
+
+    def __init__(self, fname):
+
+        self.attributes = {}
+        data = open(fname).read()
+        for block in data.split('type = ')[1:]:
+            try:
+                (type_line, name_line, count_line, values) = \
+                        block.split('\n', 3)
+                name = name_line.split('=', 1)[1].strip()
+                count = int(count_line.split('=', 1)[1])
+            except (ValueError, IndexError):
+                raise ValueError('bad attribute in AFNI header')
+            type = type_line.strip()
+            if type == 'string-attribute':
+                # 'value~, with ~ standing in for the terminating NUL
+                start = values.index("'") + 1
+                self.attributes[name] = values[start:start+count-1]
+            elif type == 'integer-attribute':
+                self.attributes[name] = [ int(v) for v in
+                                          values.split()[:count] ]
+            elif type == 'float-attribute':
+                self.attributes[name] = [ float(v) for v in
+                                          values.split()[:count] ]
+            else:
+                raise ValueError('unknown AFNI attribute type %s' % type)
+
+        return
+
+    def geometry(self):
+        """return the geometry of the volume (see BaseData.geometry())"""
+        try:
+            extents = list(self.attributes['DATASET_DIMENSIONS'][:3])
+            resolutions = [ abs(d) for d in self.attributes['DELTA'][:3] ]
+        except KeyError, exc:
+            raise ValueError('AFNI header has no %s' % str(exc))
+        t_units = None
+        n_vals = self.attributes.get('DATASET_RANK', [3, 1])[1]
+        if n_vals > 1:
+            extents.append(n_vals)
+            if 'TAXIS_NUMS' in self.attributes:
+                resolutions.append(self.attributes['TAXIS_FLOATS'][1])
+                t_units = afni_units_t.get(self.attributes['TAXIS_NUMS'][2])
+            else:
+                # a bucket of sub-bricks rather than a time series
+                resolutions.append(1.0)
+        return (extents, resolutions, 'Millimeters', t_units)
+
+class NetCDFHeader:
+
+    """the header of a NetCDF classic (MINC1) file
+
+    dimensions maps dimension names to lengths and variables maps
+    variable names to (dimension names, attributes).
+    """
+
+    def __init__(self, fname):
+
+        # fname can also be an open file object
+        if isinstance(fname, basestring):
+            fo = open(fname, 'rb')
+        else:
+            fo = fname
+        try:
+            self._read(fo)
+        except struct.error:
+            raise ValueError('NetCDF header too short')
+        finally:
+            fo.close()
+        return
+
+    def _unpack(self, fo, fmt):
+        fmt = '>%s' % fmt
+        return struct.unpack(fmt, fo.read(struct.calcsize(fmt)))
+
+    def _read_name(self, fo):
+        (n, ) = self._unpack(fo, 'i')
+        name = fo.read(n)
+        fo.read(-n % 4)
+        return name
+
+    def _read_list(self, fo, tag, read_item):
+        (list_tag, n) = self._unpack(fo, 'ii')
+        if list_tag == 0 and n == 0:
+            return []
+        if list_tag != tag:
+            raise ValueError('bad list in NetCDF header')
+        return [ read_item(fo) for i in xrange(n) ]
+
+    def _read_attribute(self, fo):
+        name = self._read_name(fo)
+        (nc_type, n) = self._unpack(fo, 'ii')
+        if nc_type not in netcdf_types:
+            raise ValueError('bad attribute type in NetCDF header')
+        (fmt, size) = netcdf_types[nc_type]
+        data = fo.read(n * size)
+        fo.read(-(n * size) % 4)
+        if fmt == 'c':
+            value = data.rstrip('\0')
+        else:
+            value = struct.unpack('>%d%s' % (n, fmt), data)
+        return (name, value)
+
+    def _read(self, fo):
+        magic = fo.read(4)
+        if magic not in ('CDF\x01', 'CDF\x02'):
+            raise ValueError('bad magic string in NetCDF file')
+        (self.numrecs, ) = self._unpack(fo, 'i')
+        dims = self._read_list(fo, 10, lambda fo: (self._read_name(fo),
+                                                   self._unpack(fo, 'i')[0]))
+        self.dimensions = collections.OrderedDict()
+        for (name, length) in dims:
+            # the record dimension has length 0 in the header
+            if length == 0:
+                length = self.numrecs
+            self.dimensions[name] = length
+        self.attributes = dict(self._read_list(fo, 12, self._read_attribute))
+        # the begin offset is 64 bits in version 2 files
+        if magic == 'CDF\x02':
+            begin_fmt = 'iiq'
+        else:
+            begin_fmt = 'iii'
+        self.variables = {}
+        def read_variable(fo):
+            name = self._read_name(fo)
+            (n, ) = self._unpack(fo, 'i')
+            dim_ids = self._unpack(fo, '%di' % n)
+            attributes = dict(self._read_list(fo, 12, self._read_attribute))
+            self._unpack(fo, begin_fmt)
+            return (name, dim_ids, attributes)
+        dim_names = self.dimensions.keys()
+        for (name, dim_ids, attributes) in \
+                self._read_list(fo, 11, read_variable):
+            self.variables[name] = ([ dim_names[i] for i in dim_ids ],
+                                    attributes)
+        return
+
+    def geometry(self):
+
+        """return the geometry of the MINC image (see BaseData.geometry())
+
+        MINC lists the image dimensions slowest varying first, so they
+        are reversed here to match the converted NIfTI volume.
+        """
+
+        if 'image' not in self.variables:
+            raise ValueError('no image variable in MINC file')
+        extents = []
+        resolutions = []
+        xyz_units = None
+        t_units = None
+        for name in reversed(self.variables['image'][0]):
+            if name.endswith('space'):
+                units = minc_units_xyz
+            elif name == 'time':
+                units = minc_units_t
+            else:
+                raise ValueError('unsupported MINC dimension %s' % name)
+            attributes = self.variables.get(name, ([], {}))[1]
+            step = attributes.get('step', (1.0, ))[0]
+            unit = units.get(attributes.get('units'), units[None])
+            if name == 'time':
+                t_units = unit
+            else:
+                xyz_units = unit
+            extents.append(self.dimensions[name])
+            resolutions.append(abs(step))
+        return (extents, resolutions, xyz_units, t_units)
+
+class BaseData:
+
+    """base class for data handling classes
+
+    Subclasses should define:
+
+        @property image03(), which returns a dictionary containing the 
+        image03 structure
+
+        geometry(), which returns the extents, resolutions and units of 
+        the image (optional; the default converts the data with nii_gz())
+
+        _convert_nii_gz(), which converts the data to a .nii.gz written 
+        to the given path and returns the file name (which may instead 
+        name an existing .nii.gz).  It is called at most once per 
+        instance; nii_gz() keeps the result.
+
+        header(), which returns a string containing the header information (in 
+        an arbitrary format).
+
+    Each subclass should define __init__() such that it returns only if 
+    it is prepared to handle the data in the passed temporary directory.  
+    If the class rejects the data (e.g. a DICOM handler recieves a NIfTI 
+    file), __init__() should raise TypeError; if the class accepts the 
+    data but finds an error (e.g. a DICOM handler finds more than one 
+    series), __init__() should raise DataError.
+
+    find_data_handler() chooses the subclass with classify_data(), so a 
+    new subclass also needs a rule there.
+
+    metrics is the Metrics object of the run (see metrics.py), which 
+    call() records the programs it runs to, or None.
+    """
+
+    def __init__(self, tempdir, metrics=None):
+        self.tempdir = tempdir
+        self.metrics = metrics
+        self.unpacked_dir = os.path.join(self.tempdir, 'unpacked')
+        self.contents = unpacked_contents(self.tempdir)
+        # a serial number for process output
+        self.process_index = 0
+        self._image03 = None
+        # target format => converted volume, so each conversion is done 
+        # once per run
+        self._conversions = {}
+        return
+
+    def nii_gz(self, path=None):
+
+        """return the file name of a .nii.gz of the data
+
+        If a file name is specified, the volume is placed there (see 
+        place_file()); otherwise a temporary file is returned.  The data 
+        is converted only on the first call.
+        """
+
+        if 'nii.gz' not in self._conversions:
+            converted = os.path.join(self.tempdir, 'volume.nii.gz')
+            self._conversions['nii.gz'] = self._convert_nii_gz(converted)
+        else:
+            message(DEBUG, 'using the converted .nii.gz')
+        if not path:
+            return self._conversions['nii.gz']
+        place_file(self._conversions['nii.gz'], path)
+        return path
+
+    def geometry(self):
+
+        """return (extents, resolutions, spatial units, time units) for 
+        the image03 structure
+
+        The default converts the data and reads the NIfTI header; 
+        subclasses read their native headers instead where they can, so 
+        describing the data doesn't cost a conversion.
+        """
+
+        return NIfTI_1(self.nii_gz()).geometry()
+
+    def _image03_from_geometry(self):
+        """fill as much of the image03 structure as possible from the 
+        image geometry
+
+        this also initializes _image03 with the known fields
+        """
+
+        self._image03 = image03_from_geometry(self.geometry())
+        return self._image03
+
+    def stdout_fname(self):
+        return os.path.join(os.path.join(self.tempdir, 'output'), 
+                            '%d.out' % self.process_index)
+
+    def stderr_fname(self):
+        return os.path.join(os.path.join(self.tempdir, 'output'), 
+                            '%d.err' % self.process_index)
+
+    def _record_process(self, args, exit_value, wall_time):
+        if self.metrics:
+            self.metrics.record_process(self.process_index, 
+                                        args, 
+                                        exit_value, 
+                                        wall_time)
+        return
+
+    def call(self, args):
+        message(DEBUG, 'running (%d) %s' % (self.process_index, ' '.join(args)))
+        stdout_f = None
+        stderr_f = None
+        self.process_index += 1
+        stdout_fname = self.stdout_fname()
+        stderr_fname = self.stderr_fname()
+        start = time.time()
+        try:
+            stdout_f = open(stdout_fname, 'w')
+            stderr_f = open(stderr_fname, 'w')
+            rv = subprocess.call(args, stdout=stdout_f, stderr=stderr_f)
+            self._record_process(args, rv, time.time() - start)
+        except OSError, exc:
+            self._record_process(args, None, time.time() - start)
+            # ENOENT if the program couldn't be found
+            if exc.errno == errno.ENOENT:
+                msg = 'couldn\'t find %s' % args[0]
+            else:
+                msg = str(exc)
+            raise GeneralError(msg)
+        finally:
+            if stdout_f:
+                stdout_f.close()
+            if stderr_f:
+                stderr_f.close()
+        if rv < 0:
+            raise GeneralError('%s killed by signal %d' % (args[0], -rv))
+        if args[0] == 'mri_convert':
+            stderr = open(stderr_fname).read()
+            if 'ERROR: FreeSurfer license file' in stderr:
+                raise GeneralError('FreeSurfer license not found')
+        return rv
+
+    def check_call(self, args):
+        rv = self.call(args)
+        if rv:
+            raise GeneralError('error running %s' % args[0])
+        return
+
+class NIfTIGzData(BaseData):
+
+    def __init__(self, tempdir, metrics=None):
+        BaseData.__init__(self, tempdir, metrics)
+        if not self.contents:
+            raise TypeError('no files')
+        if len(self.contents) != 1:
+            raise TypeError('too many files')
+        if not self.contents[0].endswith('.nii.gz'):
+            raise TypeError('bad extension')
+        try:
+            self.nifti = NIfTI_1(self.contents[0])
+            self.nifti.check()
+        except (ValueError, IOError), exc:
+            raise DataError('could not read .nii.gz: %s' % str(exc))
+        return
+
+    def geometry(self):
+        return self.nifti.geometry()
+
+    @property
+    def image03(self):
+        if self._image03:
+            return self._image03
+        self._image03_from_geometry()
+        self._image03['image_file_format'] = 'NIfTI'
+        return self._image03
+
+    def _convert_nii_gz(self, path):
+        # the data is already a .nii.gz
+        return self.contents[0]
+
+    def header(self):
+        args = ['nifti_tool', '-disp_hdr', '-infiles', self.contents[0]]
+        self.check_call(args)
+        return open(self.stdout_fname()).read()
+
+class NIfTIData(BaseData):
+
+    def __init__(self, tempdir, metrics=None):
+        BaseData.__init__(self, tempdir, metrics)
+        if not self.contents:
+            raise TypeError('no files')
+        if len(self.contents) != 1:
+            raise TypeError('too many files')
+        if not self.contents[0].endswith('.nii'):
+            raise TypeError('bad extension')
+        try:
+            self.nifti = NIfTI_1(self.contents[0])
+            self.nifti.check()
+        except (ValueError, IOError), exc:
+            raise DataError('could not read .nii: %s' % str(exc))
+        return
+
+    def geometry(self):
+        return self.nifti.geometry()
+
+    @property
+    def image03(self):
+        if self._image03:
+            return self._image03
+        self._image03_from_geometry()
+        self._image03['image_file_format'] = 'NIfTI'
+        return self._image03
+
+    def _convert_nii_gz(self, path):
+        self.check_call(['mri_convert', self.contents[0], path])
+        return path
+
+    def header(self):
+        args = ['nifti_tool', '-disp_hdr', '-infiles', self.contents[0]]
+        self.check_call(args)
+        return open(self.stdout_fname()).read()
+
+class AFNIData(BaseData):
+
+    def __init__(self, tempdir, metrics=None):
+        BaseData.__init__(self, tempdir, metrics)
+        if not self.contents:
+            raise TypeError('no files')
+        if len(self.contents) != 2:
+            raise TypeError('wrong number of files')
+        base = os.path.commonprefix(self.contents)
+        if not base:
+            raise TypeError('no common prefix')
+        if not base.endswith('.'):
+            raise TypeError('common prefix does not end with "."')
+        self.head = '%sHEAD' % base
+        self.brik = '%sBRIK' % base
+        if self.head not in self.contents or self.brik not in self.contents:
+            raise TypeError('not a HEAD/BRIK pair')
+        rv = self.call(['mri_convert', '-ro', self.brik])
+        if rv:
+            raise DataError('could not read .BRIK')
+        return
+
+    def geometry(self):
+        try:
+            return AFNIHeader(self.head).geometry()
+        except ValueError, exc:
+            message(DEBUG, 'can\'t read HEAD (%s); converting' % str(exc))
+            return BaseData.geometry(self)
+
+    @property
+    def image03(self):
+        if self._image03:
+            return self._image03
+        self._image03_from_geometry()
+        self._image03['image_file_format'] = 'AFNI'
+        return self._image03
+
+    def _convert_nii_gz(self, path):
+        self.check_call(['mri_convert', self.brik, path])
+        return path
+
+    def header(self):
+        return open(self.head).read()
+
+class MINCData(BaseData):
+
+    def __init__(self, tempdir, metrics=None):
+        BaseData.__init__(self, tempdir, metrics)
+        if not self.contents:
+            raise TypeError('no files')
+        if len(self.contents) > 1:
+            raise TypeError('too many files')
+        if not self.contents[0].endswith('.mnc'):
+            raise TypeError('bad extension')
+        # since both MINC and MINC2 use .mnc, we also check the NetCDF magic 
+        # number here
+        if open(self.contents[0]).read(3) == 'CDF':
+            rv = self.call(['mri_convert', '-ro', self.contents[0]])
+        else:
+            rv = self.call(['mnc2nii', '-nii', self.contents[0]])
+        if rv:
+            raise DataError('could not read .mnc')
+        return
+
+    def geometry(self):
+        # MINC2 files (handled here without nibabel) aren't NetCDF
+        try:
+            return NetCDFHeader(self.contents[0]).geometry()
+        except ValueError, exc:
+            msg = 'can\'t read MINC header (%s); converting'
+            message(DEBUG, msg % str(exc))
+            return BaseData.geometry(self)
+
+    @property
+    def image03(self):
+        if self._image03:
+            return self._image03
+        self._image03_from_geometry()
+        self._image03['image_file_format'] = 'MINC'
+        return self._image03
+
+    def _convert_nii_gz(self, path):
+        try:
+            self.check_call(['mri_convert', self.contents[0], path])
+        except:
+            self.check_call(['mnc2nii', '-nii', self.contents[0], path])
+        return path
+
+    def header(self):
+        self.check_call(['mincheader', self.contents[0]])
+        return open(self.stdout_fname()).read()
+
+class MINC2Data(BaseData):
+
+    def __init__(self, tempdir, metrics=None):
+        BaseData.__init__(self, tempdir, metrics)
+        if not nibabel:
+            raise TypeError('MINC2 unsupported')
+        if not self.contents:
+            raise TypeError('no files')
+        if len(self.contents) > 1:
+            raise TypeError('too many files')
+        if not self.contents[0].endswith('.mnc'):
+            raise TypeError('bad extension')
+        try:
+            self.im = nibabel.load(self.contents[0])
+        except:
+            raise TypeError('could not read .mnc')
+        if not isinstance(self.im, nibabel.Minc2Image):
+            raise TypeError('not MINC2')
+        return
+
+    def geometry(self):
+        # nii_gz() saves the image as is, so this matches the NIfTI volume
+        return (self.im.header.get_data_shape(), 
+                self.im.header.get_zooms(), 
+                'Millimeters', 
+                'Seconds')
+
+    @property
+    def image03(self):
+        if self._image03:
+            return self._image03
+        self._image03_from_geometry()
+        self._image03['image_file_format'] = 'MINC'
+        return self._image03
+
+    def _convert_nii_gz(self, path):
+        nibabel.save(self.im, path)
+        return path
+
+    def header(self):
+        data = 'data_layout: %s\n' % self.im.header.data_layout
+        data += 'default_x_flip: %s\n' % self.im.header.default_x_flip
+        data += 'dtype: %s\n' % str(self.im.header.get_data_dtype())
+        data += 'shape: %s\n' % str(self.im.header.get_data_shape())
+        data += 'zooms: %s\n' % str(self.im.header.get_zooms())
+        data += 'base affine:\n'
+        data += str(self.im.header.get_base_affine())
+        data += '\n'
+        data += 'best affine:\n'
+        data += str(self.im.header.get_best_affine())
+        data += '\n'
+        return data
+
+class NRRDData(BaseData):
+
+    def __init__(self, tempdir, metrics=None):
+        BaseData.__init__(self, tempdir, metrics)
+        if not SimpleITK:
+            raise TypeError('NRRD unsupported')
+        if not self.contents:
+            raise TypeError('no files')
+        if len(self.contents) > 1:
+            raise TypeError('too many files')
+        if not self.contents[0].endswith('.nrrd'):
+            raise TypeError('bad extension')
+        # read just the header if this SimpleITK can; the voxel data is 
+        # only read if it's needed (see im)
+        self._im = None
+        try:
+            self.info = SimpleITK.ImageFileReader()
+            self.info.SetFileName(self.contents[0])
+            self.info.ReadImageInformation()
+        except AttributeError:
+            self.info = self.im
+        except:
+            raise TypeError('could not read .nrrd')
+        return
+
+    @property
+    def im(self):
+        if self._im is None:
+            try:
+                self._im = SimpleITK.ReadImage(self.contents[0])
+            except:
+                raise DataError('could not read .nrrd')
+        return self._im
+
+    def geometry(self):
+        # ITK works in millimeters and seconds
+        return (self.info.GetSize(), 
+                self.info.GetSpacing(), 
+                'Millimeters', 
+                'Seconds')
+
+    @property
+    def image03(self):
+        if self._image03:
+            return self._image03
+        self._image03_from_geometry()
+        self._image03['image_file_format'] = 'NRRD'
+        return self._image03
+
+    def _convert_nii_gz(self, path):
+        SimpleITK.WriteImage(self.im, path)
+        return path
+
+    def header(self):
+        data = 'dimension: %s\n' % str(self.im.GetDimension())
+        data += 'size: %s\n' % str(self.im.GetSize())
+        data += 'spacing: %s\n' % str(self.im.GetSpacing())
+        data += 'origin: %s\n' % str(self.im.GetOrigin())
+        data += 'direction: %s\n' % str(self.im.GetDirection())
+        cpp = str(self.im.GetNumberOfComponentsPerPixel())
+        data += 'components per pixel: %s\n' % cpp
+        data += 'metadata:\n'
+        for key in self.im.GetMetaDataKeys():
+            data += '    %s = %s\n' % (key, str(self.im.GetMetaData(key)))
+        return data
+
+class DICOMSeries:
+
+    """a DICOM series from the header scan
+
+    files is sorted by slice position and headers[i] holds the tags read 
+    from files[i] (see scan_dicom_header()); tags is the header of the 
+    first file.
+    """
+
+    def __init__(self, uid):
+        self.uid = uid
+        self.files = []
+        self.headers = []
+        return
+
+    def add(self, fname, header):
+        self.files.append(fname)
+        self.headers.append(header)
+        return
+
+    @property
+    def tags(self):
+        return self.headers[0]
+
+    @property
+    def description(self):
+        return self.tags.get('SeriesDescription')
+
+    def _slice_key(self, header, normal):
+        """sort key for a slice: its position along the slice normal, or 
+        its instance number"""
+        if normal is not None and 'ImagePositionPatient' in header:
+            pos = [ float(v) for v in header['ImagePositionPatient'] ]
+            return (0, sum([ p*n for (p, n) in zip(pos, normal) ]))
+        if 'InstanceNumber' in header:
+            return (1, int(header['InstanceNumber']))
+        return (2, 0)
+
+    def sort(self):
+        """sort the files by slice position"""
+        normal = None
+        orientation = self.tags.get('ImageOrientationPatient')
+        if orientation is not None and len(orientation) == 6:
+            (r, c) = ([ float(v) for v in orientation[:3] ], 
+                      [ float(v) for v in orientation[3:] ])
+            normal = (r[1]*c[2] - r[2]*c[1], 
+                      r[2]*c[0] - r[0]*c[2], 
+                      r[0]*c[1] - r[1]*c[0])
+        keyed = [ (self._slice_key(h, normal), f, h) 
+                  for (f, h) in zip(self.files, self.headers) ]
+        keyed.sort()
+        self.files = [ f for (k, f, h) in keyed ]
+        self.headers = [ h for (k, f, h) in keyed ]
+        return
+
+    def geometry(self):
+
+        """return the geometry of the series from the scanned headers 
+        (see BaseData.geometry())
+
+        The extents and resolutions are those of the volume 
+        dicom_series_to_nifti() builds.  Raises NotImplementedError for 
+        series it can't handle.
+        """
+
+        tags = self.tags
+        if int(tags.get('NumberOfFrames', 1) or 1) > 1:
+            raise NotImplementedError('multi-frame DICOM')
+        if 'MOSAIC' in [ str(v).upper() for v in tags.get('ImageType', []) ]:
+            raise NotImplementedError('mosaic DICOM')
+        try:
+            rows = int(tags['Rows'])
+            cols = int(tags['Columns'])
+            pixel_spacing = [ float(v) for v in tags['PixelSpacing'] ]
+            positions = [ tuple([ float(v) for v in h['ImagePositionPatient'] ])
+                          for h in self.headers ]
+        except KeyError, exc:
+            raise NotImplementedError('%s missing' % str(exc))
+        if len(set(positions)) != len(positions):
+            raise NotImplementedError('repeated slice positions')
+        n = len(self.files)
+        if n > 1:
+            _check_slice_steps(positions, tags.get('ImageOrientationPatient'))
+            step = [ (b - a) / (n - 1) 
+                     for (a, b) in zip(positions[0], positions[-1]) ]
+            slice_spacing = sum([ v*v for v in step ]) ** 0.5
+        else:
+            slice_spacing = float(tags.get('SliceThickness', 1) or 1)
+        return ((cols, rows, n), 
+                (pixel_spacing[1], pixel_spacing[0], slice_spacing), 
+                'Millimeters', 
+                None)
+
+# tags read by the DICOM header scan, in addition to those in image03_dicom
+dicom_scan_tags = ('SeriesInstanceUID', 
+                   'SeriesNumber', 
+                   'SeriesDescription', 
+                   'InstanceNumber', 
+                   'ImagePositionPatient', 
+                   'ImageOrientationPatient', 
+                   'Rows', 
+                   'Columns', 
+                   'PixelSpacing', 
+                   'SliceThickness', 
+                   'NumberOfFrames', 
+                   'ImageType')
+
+# number of threads for the DICOM header scan
+dicom_scan_threads = 8
+
+def scan_dicom_header(fname):
+
+    """read the header of a DICOM file, stopping before the pixel data
+
+    Returns a dictionary of the values of the tags in dicom_scan_tags and 
+    image03_dicom that are in the file.  Raises TypeError if the file 
+    can't be read as DICOM.
+    """
+
+    try:
+        do = dicom.read_file(fname, 
+                             defer_size=1024, 
+                             stop_before_pixels=True, 
+                             force=True)
+    except:
+        raise TypeError('non-DICOM found')
+    header = {}
+    tags = dicom_scan_tags + tuple([ t for (t, c) in image03_dicom.values() ])
+    for tag in tags:
+        try:
+            header[tag] = getattr(do, tag)
+        except AttributeError:
+            pass
+    return header
+
+def index_dicom(files):
+
+    """scan the headers of DICOM files in parallel and return an index 
+    of the series they make up
+
+    The index is an OrderedDict of series instance UID => DICOMSeries.
+    """
+
+    # imported here to keep startup fast
+    import multiprocessing.pool
+
+    n_threads = max(min(dicom_scan_threads, len(files)), 1)
+    pool = multiprocessing.pool.ThreadPool(n_threads)
+    try:
+        headers = pool.map(scan_dicom_header, files)
+    finally:
+        pool.close()
+        pool.join()
+    index = collections.OrderedDict()
+    for (fname, header) in zip(files, headers):
+        uid = header.get('SeriesInstanceUID')
+        if uid:
+            uid = str(uid)
+        else:
+            # Create dummy uid for the purpose of extracting the file
+            uid = '001'
+        if uid not in index:
+            index[uid] = DICOMSeries(uid)
+        index[uid].add(fname, header)
+    for series in index.itervalues():
+        series.sort()
+    return index
+
+def _read_slice(args):
+    """read the pixel data of one DICOM file into volume[:, :, k]"""
+    (fname, volume, k) = args
+    do = dicom.read_file(fname, force=True)
+    if int(getattr(do, 'NumberOfFrames', 1) or 1) > 1:
+        raise NotImplementedError('multi-frame DICOM')
+    if 'MOSAIC' in [ str(v).upper() for v in getattr(do, 'ImageType', []) ]:
+        raise NotImplementedError('mosaic DICOM')
+    pixels = do.pixel_array
+    if pixels.ndim != 2:
+        raise NotImplementedError('%d-dimensional pixel data' % pixels.ndim)
+    volume[:, :, k] = pixels.T
+    return (float(getattr(do, 'RescaleSlope', 1) or 1), 
+            float(getattr(do, 'RescaleIntercept', 0) or 0))
+
+def _read_series(series):
+
+    """read the pixel data of a DICOMSeries into a volume
+
+    Returns (volume, pixel spacing, [(rescale slope, rescale intercept) 
+    for each slice]).
+    """
+
+    first = dicom.read_file(series.files[0], 
+                            stop_before_pixels=True, 
+                            force=True)
+    try:
+        rows = int(first.Rows)
+        cols = int(first.Columns)
+        pixel_spacing = [ float(v) for v in first.PixelSpacing ]
+    except AttributeError, exc:
+        raise NotImplementedError(str(exc))
+    if int(first.BitsAllocated) == 8:
+        dtype = numpy.uint8
+    elif int(first.PixelRepresentation) == 1:
+        dtype = numpy.int16
+    else:
+        dtype = numpy.uint16
+    if int(first.BitsAllocated) == 32:
+        if int(first.PixelRepresentation) == 1:
+            dtype = numpy.int32
+        else:
+            dtype = numpy.uint32
+
+    n = len(series.files)
+    volume = numpy.empty((cols, rows, n), dtype=dtype)
+    # imported here to keep startup fast
+    import multiprocessing.pool
+    n_threads = max(min(dicom_scan_threads, n), 1)
+    pool = multiprocessing.pool.ThreadPool(n_threads)
+    try:
+        rescale = pool.map(_read_slice, 
+                           [ (f, volume, k) 
+                             for (k, f) in enumerate(series.files) ])
+    finally:
+        pool.close()
+        pool.join()
+    return (volume, pixel_spacing, rescale)
+
+# largest difference, as a fraction of the mean slice spacing, between 
+# the steps from slice to slice that still counts as even spacing
+slice_step_tolerance = 0.01
+
+def _check_slice_steps(positions, orientation):
+
+    """check that slice positions (in series order) are evenly spaced 
+    along the slice normal, as the volume built from them assumes
+
+    Raises NotImplementedError for slices out of order or at the same 
+    position along the normal, or unevenly spaced (e.g. a missing slice).
+    """
+
+    positions = [ [ float(v) for v in p ] for p in positions ]
+    n = len(positions)
+    if n < 2:
+        return
+    if orientation is None or len(orientation) != 6:
+        raise NotImplementedError('ImageOrientationPatient missing')
+    (r, c) = ([ float(v) for v in orientation[:3] ], 
+              [ float(v) for v in orientation[3:] ])
+    normal = (r[1]*c[2] - r[2]*c[1], 
+              r[2]*c[0] - r[0]*c[2], 
+              r[0]*c[1] - r[1]*c[0])
+    mean_step = [ (b - a) / (n - 1) 
+                  for (a, b) in zip(positions[0], positions[-1]) ]
+    spacing = sum([ s*m for (s, m) in zip(mean_step, normal) ])
+    tolerance = slice_step_tolerance * abs(spacing)
+    for (p1, p2) in zip(positions[:-1], positions[1:]):
+        step = [ b - a for (a, b) in zip(p1, p2) ]
+        if sum([ s*m for (s, m) in zip(step, normal) ]) <= 0:
+            raise NotImplementedError('slice positions not increasing along '
+                                      'the normal')
+        if max([ abs(s - m) for (s, m) in zip(step, mean_step) ]) > tolerance:
+            raise NotImplementedError('slices not evenly spaced')
+    return
+
+def dicom_series_to_nifti(series, path):
+
+    """convert a DICOMSeries to a NIfTI volume (written to path) in 
+    process
+
+    Slices are stacked in series order (by position along the slice 
+    normal) into a preallocated volume, rescale slope and intercept are 
+    applied, and the affine is built from the image position, 
+    orientation and pixel spacing.
+
+    Raises NotImplementedError for series this can't handle (multi-frame, 
+    mosaic or time series data, compressed pixel data, missing geometry, 
+    or slices that aren't evenly spaced, as with a missing slice), and 
+    for any error reading the files, which the caller should convert 
+    some other way.
+    """
+
+    tags = series.tags
+    for tag in ('ImagePositionPatient', 'ImageOrientationPatient'):
+        for header in series.headers:
+            if tag not in header:
+                raise NotImplementedError('%s missing' % tag)
+    positions = numpy.array([ [ float(v) for v in h['ImagePositionPatient'] ] 
+                              for h in series.headers ])
+    if len(set([ tuple(p) for p in positions ])) != len(positions):
+        # more than one image at a position: a time series
+        raise NotImplementedError('repeated slice positions')
+    _check_slice_steps(positions, tags['ImageOrientationPatient'])
+
+    n = len(series.files)
+    try:
+        (volume, pixel_spacing, rescale) = _read_series(series)
+    except NotImplementedError:
+        raise
+    except Exception, exc:
+        # files pydicom reads differently (or not at all) without the 
+        # header scan's leniency, missing pixel tags, slices of different 
+        # shapes...
+        raise NotImplementedError('error reading pixel data: %s' % 
+                                  str(exc))
+    slopes = numpy.array([ r[0] for r in rescale ], dtype=numpy.float32)
+    intercepts = numpy.array([ r[1] for r in rescale ], dtype=numpy.float32)
+    if (slopes != 1).any() or (intercepts != 0).any():
+        volume = volume.astype(numpy.float32)
+        volume *= slopes[numpy.newaxis, numpy.newaxis, :]
+        volume += intercepts[numpy.newaxis, numpy.newaxis, :]
+
+    # affine in DICOM (LPS) space: column i of the volume runs along the 
+    # row direction, spaced by the column spacing, and row j along the 
+    # column direction, spaced by the row spacing
+    orientation = [ float(v) for v in tags['ImageOrientationPatient'] ]
+    row_cosine = numpy.array(orientation[:3])
+    col_cosine = numpy.array(orientation[3:])
+    if n > 1:
+        slice_step = (positions[-1] - positions[0]) / (n - 1)
+    else:
+        thickness = float(tags.get('SliceThickness', 1) or 1)
+        slice_step = numpy.cross(row_cosine, col_cosine) * thickness
+    affine = numpy.eye(4)
+    affine[:3, 0] = row_cosine * pixel_spacing[1]
+    affine[:3, 1] = col_cosine * pixel_spacing[0]
+    affine[:3, 2] = slice_step
+    affine[:3, 3] = positions[0]
+    # LPS to RAS
+    affine[:2, :] *= -1
+
+    image = nibabel.Nifti1Image(volume, affine)
+    image.header.set_xyzt_units('mm')
+    nibabel.save(image, path)
+
+    return path
+
+def _series_order(series):
+    """sort key for DICOMSeries: series number, then UID"""
+    try:
+        number = int(series.tags['SeriesNumber'])
+    except (KeyError, TypeError, ValueError):
+        number = None
+    return (number is None, number, series.uid)
+
+class DICOMData(BaseData):
+
+    """DICOM data
+
+    Data with more than one series is rejected unless split_series is 
+    true, in which case split() gives a handler for each series and 
+    series is the first series.
+    """
+
+    def __init__(self, tempdir, split_series=False, metrics=None):
+        BaseData.__init__(self, tempdir, metrics)
+        if not self.contents:
+            raise TypeError('no files')
+        message(DEBUG, 'scanning %d DICOM headers' % len(self.contents))
+        self.series_index = index_dicom(self.contents)
+        if len(self.series_index) > 1 and not split_series:
+            raise DataError('multiple series found')
+        self.series = self.series_index.values()[0]
+        self._split = None
+        return
+
+    def split(self):
+
+        """return a list of DICOMSeriesData, one for each series, in 
+        series number (then UID) order
+
+        With a single series, the list holds just this instance.
+        """
+
+        if self._split is None:
+            if len(self.series_index) == 1:
+                self._split = [self]
+            else:
+                self._split = []
+                ordered = sorted(self.series_index.values(), 
+                                 key=_series_order)
+                for (i, series) in enumerate(ordered):
+                    series_tempdir = os.path.join(self.tempdir, 
+                                                  'series', 
+                                                  str(i+1))
+                    os.makedirs(os.path.join(series_tempdir, 'output'))
+                    self._split.append(DICOMSeriesData(series_tempdir, 
+                                                       series, 
+                                                       i+1, 
+                                                       self.metrics))
+        return self._split
+
+    def geometry(self):
+        try:
+            return self.series.geometry()
+        except NotImplementedError, exc:
+            message(DEBUG, 'no geometry from the headers (%s); converting' % 
+                           str(exc))
+            return BaseData.geometry(self)
+
+    @property
+    def image03(self):
+        if self._image03:
+            return self._image03
+        self._image03_from_geometry()
+        for (field, (tag, converter)) in image03_dicom.iteritems():
+            if tag not in self.series.tags:
+                continue
+            value = self.series.tags[tag]
+            if not value:
+                value = None
+            elif converter is not None:
+                value = converter(value)
+            self._image03[field] = value
+        self._image03['image_file_format'] = 'DICOM'
+        return self._image03
+
+    def _convert_nii_gz(self, path):
+        if nibabel:
+            try:
+                return dicom_series_to_nifti(self.series, path)
+            except NotImplementedError, exc:
+                msg = 'can\'t convert in process (%s); using mri_convert'
+                message(DEBUG, msg % str(exc))
+                if os.path.exists(path):
+                    os.unlink(path)
+        self.check_call(['mri_convert', self.series.files[0], path])
+        return path
+
+    def header(self):
+        do = dicom.read_file(self.series.files[0], 
+                             stop_before_pixels=True, 
+                             force=True)
+        return '%s\n' % str(do)
+
+class DICOMSeriesData(DICOMData):
+
+    """one series of a multi-series DICOM package (see DICOMData.split())
+
+    tempdir is the series' own working directory (for its conversion and 
+    process output); number is the series' 1-based position in the 
+    package.  image03 also gets the series description and slice count.
+    """
+
+    def __init__(self, tempdir, series, number, metrics=None):
+        BaseData.__init__(self, tempdir, metrics)
+        self.contents = list(series.files)
+        self.series_index = collections.OrderedDict([(series.uid, series)])
+        self.series = series
+        self.number = number
+        self._split = [self]
+        return
+
+    @property
+    def image03(self):
+        if self._image03:
+            return self._image03
+        DICOMData.image03.fget(self)
+        if self.series.description:
+            self._image03['image_description'] = str(self.series.description)
+        comment = 'series %d (%s), %d slices' % (self.number, 
+                                                 self.series.uid, 
+                                                 len(self.series.files))
+        self._image03['comments_misc'] = comment
+        return self._image03
+
+# eof
@@ -0,0 +1,96 @@
+# See file COPYING distributed with ndar_unpack for copyright and license.
+
+"""output file placement for ndar_unpack
+
+Outputs are made from files in the temporary directory, which is removed
+at the end of the run, so rather than copying them we link them into
+place where we can.  Only files on another file system are copied.
+"""
+
+import os
+import errno
+import fcntl
+import shutil
+
+from .common import message, DEBUG
+
+# the Linux FICLONE ioctl (linux/fs.h), which makes a copy-on-write clone
+# of a file on file systems that support it (btrfs, XFS)
+FICLONE = 0x40049409
+
+def reflink(src, dest):
+
+    """make dest a copy-on-write clone of src
+
+    Returns True on success and False if the file system (or the 
+    platform) doesn't support it.
+    """
+
+    src_fo = open(src, 'rb')
+    try:
+        dest_fo = open(dest, 'wb')
+        try:
+            fcntl.ioctl(dest_fo.fileno(), FICLONE, src_fo.fileno())
+            ok = True
+        except IOError:
+            ok = False
+        finally:
+            dest_fo.close()
+    finally:
+        src_fo.close()
+    if not ok:
+        os.unlink(dest)
+        return False
+    shutil.copymode(src, dest)
+    return True
+
+def place_file(src, dest, link=True):
+
+    """put a copy of src at dest, replacing any file there
+
+    dest is a hard link to src where possible.  Symbolic links (to the 
+    source data, which may be the user's or the download cache's) are 
+    never hard linked, since a change to one name would show in the 
+    other; they, files on another file system, and all files if link is 
+    False are cloned if the file system supports it and copied otherwise.
+    """
+
+    if os.path.lexists(dest):
+        os.unlink(dest)
+    if link and not os.path.islink(src):
+        try:
+            os.link(src, dest)
+            message(DEBUG, 'linked %s to %s' % (src, dest))
+            return
+        except OSError:
+            pass
+    if reflink(src, dest):
+        message(DEBUG, 'cloned %s to %s' % (src, dest))
+        return
+    shutil.copy(src, dest)
+    message(DEBUG, 'copied %s to %s' % (src, dest))
+    return
+
+def place_tree(src, dest):
+
+    """put a copy of the directory tree src into the directory dest, 
+    using place_file() for each file
+
+    Existing directories under dest are merged into and existing files 
+    are replaced.
+    """
+
+    for (dirpath, dirnames, filenames) in os.walk(src):
+        dest_dir = os.path.normpath(os.path.join(dest, 
+                                                 os.path.relpath(dirpath, src)))
+        try:
+            os.makedirs(dest_dir)
+        except OSError, exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        for fname in filenames:
+            place_file(os.path.join(dirpath, fname), 
+                       os.path.join(dest_dir, fname))
+    return
+
+# eof
@@ -0,0 +1,98 @@
+# See file COPYING distributed with ndar_unpack for copyright and license.
+
+"""phase timing and resource telemetry for ndar_unpack
+
+unpack() records a Metrics object for each run in UnpackResult.metrics
+(as a dictionary), and writes it as JSON if asked (--metrics).  For each
+phase (download, unpack, inspect, convert, thumbnail, image03, ...) it
+holds the wall time and the bytes read from S3 and written to disk; for
+each subprocess run by BaseData.call() it holds the process index, the
+program, its exit status and its wall time.
+
+The peak resident set sizes (process_peak_rss, and process_peak_child_rss
+for the largest child process) are those of the whole process when the
+phase ended, as the kernel keeps them: high-water marks that may have
+been reached by an earlier phase or, in a server or batch worker, an
+earlier run, not the use of the phase itself.
+
+Each run has its own Metrics object, which unpack() passes to the code
+that records to it (e.g. the data handler, see BaseData), so concurrent
+runs in one process don't mix their records.
+"""
+
+import time
+import resource
+import threading
+import contextlib
+
+def _peak_rss():
+    """return the peak RSS so far of this process and of its largest 
+    child, in kilobytes (Linux) or bytes (OS X)"""
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+class Metrics:
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.wall_time = None
+        self.phases = []
+        self.processes = []
+        self._phase = None
+        # the run's threads (downloads, extraction, conversion) record 
+        # concurrently
+        self._lock = threading.Lock()
+        return
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """time the body of a with statement as the named phase"""
+        record = {'name': name, 'bytes_read': 0, 'bytes_written': 0}
+        outer = self._phase
+        self._phase = record
+        start = time.time()
+        try:
+            yield record
+        finally:
+            record['wall_time'] = time.time() - start
+            (record['process_peak_rss'], 
+             record['process_peak_child_rss']) = _peak_rss()
+            self._phase = outer
+            self.phases.append(record)
+        return
+
+    def add_bytes(self, n, kind):
+        """count n bytes moved by the current phase; kind is bytes_read 
+        (from S3) or bytes_written (to disk)"""
+        with self._lock:
+            if self._phase is not None:
+                self._phase[kind] += n
+        return
+
+    def record_process(self, index, args, exit_value, wall_time):
+        with self._lock:
+            if self._phase is None:
+                phase = None
+            else:
+                phase = self._phase['name']
+            self.processes.append({'index': index,
+                                   'program': args[0],
+                                   'args': list(args),
+                                   'exit_value': exit_value,
+                                   'wall_time': wall_time,
+                                   'phase': phase})
+        return
+
+    def finish(self):
+        self.wall_time = time.time() - self.start_time
+        return
+
+    def as_dict(self):
+        (peak_rss, peak_child_rss) = _peak_rss()
+        return {'wall_time': self.wall_time,
+                'process_peak_rss': peak_rss,
+                'process_peak_child_rss': peak_child_rss,
+                'phases': self.phases,
+                'processes': self.processes}
+
+# eof
@@ -0,0 +1,221 @@
+# See file COPYING distributed with ndar_unpack for copyright and license.
+
+"""header probes of S3 objects
+
+probe_source() describes a single-file source on S3 (.nii, .nii.gz,
+.nrrd or .mnc) from the start of the object, read with ranged GETs
+(through a streaming decompressor for .nii.gz), rather than by
+downloading all of it.  It returns a ProbeData, which stands in for the
+BaseData handler when only the image03 structure or the data check is
+needed.
+
+A probe checks less than an inspection does: the header is checked, and
+for an uncompressed NIfTI-1 volume the length of the object is checked
+against it, but the voxel data isn't read.  Sources a probe can't
+describe (MINC2, which is HDF5, or a header that doesn't fit in
+probe_max_size bytes) raise NotImplementedError, and the caller falls
+back to downloading the source.
+"""
+
+import re
+import math
+import zlib
+import StringIO
+
+from .common import message, NOTICE, DEBUG, DataError
+from .data import NIfTI_1, NetCDFHeader, image03_from_geometry
+from .s3 import get_range
+
+# bytes read from S3 at a time, and the most read for one header
+probe_size = 64*1024
+probe_max_size = 4*1024*1024
+
+probe_extensions = ('.nii', '.nii.gz', '.nrrd', '.mnc')
+
+def can_probe(source):
+    """can probe_source() describe source (judging by its name)?"""
+    if not source.startswith('s3://'):
+        return False
+    for ext in probe_extensions:
+        if source.endswith(ext):
+            return True
+    return False
+
+class _HeaderReader:
+
+    """reads the start of an S3 object, decompressing it if gz is true
+
+    Compressed data is decompressed only as far as it's read, so the
+    first bytes of a large .nii.gz cost one small GET.  The bytes read
+    are counted in metrics (a Metrics object), if given.
+    """
+
+    def __init__(self, key, gz=False, metrics=None):
+        self.key = key
+        self.gz = gz
+        self.metrics = metrics
+        # the object bytes fetched so far
+        self.pos = 0
+        self.data = ''
+        if gz:
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return
+
+    @property
+    def complete(self):
+        """has the whole object been read?"""
+        if self.gz and self.decompressor.unconsumed_tail:
+            return False
+        return self.pos >= self.key.size
+
+    def read(self, n):
+        """return the first n bytes (fewer if the object is shorter)"""
+        while len(self.data) < n:
+            if self.gz and self.decompressor.unconsumed_tail:
+                chunk = self.decompressor.unconsumed_tail
+            elif self.pos < self.key.size:
+                end = min(self.pos + max(probe_size, n - len(self.data)),
+                          self.key.size)
+                chunk = get_range(self.key, self.pos, end)
+                if self.metrics:
+                    self.metrics.add_bytes(len(chunk), 'bytes_read')
+                self.pos = end
+            else:
+                break
+            if self.gz:
+                try:
+                    chunk = self.decompressor.decompress(chunk,
+                                                         n - len(self.data))
+                except zlib.error, exc:
+                    raise DataError('error decompressing: %s' % str(exc))
+            self.data += chunk
+        return self.data[:n]
+
+def _probe_nifti(source, reader):
+    try:
+        nifti = NIfTI_1(source, reader.read(348))
+        expected = nifti.check_header()
+        if not reader.gz:
+            nifti.check_length(reader.key.size, expected)
+    except ValueError, exc:
+        raise DataError('could not read NIfTI-1 header: %s' % str(exc))
+    return (nifti.geometry(), 'NIfTI')
+
+def _read_header(reader, parse):
+    """return parse(the start of the object), reading more of the object
+    while parse raises ValueError and there is more to read (up to
+    probe_max_size bytes)"""
+    n = probe_size
+    while True:
+        data = reader.read(n)
+        try:
+            return parse(data)
+        except ValueError, exc:
+            if reader.complete and len(data) < n:
+                raise DataError('could not read header: %s' % str(exc))
+            if n >= probe_max_size:
+                msg = 'no header in the first %d bytes' % n
+                raise NotImplementedError(msg)
+        n *= 2
+    return
+
+def _probe_minc(source, reader):
+    magic = reader.read(4)
+    if magic[:3] != 'CDF':
+        # MINC2 is HDF5, which we can't read in pieces
+        raise NotImplementedError('not a NetCDF (MINC1) file')
+    parse = lambda data: NetCDFHeader(StringIO.StringIO(data)).geometry()
+    return (_read_header(reader, parse), 'MINC')
+
+def parse_nrrd_header(data):
+
+    """return the geometry of a NRRD file (see BaseData.geometry()) from
+    its header, as SimpleITK would read it
+
+    Non-spatial axes (those with a space direction of none, such as
+    vector components) aren't image dimensions.  raises ValueError if
+    the header is incomplete or unsupported.
+    """
+
+    if not data.startswith('NRRD'):
+        raise ValueError('bad magic string in NRRD file')
+    end = re.search('\r?\n\r?\n', data)
+    if not end:
+        raise ValueError('incomplete NRRD header')
+    fields = {}
+    for line in data[:end.start()].splitlines()[1:]:
+        if line.startswith('#') or ':' not in line:
+            continue
+        (name, value) = line.split(':', 1)
+        fields[name.strip().lower()] = value.lstrip('=').strip()
+    if 'sizes' not in fields:
+        raise ValueError('no sizes in NRRD header')
+    sizes = [ int(s) for s in fields['sizes'].split() ]
+
+    if 'space directions' in fields:
+        directions = re.findall('\([^)]*\)|none', fields['space directions'])
+        if len(directions) != len(sizes):
+            raise ValueError('bad space directions in NRRD header')
+        extents = []
+        resolutions = []
+        for (size, direction) in zip(sizes, directions):
+            if direction == 'none':
+                continue
+            vector = [ float(v) for v in direction.strip('()').split(',') ]
+            extents.append(size)
+            resolutions.append(math.sqrt(sum([ v*v for v in vector ])))
+    else:
+        extents = sizes
+        resolutions = [1.0] * len(sizes)
+        if 'spacings' in fields:
+            for (i, spacing) in enumerate(fields['spacings'].split()):
+                if spacing.lower() != 'nan':
+                    resolutions[i] = float(spacing)
+
+    # ITK works in millimeters and seconds
+    return (extents, resolutions, 'Millimeters', 'Seconds')
+
+def _probe_nrrd(source, reader):
+    return (_read_header(reader, parse_nrrd_header), 'NRRD')
+
+class ProbeData:
+
+    """the description of a source from a header probe
+
+    This stands in for a BaseData instance in unpack() for the data
+    check and image03; only image03 and geometry() are available.
+    """
+
+    def __init__(self, source, geometry, format):
+        self.source = source
+        self._geometry = geometry
+        self.image03 = image03_from_geometry(geometry)
+        self.image03['image_file_format'] = format
+        return
+
+    def geometry(self):
+        return self._geometry
+
+def probe_source(source, key, metrics=None):
+
+    """describe the S3 object key (the source source) from its header
+
+    Returns a ProbeData.  raises DataError if the header is bad and
+    NotImplementedError if the source can't be probed.  The bytes read
+    are counted in metrics (a Metrics object), if given.
+    """
+
+    message(NOTICE, 'probing header of %s...' % source)
+    reader = _HeaderReader(key, source.endswith('.gz'), metrics)
+    if source.endswith('.nii') or source.endswith('.nii.gz'):
+        (geometry, format) = _probe_nifti(source, reader)
+    elif source.endswith('.mnc'):
+        (geometry, format) = _probe_minc(source, reader)
+    elif source.endswith('.nrrd'):
+        (geometry, format) = _probe_nrrd(source, reader)
+    else:
+        raise NotImplementedError('unsupported extension')
+    message(DEBUG, 'probe read %d bytes of %s' % (reader.pos, key.name))
+    return ProbeData(source, geometry, format)
+
+# eof
@@ -0,0 +1,279 @@
+# See file COPYING distributed with ndar_unpack for copyright and license.
+
+"""S3 access for ndar_unpack"""
+
+import os
+import time
+import socket
+import httplib
+import threading
+import Queue
+
+from .common import message, DEBUG, GeneralError, LazyModule
+
+# imported when first used (see common.LazyModule)
+boto = LazyModule('boto', submodules=('boto.s3.connection', 'boto.exception'))
+
+# S3 connections and buckets, kept for the life of the process so
+# repeated unpack() calls don't each set up a new connection
+# (access key ID, secret access key) => connection
+_s3_connections = {}
+# (access key ID, secret access key, bucket name) => bucket
+_s3_buckets = {}
+
+# objects larger than download_chunk_size are downloaded in chunks of 
+# this size by download_concurrency threads
+download_chunk_size = 16*1024*1024
+download_concurrency = 8
+
+# number of tries for each ranged GET, and the wait in seconds before 
+# the first retry (doubled for each one after)
+range_tries = 3
+range_retry_delay = 0.5
+
+def parse_s3_url(url):
+    """split an S3 URL into (bucket, path)"""
+    parts = url[5:].split('/', 1)
+    # s3://bucket or s3://bucket/
+    if len(parts) == 1 or not parts[1]:
+        raise GeneralError('incomplete S3 URL')
+    return tuple(parts)
+
+def get_s3_bucket(bucket, aws_access_key_id, aws_secret_access_key):
+
+    """return a (cached) boto bucket object"""
+
+    bucket_key = (aws_access_key_id, aws_secret_access_key, bucket)
+    if bucket_key in _s3_buckets:
+        return _s3_buckets[bucket_key]
+    conn_key = (aws_access_key_id, aws_secret_access_key)
+    if conn_key not in _s3_connections:
+        cf = boto.s3.connection.OrdinaryCallingFormat()
+        _s3_connections[conn_key] = boto.connect_s3(aws_access_key_id,
+                                                    aws_secret_access_key,
+                                                    calling_format=cf)
+    message(DEBUG, 'getting S3 bucket %s' % bucket)
+    b = _s3_connections[conn_key].get_bucket(bucket)
+    _s3_buckets[bucket_key] = b
+    return b
+
+def get_s3_key(url, aws_access_key_id, aws_secret_access_key):
+
+    """return the boto key object for an S3 URL
+
+    raises GeneralError if the object doesn't exist or on an S3 error
+    """
+
+    (bucket, path) = parse_s3_url(url)
+    try:
+        b = get_s3_bucket(bucket, aws_access_key_id, aws_secret_access_key)
+        message(DEBUG, 'looking for S3 object %s' % path)
+        k = b.get_key(path)
+    except boto.exception.S3ResponseError, exc:
+        raise GeneralError('S3 error: %s' % exc.message)
+    if not k:
+        raise GeneralError('%s not found' % url)
+    return k
+
+def get_range(key, start, end, etag=None):
+
+    """return bytes start to end (exclusive) of an S3 object
+
+    The GET is conditional on the object's ETag (key.etag unless etag is
+    given), so a chunk of an object that changes between requests is
+    never returned, and the length of the returned data is checked.
+    Failed GETs (S3 errors, network errors and short reads) are tried 
+    range_tries times in all, waiting range_retry_delay seconds before 
+    the first retry and twice as long before each one after.
+    """
+
+    if etag is None:
+        etag = key.etag
+    message(DEBUG, 'reading bytes %d-%d of %s' % (start, end-1, key.name))
+    headers = {'Range': 'bytes=%d-%d' % (start, end-1)}
+    if etag:
+        headers['If-Match'] = etag
+    for i in xrange(range_tries):
+        if i:
+            time.sleep(range_retry_delay * 2**(i-1))
+        try:
+            data = key.get_contents_as_string(headers=headers)
+        except boto.exception.S3ResponseError, exc:
+            # 412 Precondition Failed: the ETag changed, so retrying
+            # won't help
+            if exc.status == 412 or i == range_tries - 1:
+                raise GeneralError('S3 error: %s' % exc.message)
+            continue
+        except (socket.error, httplib.HTTPException), exc:
+            # a dropped connection (socket.timeout is a socket.error, 
+            # and IncompleteRead an HTTPException); start the next try 
+            # on a fresh response
+            message(DEBUG, 'error reading %s: %s' % (key.name, str(exc)))
+            key.close()
+            if i == range_tries - 1:
+                raise GeneralError('error reading %s: %s' % (key.name, 
+                                                             str(exc)))
+            continue
+        if len(data) == end - start:
+            return data
+    raise GeneralError('short read from %s' % key.name)
+
+def _thread_key(key):
+    """return a key object for key on a new S3 connection
+
+    boto connections aren't shared between download threads
+    """
+    conn = key.bucket.connection
+    new_conn = boto.connect_s3(conn.aws_access_key_id,
+                               conn.aws_secret_access_key,
+                               calling_format=conn.calling_format)
+    b = new_conn.get_bucket(key.bucket.name, validate=False)
+    return b.new_key(key.name)
+
+def download_key(key, fname, chunk_size=None, concurrency=None):
+
+    """download an S3 object to fname
+
+    Objects larger than chunk_size (default download_chunk_size) are
+    split into byte ranges that are fetched by concurrency (default
+    download_concurrency) threads, each with its own connection, into a
+    preallocated file.  Each range is checked against the object's ETag
+    and length (see get_range()).
+
+    raises GeneralError if chunk_size or concurrency isn't positive
+    """
+
+    if chunk_size is None:
+        chunk_size = download_chunk_size
+    if concurrency is None:
+        concurrency = download_concurrency
+    if chunk_size < 1:
+        raise GeneralError('bad download chunk size %d' % chunk_size)
+    if concurrency < 1:
+        raise GeneralError('bad download concurrency %d' % concurrency)
+
+    size = key.size
+    if size <= chunk_size or concurrency < 2:
+        try:
+            key.get_contents_to_filename(fname)
+            key.close()
+        except boto.exception.S3ResponseError, exc:
+            raise GeneralError('S3 error: %s' % exc.message)
+        return
+
+    ranges = Queue.Queue()
+    n_ranges = 0
+    for start in xrange(0, size, chunk_size):
+        ranges.put((start, min(start+chunk_size, size)))
+        n_ranges += 1
+    message(DEBUG, 'downloading %d bytes in %d chunks' % (size, n_ranges))
+
+    fo = open(fname, 'wb')
+    fo.truncate(size)
+    fo.close()
+
+    errors = []
+
+    def worker():
+        try:
+            k = _thread_key(key)
+            fo = open(fname, 'r+b')
+            try:
+                while not errors:
+                    try:
+                        (start, end) = ranges.get_nowait()
+                    except Queue.Empty:
+                        break
+                    data = get_range(k, start, end, key.etag)
+                    fo.seek(start)
+                    fo.write(data)
+            finally:
+                fo.close()
+        except Exception, exc:
+            errors.append(exc)
+        return
+
+    threads = [ threading.Thread(target=worker)
+                for i in xrange(min(concurrency, n_ranges)) ]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        if isinstance(errors[0], GeneralError):
+            raise errors[0]
+        raise GeneralError('error downloading %s: %s' % (key.name,
+                                                         str(errors[0])))
+    if os.path.getsize(fname) != size:
+        raise GeneralError('%s: size mismatch after download' % key.name)
+
+    return
+
+class S3RangeFile:
+
+    """read-only, seekable file-like object over an S3 key
+
+    Reads are served from a buffer filled by ranged GETs of at least
+    block_size bytes, so a reader that seeks around (zipfile reading the
+    central directory at the end of the object, then the members) only
+    fetches the parts of the object it reads.
+    """
+
+    def __init__(self, key, block_size=8*1024*1024):
+        self.key = key
+        self.name = key.name
+        self.size = key.size
+        self.block_size = block_size
+        self.pos = 0
+        self.buf = ''
+        self.buf_start = 0
+        # bytes fetched from S3
+        self.bytes_read = 0
+        return
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            pos = offset
+        elif whence == 1:
+            pos = self.pos + offset
+        elif whence == 2:
+            pos = self.size + offset
+        else:
+            raise ValueError('bad whence %d' % whence)
+        if pos < 0:
+            raise IOError('negative seek position %d' % pos)
+        self.pos = pos
+        return
+
+    def tell(self):
+        return self.pos
+
+    def _get_range(self, start, end):
+        """return bytes start to end (exclusive) of the object"""
+        data = get_range(self.key, start, end)
+        self.bytes_read += len(data)
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = self.size
+        else:
+            end = min(self.pos+size, self.size)
+        if self.pos >= end:
+            return ''
+        buf_end = self.buf_start + len(self.buf)
+        if self.pos < self.buf_start or end > buf_end:
+            fetch_end = min(max(end, self.pos+self.block_size), self.size)
+            self.buf = self._get_range(self.pos, fetch_end)
+            self.buf_start = self.pos
+        data = self.buf[self.pos-self.buf_start:end-self.buf_start]
+        self.pos = end
+        return data
+
+    def close(self):
+        self.buf = ''
+        return
+
+# eof
@@ -0,0 +1,331 @@
+# See file COPYING distributed with ndar_unpack for copyright and license.
+
+"""the ndar_unpack worker daemon and its client
+
+serve() runs a pool of worker processes that take unpack() jobs from a
+Unix socket.  The imaging libraries are imported once, before the
+workers are forked, and each worker keeps its S3 connections (see
+s3.get_s3_bucket()) and download caches from job to job, so a job pays
+for neither process startup nor connection setup.
+
+remote_unpack() sends a job to a server and returns an UnpackResult,
+as unpack() does.  ndar_unpack uses it when a server socket is given
+(--socket or NDAR_UNPACK_SOCKET) and present.
+
+The protocol is JSON lines.  The client sends one job:
+
+    {"source": ..., "kwargs": {unpack() keyword arguments},
+     "cache": null, false or {"directory": ..., "max_size": ...},
+     "output_level": ..., "progname": ...}
+
+and the server sends the job's output as it is written:
+
+    {"stream": "stdout" or "stderr", "data": ...}
+
+followed by the result:
+
+    {"result": {"exit_value": ..., "error": ..., "traceback": ...,
+                "volumes": ..., "thumbnail": ..., "image03": ...,
+                "metrics": ...}}
+
+Relative paths are made absolute by the client, since the server has
+its own working directory.  The socket is only accessible to the user
+running the server, since jobs carry AWS keys.
+"""
+
+import sys
+import os
+import errno
+import json
+import signal
+import socket
+import threading
+
+from . import common
+from .common import message, NOTICE, DEBUG, GeneralError
+from .core import unpack, UnpackResult
+from .cache import DownloadCache
+from .data import dicom, nibabel, numpy, SimpleITK
+from .s3 import boto
+
+# the environment variable naming the server socket
+socket_env = 'NDAR_UNPACK_SOCKET'
+
+# unpack() keyword arguments that name files or directories
+path_keywords = ('thumbnail',
+                 'image03',
+                 'header',
+                 'contents',
+                 'download_dir',
+                 'unpack_dir',
+                 'metrics')
+
+def default_socket():
+    """return the socket named by the environment, or None"""
+    return os.environ.get(socket_env) or None
+
+class _StreamWriter:
+
+    """a file-like object that sends what is written to it to the client
+    as stream messages
+
+    Writes may come from several threads (e.g. download threads' debug
+    messages), so they are serialized.
+    """
+
+    def __init__(self, fo, name, lock):
+        self.fo = fo
+        self.name = name
+        self.lock = lock
+        return
+
+    def write(self, data):
+        line = json.dumps({'stream': self.name, 'data': data})
+        self.lock.acquire()
+        try:
+            self.fo.write(line + '\n')
+            self.fo.flush()
+        finally:
+            self.lock.release()
+        return
+
+    def flush(self):
+        return
+
+def _send_line(fo, obj):
+    fo.write(json.dumps(obj) + '\n')
+    fo.flush()
+    return
+
+#############################################################################
+# server
+#
+
+class _Worker:
+
+    """a server worker process: runs the jobs from the connections it
+    accepts, one at a time"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        # (directory, max_size) => DownloadCache
+        self.caches = {}
+        return
+
+    def _cache(self, spec):
+        if spec is None or spec is False:
+            return spec
+        key = (spec['directory'], spec.get('max_size'))
+        if key not in self.caches:
+            self.caches[key] = DownloadCache(*key)
+        return self.caches[key]
+
+    def run(self):
+        while True:
+            try:
+                (conn, address) = self.sock.accept()
+            except socket.error, exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                raise
+            try:
+                self.handle(conn)
+            except Exception, exc:
+                message(NOTICE, 'error handling job: %s' % str(exc))
+            finally:
+                conn.close()
+        return
+
+    def handle(self, conn):
+
+        in_fo = conn.makefile('rb')
+        out_fo = conn.makefile('wb')
+        line = in_fo.readline()
+        if not line:
+            return
+        job = json.loads(line)
+        kwargs = {}
+        for (key, value) in job.get('kwargs', {}).iteritems():
+            kwargs[str(key)] = value
+        kwargs['cache'] = self._cache(job.get('cache'))
+
+        lock = threading.Lock()
+        (stdout, stderr) = (sys.stdout, sys.stderr)
+        (output_level, progname) = (common.output_level, common.progname)
+        sys.stdout = _StreamWriter(out_fo, 'stdout', lock)
+        sys.stderr = _StreamWriter(out_fo, 'stderr', lock)
+        common.output_level = job.get('output_level', NOTICE)
+        common.progname = job.get('progname', progname)
+        try:
+            result = unpack(job['source'], **kwargs)
+        finally:
+            (sys.stdout, sys.stderr) = (stdout, stderr)
+            (common.output_level, common.progname) = (output_level, progname)
+
+        message(DEBUG, 'job %s exited with %d' % (job['source'],
+                                                  result.exit_value))
+        _send_line(out_fo, {'result': {'exit_value': result.exit_value,
+                                       'error': result.error,
+                                       'traceback': result.traceback,
+                                       'volumes': result.volumes,
+                                       'thumbnail': result.thumbnail,
+                                       'image03': result.image03,
+                                       'metrics': result.metrics}})
+        return
+
+def _server_running(socket_path):
+    """is a server listening on socket_path?"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return True
+
+def serve(socket_path, workers=1):
+
+    """serve unpack() jobs on the Unix socket socket_path with workers
+    worker processes
+
+    Runs until interrupted or terminated (SIGTERM), then stops the
+    workers and removes the socket.  Workers that exit are replaced.
+    """
+
+    if os.path.exists(socket_path):
+        if _server_running(socket_path):
+            raise GeneralError('a server is already running on %s' %
+                               socket_path)
+        message(DEBUG, 'removing stale socket %s' % socket_path)
+        os.unlink(socket_path)
+
+    # import the libraries once, for all of the workers
+    message(DEBUG, 'importing libraries')
+    dicom.read_file
+    boto.connect_s3
+    for module in (nibabel, numpy, SimpleITK):
+        bool(module)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0077)
+    try:
+        sock.bind(socket_path)
+    finally:
+        os.umask(umask)
+    sock.listen(64)
+    message(NOTICE, 'serving on %s with %d workers' % (socket_path, workers))
+
+    children = set()
+
+    def start_worker():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            try:
+                _Worker(sock).run()
+            finally:
+                os._exit(1)
+        children.add(pid)
+        return
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        for i in xrange(workers):
+            start_worker()
+        while True:
+            try:
+                (pid, status) = os.wait()
+            except OSError, exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                raise
+            children.discard(pid)
+            message(NOTICE, 'worker %d exited; starting another' % pid)
+            start_worker()
+    except KeyboardInterrupt:
+        message(NOTICE, 'stopping')
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        sock.close()
+        os.unlink(socket_path)
+
+    return
+
+#############################################################################
+# client
+#
+
+def _absolute(path):
+    if not path or path == '-' or path is True:
+        return path
+    return os.path.abspath(path)
+
+def remote_unpack(socket_path, source, cache=None, **kwargs):
+
+    """run unpack(source, **kwargs) on the server listening on
+    socket_path and return an UnpackResult
+
+    The job's output is written to sys.stdout and sys.stderr as the
+    server sends it.  cache is None, False or a DownloadCache, as for
+    unpack().  UnpackResult.data is always None.
+
+    Raises socket.error if the server can't be reached.
+    """
+
+    if not source.startswith('s3://'):
+        source = os.path.abspath(source)
+    for key in path_keywords:
+        if key in kwargs:
+            kwargs[key] = _absolute(kwargs[key])
+    if kwargs.get('volume'):
+        if isinstance(kwargs['volume'], basestring):
+            kwargs['volume'] = [kwargs['volume']]
+        kwargs['volume'] = [ _absolute(v) for v in kwargs['volume'] ]
+    if cache:
+        cache = {'directory': cache.directory, 'max_size': cache.max_size}
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    try:
+        out_fo = sock.makefile('wb')
+        in_fo = sock.makefile('rb')
+        _send_line(out_fo, {'source': source,
+                            'kwargs': kwargs,
+                            'cache': cache,
+                            'output_level': common.output_level,
+                            'progname': common.progname})
+        for line in in_fo:
+            obj = json.loads(line)
+            if 'stream' in obj:
+                if obj['stream'] == 'stderr':
+                    fo = sys.stderr
+                else:
+                    fo = sys.stdout
+                fo.write(obj['data'])
+                fo.flush()
+            elif 'result' in obj:
+                result = UnpackResult(source)
+                for (key, value) in obj['result'].iteritems():
+                    setattr(result, str(key), value)
+                return result
+    finally:
+        sock.close()
+
+    raise GeneralError('lost the connection to the server')
+
+# eof
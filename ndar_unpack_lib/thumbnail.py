@@ -0,0 +1,130 @@
+# See file COPYING distributed with ndar_unpack for copyright and license.
+
+"""in-process thumbnail rendering for ndar_unpack
+
+render_thumbnail() writes a PNG of the sagittal, coronal and axial
+mid-plane slices of a NIfTI volume side by side (like slicer -a), reading
+only those slices through nibabel's array proxy.
+"""
+
+import struct
+import zlib
+
+from .data import nibabel, numpy
+
+# intensity window percentiles
+window_percentiles = (2, 98)
+
+def write_png(fname, pixels):
+
+    """write a 2-D uint8 array as an 8-bit grayscale PNG"""
+
+    (height, width) = pixels.shape
+    # each scanline is preceded by its filter type (0, none)
+    raw = ''.join([ '\0' + pixels[row].tostring() for row in xrange(height) ])
+
+    def chunk(tag, data):
+        crc = zlib.crc32(tag + data) & 0xffffffff
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', crc)
+
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)
+    fo = open(fname, 'wb')
+    try:
+        fo.write('\x89PNG\r\n\x1a\n')
+        fo.write(chunk('IHDR', ihdr))
+        fo.write(chunk('IDAT', zlib.compress(raw)))
+        fo.write(chunk('IEND', ''))
+    finally:
+        fo.close()
+    return
+
+def _resample(plane, zooms):
+    """nearest-neighbour resample a 2-D plane to square pixels"""
+    scale = min(zooms)
+    for axis in (0, 1):
+        n = plane.shape[axis]
+        new_n = max(int(round(n * zooms[axis] / scale)), 1)
+        if new_n != n:
+            index = (numpy.arange(new_n) * n) // new_n
+            plane = numpy.take(plane, index, axis=axis)
+    return plane
+
+def mid_planes(image):
+
+    """return the sagittal, coronal and axial mid-plane slices of a
+    nibabel image in canonical (RAS) orientation
+
+    Only the three slices (of the middle volume, for 4-D data) are read.
+    Each plane is returned as a 2-D array with superior (or anterior, for
+    the axial plane) up and resampled to square pixels.
+    """
+
+    shape = image.shape
+    if len(shape) < 3:
+        raise ValueError('volume has fewer than three dimensions')
+    zooms = image.header.get_zooms()
+
+    # ornt[input axis] = (RAS axis, flip)
+    ornt = nibabel.io_orientation(image.affine)
+    ras_to_input = {}
+    for (input_axis, (ras_axis, flip)) in enumerate(ornt[:3]):
+        ras_to_input[int(ras_axis)] = (input_axis, flip < 0)
+
+    extra = tuple([ n // 2 for n in shape[3:] ])
+
+    planes = []
+    # (slice axis, axis displayed across, axis displayed up)
+    for (slice_ras, across_ras, up_ras) in ((0, 1, 2), (1, 0, 2), (2, 0, 1)):
+        (slice_axis, slice_flip) = ras_to_input[slice_ras]
+        slicer = [slice(None)] * 3
+        slicer[slice_axis] = shape[slice_axis] // 2
+        plane = numpy.asarray(image.dataobj[tuple(slicer) + extra])
+        # the remaining input axes, in input order
+        remaining = [ a for a in (0, 1, 2) if a != slice_axis ]
+        (across_axis, across_flip) = ras_to_input[across_ras]
+        (up_axis, up_flip) = ras_to_input[up_ras]
+        if remaining.index(across_axis) != 0:
+            plane = plane.T
+        if across_flip:
+            plane = plane[::-1, :]
+        if up_flip:
+            plane = plane[:, ::-1]
+        # rows down the image run from superior to inferior
+        plane = plane.T[::-1, :]
+        plane = _resample(plane, (zooms[up_axis], zooms[across_axis]))
+        planes.append(plane)
+
+    return planes
+
+def render_thumbnail(nifti_fname, png_fname):
+
+    """write a thumbnail PNG of a NIfTI volume
+
+    Intensities are windowed to the window_percentiles percentiles of the
+    three slices.
+    """
+
+    image = nibabel.load(nifti_fname)
+    planes = [ numpy.nan_to_num(p.astype(numpy.float32))
+               for p in mid_planes(image) ]
+
+    values = numpy.concatenate([ p.ravel() for p in planes ])
+    (low, high) = numpy.percentile(values, window_percentiles)
+    if high <= low:
+        high = low + 1
+
+    height = max([ p.shape[0] for p in planes ])
+    width = sum([ p.shape[1] for p in planes ])
+    thumbnail = numpy.zeros((height, width), dtype=numpy.uint8)
+    x = 0
+    for p in planes:
+        scaled = numpy.clip((p - low) * 255.0 / (high - low), 0, 255)
+        y = (height - p.shape[0]) // 2
+        thumbnail[y:y+p.shape[0], x:x+p.shape[1]] = scaled.astype(numpy.uint8)
+        x += p.shape[1]
+
+    write_png(png_fname, thumbnail)
+
+    return png_fname
+
+# eof